@@ -0,0 +1,183 @@
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import subprocess
+import tempfile
+import numpy as np
+from glob import glob
+from os.path import join, dirname, abspath
+from tqdm import tqdm
+from settings import eval_settings
+from isles.masks import load_mask
+from isles.scoring import score_batch
+from isles.synthetic import write_synthetic_dataset
+
+# Synthetic scenarios: volume shape, number of true lesions, lesion radius range (voxels), overlap level and number of
+# false-positive lesions in the prediction.
+SHAPES = {'small': (64, 64, 64), 'mni': (197, 233, 189)}
+SCENARIOS = {
+    'quick': [
+        {'shape': 'small', 'num_lesions': 1, 'radius_range': (3, 6), 'overlap': 0.8, 'num_false_positives': 0},
+        {'shape': 'mni', 'num_lesions': 10, 'radius_range': (3, 8), 'overlap': 0.8, 'num_false_positives': 5},
+    ],
+    'full': [
+        {'shape': 'mni', 'num_lesions': 1, 'radius_range': (8, 15), 'overlap': 0.8, 'num_false_positives': 0},
+        {'shape': 'mni', 'num_lesions': 10, 'radius_range': (3, 8), 'overlap': 0.8, 'num_false_positives': 5},
+        {'shape': 'mni', 'num_lesions': 100, 'radius_range': (1, 4), 'overlap': 0.5, 'num_false_positives': 50},
+        {'shape': 'mni', 'num_lesions': 500, 'radius_range': (1, 2), 'overlap': 0.5, 'num_false_positives': 500},
+        {'shape': 'mni', 'num_lesions': 10, 'radius_range': (3, 8), 'overlap': 0.0, 'num_false_positives': 0},
+        {'shape': 'mni', 'num_lesions': 10, 'radius_range': (3, 8), 'overlap': 1.0, 'num_false_positives': 0},
+    ],
+}
+
+# Runs evaluation.py in a fresh interpreter with overridden settings, then prints the peak RSS of the run. On Linux,
+# ru_maxrss of a freshly started process can include the memory of the benchmark process that started it, so the
+# high-water mark in /proc is used instead when available.
+_EVALUATION_BOOTSTRAP = '''
+import sys, json, resource, runpy, settings
+settings.eval_settings.update(json.loads(sys.argv.pop(1)))
+runpy.run_path("evaluation.py", run_name="__main__")
+max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+try:
+    with open("/proc/self/status") as f:
+        max_rss = int([line for line in f if line.startswith("VmHWM:")][0].split()[1])
+except (OSError, IndexError):
+    pass
+print(json.dumps({"self": max_rss, "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss}))
+'''
+
+
+def _max_rss_mb(max_rss):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return max_rss / 1024**2 if sys.platform == 'darwin' else max_rss / 1024
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=dirname(abspath(__file__)), capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def scenario_name(scenario):
+    return (f'{scenario["shape"]}_lesions-{scenario["num_lesions"]}_radius-{scenario["radius_range"][0]}-'
+            f'{scenario["radius_range"][1]}_overlap-{scenario["overlap"]}_fp-{scenario["num_false_positives"]}')
+
+
+def time_scoring_functions(truth_root, prediction_root, scoring_functions, batch_size):
+    '''
+    Times every scoring function individually, and score_batch over all of them, on the masks of a synthetic dataset.
+    Loading is not timed.
+    Returns
+    -------
+    dict
+        {name: {'seconds', 'voxels_per_second', 'subjects_per_second'}}; score_batch is reported as 'score_batch'.
+    '''
+    truth_paths = sorted(glob(join(truth_root, '**', '*.nii.gz'), recursive=True))
+    prediction_paths = sorted(glob(join(prediction_root, '**', '*.nii.gz'), recursive=True))
+    batches = []
+    for start_idx in range(0, len(truth_paths), batch_size):
+        batch_slice = slice(start_idx, start_idx + batch_size)
+        truth = np.stack([load_mask(path)[np.newaxis, ...] for path in truth_paths[batch_slice]])
+        prediction = np.stack([load_mask(path)[np.newaxis, ...] for path in prediction_paths[batch_slice]])
+        batches.append((truth, prediction))
+    num_subjects = len(truth_paths)
+    num_voxels = sum(truth.size for truth, _ in batches)
+
+    timed = {score_name: lambda truth, prediction, score=score: score(truth=truth, prediction=prediction,
+                                                                       batchwise=True)
+             for score_name, score in scoring_functions.items()}
+    timed['score_batch'] = lambda truth, prediction: score_batch(truth, prediction, scoring_functions)
+    timings = {}
+    for name, func in timed.items():
+        start = time.perf_counter()
+        for truth, prediction in batches:
+            func(truth, prediction)
+        seconds = time.perf_counter() - start
+        timings[name] = {'seconds': seconds,
+                         'voxels_per_second': num_voxels / seconds,
+                         'subjects_per_second': num_subjects / seconds}
+    return timings
+
+
+def time_evaluation(truth_root, prediction_root, work_dir, num_subjects, multiprocessing, batch_size):
+    '''
+    Times a full evaluation.py run on a synthetic dataset, in a separate interpreter.
+    Returns
+    -------
+    dict
+        Settings of the run, wall time, subjects per second and peak RSS of the main process and of the largest worker.
+    '''
+    overrides = {'GroundTruthRoot': truth_root,
+                 'PredictionRoot': prediction_root,
+                 'GroundTruthIndexRoot': None,
+                 'ScoreCachePath': None,
+                 'MetricsOutputPath': join(work_dir, 'metrics.json'),
+                 'SubjectScoresOutputPath': None,
+                 'Multiprocessing': multiprocessing,
+                 'LoaderBatchSize': batch_size}
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', _EVALUATION_BOOTSTRAP, json.dumps(overrides)],
+                            cwd=dirname(abspath(__file__)), capture_output=True, text=True)
+    seconds = time.perf_counter() - start
+    if(result.returncode != 0):
+        raise RuntimeError(f'evaluation.py failed:\n{result.stderr}')
+    max_rss = json.loads(result.stdout.strip().splitlines()[-1])
+    return {'multiprocessing': multiprocessing,
+            'batch_size': batch_size,
+            'seconds': seconds,
+            'subjects_per_second': num_subjects / seconds,
+            'peak_rss_mb': _max_rss_mb(max_rss['self']),
+            'peak_worker_rss_mb': _max_rss_mb(max_rss['children'])}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the scoring functions and evaluation.py on synthetic '
+                                                 'lesion masks, and writes a JSON report that can be compared '
+                                                 'between commits.')
+    parser.add_argument('--output', default='benchmark.json', help='Path of the JSON report.')
+    parser.add_argument('--scenarios', choices=sorted(SCENARIOS), default='quick', help='Set of scenarios to run.')
+    parser.add_argument('--subjects', type=int, default=8, help='Number of subjects per scenario.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic data.')
+    parser.add_argument('--multiprocessing', type=int, nargs='+', default=[1, 4],
+                        help='Values of Multiprocessing for the evaluation.py runs.')
+    parser.add_argument('--batch-size', type=int, nargs='+', default=[1, 4],
+                        help='Values of LoaderBatchSize for the evaluation.py runs.')
+    parser.add_argument('--skip-evaluation', action='store_true', help='Only time the scoring functions.')
+    parser.add_argument('--work-dir', default=None, help='Directory for the synthetic data. Default: temporary.')
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='isles-benchmark-')
+    report = {'commit': _git_commit(),
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'subjects': args.subjects,
+              'seed': args.seed,
+              'scenarios': []}
+    for scenario in tqdm(SCENARIOS[args.scenarios], desc='Benchmark', dynamic_ncols=True):
+        name = scenario_name(scenario)
+        truth_root = join(work_dir, name, 'ground-truth')
+        prediction_root = join(work_dir, name, 'prediction')
+        shutil.rmtree(join(work_dir, name), ignore_errors=True)
+        write_synthetic_dataset(truth_root, prediction_root, args.subjects, SHAPES[scenario['shape']],
+                                scenario['num_lesions'], scenario['radius_range'], scenario['overlap'],
+                                scenario['num_false_positives'], seed=args.seed)
+
+        result = {'name': name, **scenario, 'shape': SHAPES[scenario['shape']],
+                  'scoring_functions': time_scoring_functions(truth_root, prediction_root,
+                                                              eval_settings['ScoringFunctions'],
+                                                              eval_settings['LoaderBatchSize'])}
+        if(not args.skip_evaluation):
+            result['evaluation'] = [time_evaluation(truth_root, prediction_root, join(work_dir, name), args.subjects,
+                                                    multiprocessing, batch_size)
+                                    for multiprocessing in args.multiprocessing for batch_size in args.batch_size]
+        report['scenarios'].append(result)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    if(args.work_dir is None):
+        shutil.rmtree(work_dir)
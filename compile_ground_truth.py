@@ -0,0 +1,26 @@
+from functools import partial
+from multiprocessing import Pool
+from tqdm import tqdm
+from bidsio import BIDSLoader
+from settings import eval_settings
+from isles.ground_truth import compile_subject
+
+# Compiles the ground truth once into the index at eval_settings['GroundTruthIndexRoot'], which evaluation.py then reads
+# instead of decompressing and relabeling the .nii.gz files. Subjects whose entry is up to date are skipped.
+if __name__ == '__main__':
+    index_root = eval_settings['GroundTruthIndexRoot']
+    if(index_root is None):
+        raise ValueError('Set GroundTruthIndexRoot in settings.py to the directory in which to write the index.')
+
+    BIDSLoader.write_dataset_description(eval_settings['GroundTruthRoot'], eval_settings['GroundTruthBIDSDerivativeName'][0])
+    loader = BIDSLoader(data_root=[eval_settings['GroundTruthRoot']], target_root=[eval_settings['GroundTruthRoot']],
+                        data_derivatives_names=eval_settings['GroundTruthBIDSDerivativeName'],
+                        target_derivatives_names=eval_settings['GroundTruthBIDSDerivativeName'],
+                        target_entities=eval_settings['GroundTruthEntities'],
+                        data_entities=eval_settings['GroundTruthEntities'])
+    path_tuples = [tuple(image.path for image in image_tuple) for image_tuple in loader.target_list]
+
+    with Pool(eval_settings['Multiprocessing']) as pool:
+        for _ in tqdm(pool.imap_unordered(partial(compile_subject, index_root=index_root), path_tuples),
+                      total=len(path_tuples), desc='Compile ground truth', dynamic_ncols=True):
+            pass
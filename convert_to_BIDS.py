@@ -1,10 +1,14 @@
-import os, numpy as np, nibabel as nib
-from os.path import join, basename, dirname, exists
+import os, json, zipfile, tempfile, numpy as np, nibabel as nib
+from os.path import join, basename, dirname, exists, relpath
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 from glob import glob, iglob
 from bidsio import BIDSLoader
 from settings import eval_settings
 from tqdm.contrib import tzip
+from isles.bids_layout import prediction_bids_path
+from isles.integrity import check_files
 
 # Define global vars
 model_prediction_dir = os.getenv('MODEL_PREDICTION_DIR', default=None)
@@ -12,37 +16,86 @@ BIDS_formatted_dir = 'BIDS_' + model_prediction_dir.split('/')[-1]
 zip_filename = f'{BIDS_formatted_dir}.zip'
 
 
-def check_integrity(src_dir: str, fname='*.nii.gz', chk_label_1=False):
-    outlier_paths = []
-    for path in tqdm(sorted(list(iglob(join(src_dir, '**', fname), recursive=True))), desc='CRC Check', colour='BLUE', dynamic_ncols=True):
-        try:
-            elements = np.unique(np.array(nib.load(path).dataobj))
-            if chk_label_1:
-                if len(elements) != 2:
-                    raise Exception(f'Length is not 2; {elements}')
-        except Exception as e:
-            tqdm.write(path+': '+e.__str__())
-            outlier_paths.append(path)
-    return outlier_paths
+def check_integrity(src_dir: str, fname='*.nii.gz', chk_label_1=False, reference_path: str = None):
+    '''
+    Checks every prediction in src_dir over a process pool (see isles.integrity.check_file): gzip CRC, header, shape
+    and affine against reference_path if given, and voxel values in {0, 1}. With chk_label_1, empty predictions are
+    reported too. Returns the reports of the files that failed.
+    '''
+    paths = sorted(iglob(join(src_dir, '**', fname), recursive=True))
+    reports = check_files(paths, reference_path=reference_path, require_all_labels=chk_label_1)
+    failed = [report for report in reports if not report['ok']]
+    for report in failed:
+        tqdm.write(report['path']+': '+'; '.join(report['errors']))
+    tqdm.write(f'Integrity check: {len(failed)} of {len(reports)} files failed')
+    return failed
 
 def chk_CRC(src_dir:str, fname:str='*', recursive:bool=True):
-    for path in tqdm(sorted(list(iglob(f'{src_dir}/{fname}', recursive={recursive}))), desc='CRC Checking'):
-        try:
-            _ = nib.load(path).get_fdata()
-        except Exception as e:
-            tqdm.write(path+': '+e.__str__())
+    # Decodes every file once, streaming, so that gzip verifies its CRC; the voxel values are not checked
+    paths = sorted(iglob(f'{src_dir}/{fname}', recursive=recursive))
+    for report in check_files(paths):
+        if(not report['readable']):
+            tqdm.write(report['path']+': '+'; '.join(report['errors']))
 
 def convert_to_BIDS(src_dir:str, dst_dir:str, fname:str='*.nii.gz'):
     for path in tqdm(sorted(glob(join(src_dir, fname))), desc='Convert to BIDS', colour='green', dynamic_ncols=True):
         # Directory configuration
         tqdm.write(path)
-        first_dir = 'sub-r'+basename(path)[3:6]+'s'+basename(path)[7:10]
-        target_dir = join(dst_dir, first_dir, 'ses-1', 'anat')
-        os.makedirs(target_dir, exist_ok=True)
-        fname = join(f'{first_dir}_{"ses-1"}_{"space-MNI152NLin2009aSym_label_L_desc-T1lesion_mask.nii.gz"}')
+        target_path = prediction_bids_path(dst_dir, path)
+        os.makedirs(dirname(target_path), exist_ok=True)
 
         # Save as NiBabel file        
-        nib.load(path).to_filename(join(target_dir, fname))
+        nib.load(path).to_filename(target_path)
+
+def _read_bytes(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+def _read_ahead(executor, paths, window: int):
+    '''
+    Yields the bytes of every file in paths, in order, with at most window files read ahead by executor.
+    '''
+    pending = deque()
+    for path in paths:
+        pending.append(executor.submit(_read_bytes, path))
+        if(len(pending) > window):
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def package_submission(src_dir: str, zip_path: str, fname: str = '*.nii.gz', num_workers: int = os.cpu_count()):
+    '''
+    Writes the predictions in src_dir into a zip archive with the layout of convert_to_BIDS, without an intermediate
+    directory tree. The files are already gzipped, so their bytes are stored unchanged (no decompression, no
+    recompression); the files are read by a thread pool while the archive is written, at most 2 * num_workers files
+    ahead, so that memory does not grow with the size of the submission.
+    Parameters
+    ----------
+    src_dir : str
+        Directory containing the model predictions.
+    zip_path : str
+        Path of the archive to write.
+    fname : str
+        Optional. Glob pattern of the predictions. Default: '*.nii.gz'.
+    num_workers : int
+        Optional. Number of reading threads. Default: number of CPUs.
+    '''
+    paths = sorted(glob(join(src_dir, fname)))
+    arcnames = [relpath(prediction_bids_path('.', path), '.') for path in paths]
+    if(len(set(arcnames)) != len(arcnames)):
+        raise Exception('Several predictions map to the same BIDS subject')
+
+    # dataset_description.json is generated by BIDSLoader, which only writes into a directory
+    with tempfile.TemporaryDirectory() as description_dir:
+        BIDSLoader.write_dataset_description(description_dir, eval_settings['PredictionBIDSDerivativeName'][0])
+        description = _read_bytes(join(description_dir, 'dataset_description.json'))
+
+    with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_STORED) as archive, \
+            ThreadPoolExecutor(num_workers) as executor:
+        for arcname, data in tqdm(zip(arcnames, _read_ahead(executor, paths, 2 * num_workers)), total=len(paths),
+                                  desc='Package BIDS', colour='green', dynamic_ncols=True):
+            archive.writestr(arcname, data)
+        archive.writestr('dataset_description.json', description)
 
 def union(src0_dir:str, src1_dir:str, dst_dir:str):
     os.makedirs(dst_dir, exist_ok=True)
@@ -69,9 +122,9 @@ if __name__ == '__main__':
     if exists(zip_filename):
         os.remove(zip_filename)
     # union(union_src0_dir, union_src1_dir, union_dst_dir)
-    convert_to_BIDS(model_prediction_dir, BIDS_formatted_dir)
-    BIDSLoader.write_dataset_description(BIDS_formatted_dir, eval_settings['PredictionBIDSDerivativeName'][0])
     if os.getenv('CHECK_CRC', default=None) == 'True':
-        check_integrity(BIDS_formatted_dir)
-    os.system(f'cd {BIDS_formatted_dir} && zip -qr ../{zip_filename} *')
-    os.system(f'rm -rf {BIDS_formatted_dir}')
\ No newline at end of file
+        failed = check_integrity(model_prediction_dir, reference_path=os.getenv('REFERENCE_PATH', default=None))
+        if os.getenv('INTEGRITY_REPORT_PATH', default=None) is not None:
+            with open(os.getenv('INTEGRITY_REPORT_PATH'), 'w') as f:
+                json.dump(failed, f, indent=2)
+    package_submission(model_prediction_dir, zip_filename)
@@ -1,23 +1,107 @@
-import pandas as pd, json, numpy as np, nibabel as nib
-from glob import iglob
+import os, csv, time, queue, argparse, threading, json, numpy as np, nibabel as nib
 from tqdm import tqdm
 from bidsio import BIDSLoader
 from collections import defaultdict
+from contextlib import nullcontext
 from multiprocessing import Pool
 from settings import eval_settings
+from isles.scoring import score_batch, label_mask, threshold_sweep, lesion_size_bucket, SWEEP_METRICS
+from isles.ground_truth import load_subject
+from isles.score_cache import ScoreCache
+from isles.masks import load_mask, VolumeCache
+from isles.aggregation import ScoreAggregator, bootstrap_mean_intervals, bootstrap_paired_comparison, bootstrap_ranks
+from isles.profiling import StageProfiler, summarize_events, write_trace
+from isles.slabs import score_slabs, slab_scoring_functions
+from isles.sharding import parse_shard, shard_subjects, write_partial
+
+
+def prefetch(iterable, depth: int):
+    '''
+    Iterates over iterable in a background thread, keeping up to depth items ready in a bounded queue. Used to decode
+    the next batch while the current one is being scored; at most depth + 2 items (queued, being produced and being
+    consumed) are alive at any time. Exceptions raised by the iterable are re-raised in the consuming thread.
+    Parameters
+    ----------
+    iterable : iterable
+        Iterable to consume in the background.
+    depth : int
+        Maximum number of items waiting in the queue. If 0, the iterable is consumed in the calling thread.
+    Returns
+    -------
+    generator
+    '''
+    if(depth <= 0):
+        yield from iterable
+        return
+
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(entry):
+        # Give up if the consumer went away, instead of blocking forever on a full queue
+        while not stop.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if(not put((item, None))):
+                    return
+            put((done, None))
+        except BaseException as e:
+            put((done, e))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item, error = items.get()
+            if(item is done):
+                if(error is not None):
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        producer.join()
 
 
 def evaluate(bids_loader: BIDSLoader,
-             scoring_functions: dict) -> dict:
+             scoring_functions: dict,
+             prefetch_depth: int = 0,
+             profiler: StageProfiler = None,
+             thresholds: list = None,
+             lesion_tables: list = None) -> dict:
     '''
     Evaluates the prediction:truth pairs stored in the loader according to the scoring functions. Returns a dict
     containing the scores for each pair, keyed identically to scoring_functions.
     Parameters
     ----------
     bids_loader : BIDSLoader
-        BIDSLoader containing predictions in .data_list and the ground_truth in .target_list.
+        BIDSLoader containing predictions in .data_list and the ground_truth in .target_list. If the loader yields
+        (prediction, truth, truth_labels, spacings) batches, as SubjectLoader does, the precomputed ground truth labels
+        are used by the lesion metrics instead of relabeling the ground truth, and the voxel spacings by the surface
+        distance metrics.
     scoring_functions : dict
         Dictionary of scoring functions to use to evaluate predictions, keyed by the desired output name.
+    prefetch_depth : int
+        Optional. Number of batches to decode in a background thread while the current batch is scored. If 0, batches
+        are loaded synchronously. Default: 0.
+    profiler : StageProfiler
+        Optional. If set, the loading of every batch and the scoring stages (see score_batch) are recorded, with the
+        subjects of the batch. Default: None.
+    thresholds : list
+        Optional. If set, the predictions are treated as probabilities and the threshold_sweep metrics are also
+        computed at every threshold, as scores named by sweep_score_name. Default: None.
+    lesion_tables : list
+        Optional. If set, the LesionTable of every pair (see isles.scoring.lesion_statistics) is appended to it, in the
+        order of the scores. Default: None.
     Returns
     -------
     dict [list]
@@ -25,109 +109,914 @@ def evaluate(bids_loader: BIDSLoader,
         to the aggregator before writing out results.
     '''
     score_results = defaultdict(list)
+    batches = bids_loader.load_batches()
+    if(profiler is not None):
+        data_list, batch_size = bids_loader.data_list, bids_loader.batch_size
+        batch_subjects = [[subject_name(image_tuple) for image_tuple in data_list[idx:idx+batch_size]]
+                          for idx in range(0, len(data_list), batch_size)]
+        # Wrapped before prefetch, so that loading is timed in the thread doing it
+        batches = profiler.iterate('load', batches, item_args=[{'subjects': subjects} for subjects in batch_subjects])
     # Iterate through data
-    for prediction, truth in bids_loader.load_batches():
-        # Score
-        for score_name, score in scoring_functions.items():
-            scores = score(truth=truth, prediction=prediction, batchwise=True)
+    for batch_idx, (prediction, truth, *extras) in enumerate(prefetch(batches, prefetch_depth)):
+        if(profiler is not None):
+            profiler.context = {'subjects': batch_subjects[batch_idx]}
+        batch_scores = score_samples(truth, prediction, scoring_functions,
+                                     truth_labels=extras[0] if len(extras) > 0 else None,
+                                     spacings=extras[1] if len(extras) > 1 else None, profiler=profiler,
+                                     thresholds=thresholds, lesion_tables=lesion_tables)
+        for score_name, scores in batch_scores.items():
             score_results[score_name] += scores
     return score_results
 
 
-def aggregate_scores(scores, aggregates):
+def score_samples(truth, prediction, scoring_functions: dict, truth_labels=None, spacings=None,
+                  profiler: StageProfiler = None, thresholds: list = None, lesion_tables: list = None) -> dict:
     '''
-    Returns the aggregate measures in scores.
+    Scores a batch of prediction:truth pairs with score_batch and, if thresholds is set, the threshold sweep.
     Parameters
     ----------
-    scores : dict
-        Dictionaries of score_name:sample_scores to aggregate.
-    aggregates : list
-        List of strings containing valid keys of pandas.Series.describe().
+    truth, prediction : np.array
+        Ground truth and predictions, shaped (batch, num_images, x, y, z).
+    scoring_functions : dict
+        Dictionary of scoring functions to use, keyed by the desired output name.
+    truth_labels, spacings
+        Optional. Precomputed ground truth labels and voxel spacings of every sample; see score_batch. Default: None.
+    profiler, thresholds, lesion_tables
+        Optional. See evaluate(). Default: None.
+    Returns
+    -------
+    dict
+        Dict of score_name: scores of every sample.
+    '''
+    # Shared intermediates (e.g. confusion counts) are computed once per batch
+    intermediates = {'lesions': None} if lesion_tables is not None else None
+    score_results = score_batch(truth=truth, prediction=prediction, scoring_functions=scoring_functions,
+                                truth_labels=truth_labels, profiler=profiler, spacings=spacings,
+                                intermediates=intermediates)
+    if(lesion_tables is not None):
+        lesion_tables += intermediates['lesions']
+    if(thresholds is not None):
+        with profiler.stage('threshold_sweep') if profiler is not None else nullcontext():
+            curves = threshold_sweep(truth, prediction, thresholds, batchwise=True)
+        for metric_name, sample_curves in curves.items():
+            for threshold_idx, threshold in enumerate(thresholds):
+                score_results[sweep_score_name(metric_name, threshold)] = [curve[threshold_idx]
+                                                                           for curve in sample_curves]
+    return score_results
+
+
+def evaluate_slabs(data_list: list, target_list: list, scoring_functions: dict, slab_depth: int,
+                   lesion_tables: list = None) -> dict:
+    '''
+    Scores the subjects one z-slab at a time with isles.slabs.score_slabs, so that memory is bounded by the slab
+    rather than by the volume. Scoring functions that need whole volumes are skipped.
+    Parameters
+    ----------
+    data_list : list
+        Prediction image tuples of the subjects; the first image of each tuple is scored.
+    target_list : list
+        Ground truth image tuples of the subjects.
+    scoring_functions : dict
+        Dict of name: function, as for evaluate().
+    slab_depth : int
+        Number of z-planes per slab.
+    lesion_tables : list
+        Optional. If set, the LesionTable of every subject is appended to it. Default: None.
+    Returns
+    -------
+    dict
+        Dict of score_name: list of scores, as returned by evaluate().
+    '''
+    score_results = defaultdict(list)
+    for data_tuple, target_tuple in zip(data_list, target_list):
+        intermediates = {'lesions': None} if lesion_tables is not None else None
+        scores = score_slabs(target_tuple[0].path, data_tuple[0].path, scoring_functions, slab_depth=slab_depth,
+                             intermediates=intermediates)
+        if(lesion_tables is not None):
+            lesion_tables += intermediates['lesions']
+        for score_name, score in scores.items():
+            score_results[score_name].append(score)
+    return score_results
+
+
+def warn_slab_skipped(settings: dict):
+    '''
+    If SlabDepth is set, lists the scores that need whole volumes (e.g. surface distances, the threshold sweep) and
+    are therefore not computed.
+    '''
+    if(settings['SlabDepth'] is None):
+        return
+    skipped = list(slab_scoring_functions(settings['ScoringFunctions'])[1])
+    if(settings['SweepThresholds'] is not None):
+        skipped.append('threshold sweep')
+    if(skipped):
+        tqdm.write(f'Not computed slab-wise: {", ".join(skipped)}')
+
+
+def computed_scoring_functions(settings: dict) -> dict:
+    '''
+    Returns the scoring functions actually computed with the settings, keyed by output name: those that can be scored
+    slab-wise if SlabDepth is set, else ScoringFunctions and the scores of the threshold sweep. The score cache keys on
+    them, so that the partial scores of a slab-wise run are never returned to a whole-volume run.
+    '''
+    if(settings['SlabDepth'] is not None):
+        return slab_scoring_functions(settings['ScoringFunctions'])[0]
+    scoring_functions = dict(settings['ScoringFunctions'])
+    for threshold in settings['SweepThresholds'] or []:
+        scoring_functions.update({sweep_score_name(metric_name, threshold): threshold_sweep
+                                  for metric_name in SWEEP_METRICS})
+    return scoring_functions
+
+
+def score_cache_key(score_cache: ScoreCache, data_tuple, target_tuple, settings: dict) -> str:
+    '''
+    Returns the score cache key of a subject: its files, the scoring functions computed (see
+    computed_scoring_functions) and the SlabDepth they are computed with.
+    '''
+    return score_cache.key([image.path for image in data_tuple], [image.path for image in target_tuple],
+                           computed_scoring_functions(settings), options={'SlabDepth': settings['SlabDepth']})
+
+
+def sweep_score_name(metric_name: str, threshold: float) -> str:
+    '''
+    Returns the name under which the score of metric_name at a sweep threshold is reported, e.g. 'Dice @ 0.5'.
+    '''
+    return f'{metric_name} @ {threshold:g}'
+
+
+def split_sweep_summary(score_summary: dict, thresholds: list) -> tuple:
+    '''
+    Separates the threshold sweep scores from the summary of the regular scoring functions.
+    Returns
+    -------
+    tuple
+        (score_summary without the sweep scores, curves), where curves is {'thresholds': thresholds, metric name:
+        {aggregate: list of values at each threshold}}.
+    '''
+    curves = {'thresholds': list(thresholds)}
+    score_summary = dict(score_summary)
+    for metric_name in SWEEP_METRICS:
+        summaries = [score_summary.pop(sweep_score_name(metric_name, threshold), None) for threshold in thresholds]
+        if(summaries[0] is not None):
+            curves[metric_name] = {aggregate: [summary[aggregate] for summary in summaries]
+                                   for aggregate in summaries[0]}
+    return score_summary, curves
+
+
+def score_lists(subject_scores: list, score_names) -> dict:
+    '''
+    Turns a list of per-subject {score_name: score} dicts into {score_name: list of scores}, with NaN for the scores
+    missing from a subject.
+    '''
+    return {score_name: [np.nan if scores.get(score_name) is None else float(scores[score_name])
+                         for scores in subject_scores]
+            for score_name in score_names}
+
+
+def subject_key(record: dict) -> tuple:
+    '''
+    Returns the (subject, session) pair identifying a per-subject record (see subject_record).
+    '''
+    return record.get('subject'), record.get('session')
+
+
+def record_scores(record: dict) -> dict:
+    '''
+    Returns the {score_name: score} of a per-subject record (see subject_record).
+    '''
+    return {name: score for name, score in record.items() if name not in ('subject', 'session')}
+
+
+def load_subject_scores(path: str) -> dict:
+    '''
+    Reads a per-subject scores file written to SubjectScoresOutputPath, as {(subject, session): {score_name: score}}.
+    '''
+    subject_scores = {}
+    with open(path) as f:
+        for line in f:
+            if(line.strip()):
+                record = json.loads(line)
+                subject_scores[subject_key(record)] = record_scores(record)
+    return subject_scores
 
+
+def paired_comparison(subject_scores: dict, reference_path: str, score_names, settings: dict) -> dict:
+    '''
+    Compares the scores of this evaluation with those of the per-subject scores file at reference_path, on the subjects
+    present in both, with a subject-paired bootstrap (see isles.aggregation.bootstrap_paired_comparison).
+    Parameters
+    ----------
+    subject_scores : dict
+        {(subject, session): {score_name: score}} of this evaluation.
+    reference_path : str
+        Per-subject scores file of the reference submission.
+    score_names : iterable
+        Names of the scores to compare.
+    settings : dict
+        Evaluation settings; the Bootstrap* entries are used.
     Returns
     -------
+    dict
+        {'reference': reference_path, 'num_subjects', 'metrics': {score_name: comparison}}.
+    '''
+    reference = load_subject_scores(reference_path)
+    keys = sorted((key for key in subject_scores if key in reference), key=str)
+    comparison = bootstrap_paired_comparison(score_lists([subject_scores[key] for key in keys], score_names),
+                                             score_lists([reference[key] for key in keys], score_names),
+                                             num_resamples=settings['BootstrapResamples'],
+                                             seed=settings['BootstrapSeed'],
+                                             confidence=settings['BootstrapConfidence'])
+    return {'reference': reference_path, 'num_subjects': len(keys), 'metrics': comparison}
+
 
+def write_metrics(aggregator: ScoreAggregator, subject_scores: dict, settings: dict, timings: dict = None):
     '''
-    score_des = pd.DataFrame(scores).describe()
-    score_summary = defaultdict(dict)
-    for score_name in score_des.keys():
-        for score_agg in score_des[score_name].keys():
-            if(score_agg in aggregates):
-                score_summary[score_name][score_agg] = score_des[score_name][score_agg]
-    return score_summary
+    Writes the summary of an evaluation to MetricsOutputPath: the Aggregates of every score, with the bootstrap
+    intervals and paired comparison if BootstrapResamples is set, and the threshold sweep curves to SweepOutputPath.
+    Parameters
+    ----------
+    aggregator : ScoreAggregator
+        Aggregated scores of every subject.
+    subject_scores : dict
+        {(subject, session): {score_name: score}}; only used by the bootstrap.
+    settings : dict
+        Evaluation settings.
+    timings : dict
+        Optional. Stage timings, stored under 'timings'. Default: None.
+    '''
+    score_summary = aggregator.summary(settings['Aggregates'])
+    if(settings['BootstrapResamples'] is not None):
+        # Scores that were not computed, e.g. the surface distances of a slab-wise run, have no summary
+        score_names = [score_name for score_name in settings['ScoringFunctions'] if score_name in score_summary]
+        # Subjects in a fixed order, so that the intervals do not depend on the order (or shard) they were scored in
+        keys = sorted(subject_scores, key=str)
+        intervals = bootstrap_mean_intervals(score_lists([subject_scores[key] for key in keys], score_names),
+                                             num_resamples=settings['BootstrapResamples'],
+                                             seed=settings['BootstrapSeed'],
+                                             confidence=settings['BootstrapConfidence'])
+        for score_name, interval in intervals.items():
+            score_summary[score_name].update(interval)
+        if(settings['BootstrapReferencePath'] is not None):
+            score_summary['paired_comparison'] = paired_comparison(subject_scores, settings['BootstrapReferencePath'],
+                                                                   score_names, settings)
+    if(settings['SweepThresholds'] is not None):
+        score_summary, curves = split_sweep_summary(score_summary, settings['SweepThresholds'])
+        with open(settings['SweepOutputPath'], 'w') as f:
+            json.dump(curves, f)
+    if(timings is not None):
+        score_summary['timings'] = timings
+    with open(settings['MetricsOutputPath'], 'w') as f:
+        json.dump(score_summary, f)
 
 
-def merge_dict(list_of_dicts: list) -> defaultdict:
+def write_submission_metrics(aggregators: dict, subject_scores: dict, subject_keys, settings: dict,
+                             timings: dict = None):
     '''
-    Merges the dicts of the list into a single dict.
+    Writes the summaries of the batch mode: MetricsOutputPath once per submission (see submission_output_path), with
+    the bootstrap intervals and ranks if BootstrapResamples is set, SweepOutputPath once per submission if
+    SweepThresholds is set, and the side-by-side table to ComparisonOutputPath.
     Parameters
     ----------
-    list_of_dicts : list
-        List of dicts to combine.
+    aggregators : dict
+        {submission name: ScoreAggregator}.
+    subject_scores : dict
+        {submission name: {subject key: {score_name: score}}}; only used by the bootstrap.
+    subject_keys : iterable
+        Keys of every subject, in the order in which they are resampled.
+    settings : dict
+        Evaluation settings.
+    timings : dict
+        Optional. Stage timings of the whole run, stored under 'timings' in every summary. Default: None.
+    '''
+    summaries = {name: aggregator.summary(settings['Aggregates']) for name, aggregator in aggregators.items()}
+    extra_aggregates = []
+    if(settings['BootstrapResamples'] is not None):
+        # Every submission is resampled over the same subjects; NaN marks the subjects it did not predict
+        bootstrap_scores = {name: score_lists([scores.get(key, {}) for key in subject_keys],
+                                              settings['ScoringFunctions'])
+                            for name, scores in subject_scores.items()}
+        for name, scores in bootstrap_scores.items():
+            intervals = bootstrap_mean_intervals(scores, num_resamples=settings['BootstrapResamples'],
+                                                 seed=settings['BootstrapSeed'],
+                                                 confidence=settings['BootstrapConfidence'])
+            for score_name, interval in intervals.items():
+                summaries[name].setdefault(score_name, {}).update(interval)
+        ranks = bootstrap_ranks(bootstrap_scores, num_resamples=settings['BootstrapResamples'],
+                                seed=settings['BootstrapSeed'], lower_is_better=settings['LowerIsBetter'])
+        for score_name, submission_ranks in ranks.items():
+            for name, rank in submission_ranks.items():
+                summaries[name].setdefault(score_name, {}).update(rank)
+        extra_aggregates = ['mean_ci_low', 'mean_ci_high', 'mean_rank', 'rank_1_frequency']
+    for name, summary in summaries.items():
+        if(settings['SweepThresholds'] is not None):
+            summary, curves = split_sweep_summary(summary, settings['SweepThresholds'])
+            with open(submission_output_path(settings['SweepOutputPath'], name), 'w') as f:
+                json.dump(curves, f)
+        if(timings is not None):
+            summary['timings'] = timings
+        with open(submission_output_path(settings['MetricsOutputPath'], name), 'w') as f:
+            json.dump(summary, f)
+    if(settings['ComparisonOutputPath'] is not None):
+        with open(settings['ComparisonOutputPath'], 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['metric', 'aggregate'] + list(summaries))
+            for score_name in settings['ScoringFunctions']:
+                for aggregate in settings['Aggregates'] + extra_aggregates:
+                    row = [summaries[name].get(score_name, {}).get(aggregate) for name in summaries]
+                    if(any(value is not None for value in row)):
+                        writer.writerow([score_name, aggregate] + row)
+
+
+def subject_name(image_tuple) -> str:
+    '''
+    Returns the BIDS name of the subject and session of an image tuple, e.g. 'sub-r001s001_ses-1'.
+    '''
+    entities = image_tuple[0].get_entities()
+    if(entities.get('session') is None):
+        return f'sub-{entities.get("subject")}'
+    return f'sub-{entities.get("subject")}_ses-{entities.get("session")}'
+
+
+def subject_record(image_tuple, scores: dict) -> dict:
+    '''
+    Returns the per-subject output record: the subject and session of the subject, followed by its scores.
+    '''
+    entities = image_tuple[0].get_entities()
+    return {'subject': entities.get('subject'), 'session': entities.get('session'), **scores}
+
+
+def lesion_table_rows(image_tuple, table) -> list:
+    '''
+    Returns the rows of the per-lesion output of a subject: one dict per lesion of the ground truth and of the
+    prediction, with the subject and session, the mask, the size bucket and the fields of the LesionTable.
+    '''
+    entities = image_tuple[0].get_entities()
+    rows = []
+    for mask, lesions in (('truth', table.truth), ('prediction', table.pred)):
+        for lesion in lesions:
+            rows.append({'subject': entities.get('subject'), 'session': entities.get('session'), 'mask': mask,
+                         'channel': int(lesion['channel']), 'label': int(lesion['label']), 'voxels': int(lesion['voxels']),
+                         'size': lesion_size_bucket(lesion['voxels']), 'overlap': int(lesion['overlap']),
+                         'detected': bool(lesion['detected']),
+                         **{f'{axis}_start': int(start) for axis, start in zip('xyz', lesion['bbox_start'])},
+                         **{f'{axis}_stop': int(stop) for axis, stop in zip('xyz', lesion['bbox_stop'])}})
+    return rows
+
+
+def open_lesion_table(path: str) -> tuple:
+    '''
+    Opens the per-lesion output at path. Returns (file, csv.DictWriter) for the rows of lesion_table_rows.
+    '''
+    lesion_file = open(path, 'w', newline='')
+    lesion_writer = csv.DictWriter(lesion_file, fieldnames=['subject', 'session', 'mask', 'channel', 'label', 'voxels',
+                                                            'size', 'overlap', 'detected', 'x_start', 'y_start',
+                                                            'z_start', 'x_stop', 'y_stop', 'z_stop'])
+    lesion_writer.writeheader()
+    return lesion_file, lesion_writer
+
+
+def stack_views(arrays) -> np.ndarray:
+    '''
+    np.stack, except that a single array is returned as a view with a new leading axis. Memory-mapped volumes (from
+    the ground truth index or the volume cache) then reach the scoring functions without a private copy.
+    '''
+    if(len(arrays) == 1):
+        return arrays[0][np.newaxis]
+    return np.stack(arrays)
 
+
+class SubjectLoader:
+    '''
+    Minimal stand-in for BIDSLoader over an already-built dataset index. Unlike BIDSLoader, it does not index the BIDS
+    trees and is cheap to create and pickle, so the index is built once and shared with every worker. If
+    ground_truth_index is set, the ground truth is read from the precomputed index (see compile_ground_truth.py) when
+    an up-to-date entry exists. If mask_mode is set, images are loaded as boolean masks instead of float32 arrays,
+    which takes a quarter of the memory and avoids any copy in the scoring functions; with a volume_cache, the masks
+    are then memory-mapped from the cache instead of decoded. If probabilities is set, the predictions are always
+    loaded as float32 arrays, for threshold sweeps over probability maps.
+    '''
+    def __init__(self, data_list: list, target_list: list, batch_size: int = 1, ground_truth_index: str = None,
+                 mask_mode: bool = False, volume_cache: VolumeCache = None, probabilities: bool = False):
+        self.data_list = data_list
+        self.target_list = target_list
+        self.batch_size = batch_size
+        self.ground_truth_index = ground_truth_index
+        self.mask_mode = mask_mode
+        self.volume_cache = volume_cache
+        self.probabilities = probabilities
+
+    def __len__(self):
+        return len(self.data_list)
+
+    def load_image_tuple(self, image_tuple, probabilities: bool = False) -> np.ndarray:
+        '''
+        Loads the images of a tuple into an array of shape (num_images, x, y, z); as float32 if probabilities is set.
+        '''
+        if(self.mask_mode and not probabilities):
+            load = self.volume_cache.load_mask if self.volume_cache is not None else load_mask
+            return stack_views([load(image.path) for image in image_tuple])
+        return np.stack([nib.load(image.path).get_fdata(dtype=np.float32) for image in image_tuple])
+
+    def load_target(self, idx: int) -> tuple:
+        '''
+        Loads the ground truth of a subject. Returns (truth, truth_labels), where truth_labels is the precomputed
+        (labels, num_labels) of the subject, or None if it has to be labeled at scoring time.
+        '''
+        if(self.ground_truth_index is not None):
+            entry = load_subject([image.path for image in self.target_list[idx]], self.ground_truth_index)
+            if(entry is not None):
+                # The index stores the mask as 0/1 uint8, which can be viewed as bool directly
+                truth = entry.mask.view(np.bool_) if self.mask_mode else entry.mask.astype(np.float32)
+                return truth, (entry.labels, entry.num_lesions)
+        return self.load_image_tuple(self.target_list[idx]), None
+
+    def load_spacing(self, idx: int) -> tuple:
+        '''
+        Returns the voxel spacing of a subject along (x, y, z), from the header of its first ground truth image.
+        '''
+        return nib.load(self.target_list[idx][0].path).header.get_zooms()[:3]
+
+    def load_batches(self):
+        '''
+        Yields (data, target, target_labels, spacings) for up to batch_size samples. data and target are shaped
+        (batch, num_images, x, y, z); target_labels holds the precomputed labels of each sample (see load_target) and
+        spacings its voxel spacing (see load_spacing).
+        '''
+        for start_idx in range(0, len(self), self.batch_size):
+            end_idx = min(start_idx + self.batch_size, len(self))
+            data = stack_views([self.load_image_tuple(self.data_list[idx], probabilities=self.probabilities)
+                                for idx in range(start_idx, end_idx)])
+            targets, target_labels = zip(*[self.load_target(idx) for idx in range(start_idx, end_idx)])
+            spacings = [self.load_spacing(idx) for idx in range(start_idx, end_idx)]
+            yield data, stack_views(targets), target_labels, spacings
+
+
+# Dataset index and settings of the current worker process; set once by init_worker.
+_worker_state = {}
+
+
+def init_worker(data_list, target_list, eval_settings):
+    '''
+    Pool initializer. Receives the dataset index once per worker, instead of once per task.
+    '''
+    _worker_state['data_list'] = data_list
+    _worker_state['target_list'] = target_list
+    _worker_state['eval_settings'] = eval_settings
+
+
+def volume_cache_from_settings(settings: dict):
+    '''
+    Returns the VolumeCache configured by VolumeCachePath and VolumeCacheMaxBytes, or None if it is disabled.
+    '''
+    if(settings['VolumeCachePath'] is None):
+        return None
+    return VolumeCache(settings['VolumeCachePath'], settings['VolumeCacheMaxBytes'])
+
+
+def evaluate_subjects(subject_indices):
+    '''
+    Worker task: evaluates the subjects at subject_indices of the shared dataset index.
+    Parameters
+    ----------
+    subject_indices : list
+        Indices into the data_list/target_list given to init_worker.
     Returns
     -------
-    defaultdict
+    tuple
+        (subject_indices, scores, events, lesion_tables), with scores as returned by evaluate(), events the trace
+        events of the task if Profiling is enabled and lesion_tables the LesionTable of every subject if
+        LesionTableOutputPath is set, else None.
     '''
-    merged_dict = defaultdict(list)
-    for d in list_of_dicts:
-        for key, value in d.items():
-            merged_dict[key] += value
-    return merged_dict
+    settings = _worker_state['eval_settings']
+    lesion_tables = [] if settings['LesionTableOutputPath'] is not None else None
+    if(settings['SlabDepth'] is not None):
+        profiler = StageProfiler() if settings['Profiling'] else None
+        task_stage = profiler.stage('task', 'task', num_subjects=len(subject_indices)) if profiler else nullcontext()
+        with task_stage:
+            scores = evaluate_slabs([_worker_state['data_list'][idx] for idx in subject_indices],
+                                    [_worker_state['target_list'][idx] for idx in subject_indices],
+                                    settings['ScoringFunctions'], settings['SlabDepth'], lesion_tables=lesion_tables)
+        return subject_indices, scores, profiler.events if profiler is not None else None, lesion_tables
+    loader = SubjectLoader(data_list=[_worker_state['data_list'][idx] for idx in subject_indices],
+                           target_list=[_worker_state['target_list'][idx] for idx in subject_indices],
+                           batch_size=settings['LoaderBatchSize'],
+                           ground_truth_index=settings['GroundTruthIndexRoot'],
+                           mask_mode=settings['MaskMode'],
+                           volume_cache=volume_cache_from_settings(settings),
+                           probabilities=settings['SweepThresholds'] is not None)
+    if(not settings['Profiling']):
+        scores = evaluate(loader, settings['ScoringFunctions'], prefetch_depth=settings['PrefetchDepth'],
+                          thresholds=settings['SweepThresholds'], lesion_tables=lesion_tables)
+        return subject_indices, scores, None, lesion_tables
+    profiler = StageProfiler()
+    with profiler.stage('task', 'task', num_subjects=len(subject_indices)):
+        scores = evaluate(loader, settings['ScoringFunctions'], prefetch_depth=settings['PrefetchDepth'],
+                          profiler=profiler, thresholds=settings['SweepThresholds'], lesion_tables=lesion_tables)
+    return subject_indices, scores, profiler.events, lesion_tables
+
 
+def split_subject_scores(scores: dict, num_subjects: int) -> list:
+    '''
+    Splits the dict of score lists returned by evaluate() into one {score_name: score} dict per subject.
+    '''
+    return [{score_name: score_list[idx] for score_name, score_list in scores.items()} for idx in range(num_subjects)]
 
-def make_subloader_and_evaluate(data_list, data_shape, target_list, target_shape, eval_settings):
-    # We can't pass the BIDSLoader object directly, so we have to recreate it here. The sample BIDS dataset allows
-    # us to quickly initialize a BIDSLoader since the dataset is small.
-    local_loader = BIDSLoader(data_root=[eval_settings['PredictionRoot']], target_root=[eval_settings['GroundTruthRoot']],
-                              data_derivatives_names=eval_settings['PredictionBIDSDerivativeName'],
-                              target_derivatives_names=eval_settings['GroundTruthBIDSDerivativeName'],
-                              target_entities=eval_settings['GroundTruthEntities'],
-                              data_entities=eval_settings['PredictionEntities'])
 
-    # Copy relevant properties into this worker's BIDSLoader
-    local_loader.data_list = data_list
-    local_loader.target_list = target_list
-    local_loader.batch_size = eval_settings['LoaderBatchSize']
-    local_loader.data_shape = data_shape  # Needed since sample image is 1x1x1
-    local_loader.target_shape = target_shape  # Needed since sample image is 1x1x1
-    return evaluate(local_loader, eval_settings['ScoringFunctions'])
+def make_subject_chunks(data_list, chunk_size, subject_indices=None):
+    '''
+    Splits the subjects into tasks of at most chunk_size subjects. Subjects are ordered by decreasing prediction file
+    size, a cheap proxy for their scoring cost, so that the most expensive subjects are not left for the end of the run.
+    Parameters
+    ----------
+    data_list : list
+        List of image tuples, as in BIDSLoader.data_list.
+    chunk_size : int
+        Maximum number of subjects per task.
+    subject_indices : list
+        Optional. Indices of the subjects to schedule. Default: all subjects.
+    Returns
+    -------
+    list
+        List of lists of subject indices.
+    '''
+    if(subject_indices is None):
+        subject_indices = range(len(data_list))
+    file_sizes = {idx: sum(os.path.getsize(image.path) for image in data_list[idx]) for idx in subject_indices}
+    order = sorted(subject_indices, key=lambda idx: file_sizes[idx], reverse=True)
+    return [order[idx:idx+chunk_size] for idx in range(0, len(order), chunk_size)]
 
 
-if __name__ == "__main__":
-    # Create data_description.json
-    BIDSLoader.write_dataset_description(eval_settings['PredictionRoot'], eval_settings['PredictionBIDSDerivativeName'][0])
-    BIDSLoader.write_dataset_description(eval_settings['GroundTruthRoot'], eval_settings['GroundTruthBIDSDerivativeName'][0])
+def submission_output_path(path: str, name: str) -> str:
+    '''
+    Returns the output path of a submission in batch mode: path with _<name> before its extension.
+    '''
+    root, ext = os.path.splitext(path)
+    return f'{root}_{name}{ext}'
 
 
-    # Get data to pass to workers
-    loader = BIDSLoader(data_root=[eval_settings['PredictionRoot']], target_root=[eval_settings['GroundTruthRoot']],
+def index_submissions(prediction_roots: dict) -> tuple:
+    '''
+    Indexes every submission against the ground truth.
+    Parameters
+    ----------
+    prediction_roots : dict
+        {submission name: prediction root}.
+    Returns
+    -------
+    tuple
+        (target_list, data_lists): the ground truth image tuples of every subject predicted by at least one submission,
+        and {submission name: list of prediction image tuples aligned with target_list}, with None for the subjects
+        missing from a submission.
+    '''
+    target_list = []
+    subject_indices = {}
+    predictions = {}
+    for name, prediction_root in prediction_roots.items():
+        BIDSLoader.write_dataset_description(prediction_root, eval_settings['PredictionBIDSDerivativeName'][0])
+        loader = BIDSLoader(data_root=[prediction_root], target_root=[eval_settings['GroundTruthRoot']],
                             data_derivatives_names=eval_settings['PredictionBIDSDerivativeName'],
                             target_derivatives_names=eval_settings['GroundTruthBIDSDerivativeName'],
                             target_entities=eval_settings['GroundTruthEntities'],
                             data_entities=eval_settings['PredictionEntities'])
-    # Parallelize data
-    num_proc = eval_settings['Multiprocessing']
-    loader_idx_list = np.floor(np.linspace(0, len(loader), num_proc+1)).astype(int)
-    pool_arg_list = []
-    # Break up dataset into roughly equal portions
-    for idx in range(num_proc):
-        start_idx, end_idx = loader_idx_list[idx:idx+2]
-        data_list = loader.data_list[start_idx:end_idx]
-        target_list = loader.target_list[start_idx:end_idx]
-        pool_arg_list.append([data_list, loader.data_shape, target_list, loader.target_shape, eval_settings])
-
-    # Parallel stuff
-    pool = Pool(num_proc)
-    pool_scores = pool.starmap(make_subloader_and_evaluate, pool_arg_list)
-
-    # Combine scores into single dict
-    scores_dict = merge_dict(pool_scores)
-
-    # Aggregate scores together
-    score_summary = aggregate_scores(scores_dict, eval_settings["Aggregates"])
-
-    # Write out
-    f = open(eval_settings['MetricsOutputPath'], 'w')
-    json.dump(score_summary, f)
-    f.close()
+        predictions[name] = {}
+        for data_tuple, target_tuple in zip(loader.data_list, loader.target_list):
+            key = tuple(image.path for image in target_tuple)
+            if(key not in subject_indices):
+                subject_indices[key] = len(target_list)
+                target_list.append(target_tuple)
+            predictions[name][subject_indices[key]] = data_tuple
+    data_lists = {name: [submission.get(idx) for idx in range(len(target_list))]
+                  for name, submission in predictions.items()}
+    return target_list, data_lists
+
+
+def init_submissions_worker(target_list, data_lists, eval_settings):
+    '''
+    Pool initializer of the batch mode; see init_worker.
+    '''
+    _worker_state['target_list'] = target_list
+    _worker_state['data_lists'] = data_lists
+    _worker_state['eval_settings'] = eval_settings
+
+
+def load_submission_batches(loader: SubjectLoader, tasks: list, data_lists: dict, batch_size: int):
+    '''
+    Yields the batches of the batch mode, of up to batch_size subjects: (subject indices, truths, truth_labels,
+    spacings, predictions). The ground truth of every subject is loaded once (see SubjectLoader.load_target), and
+    predictions is {submission name: (positions in the batch, predictions)} for the submissions predicting the subjects.
+    '''
+    for start_idx in range(0, len(tasks), batch_size):
+        batch_tasks = tasks[start_idx:start_idx+batch_size]
+        subject_indices = [idx for idx, _ in batch_tasks]
+        truths, truth_labels = zip(*[loader.load_target(idx) for idx in subject_indices])
+        spacings = [loader.load_spacing(idx) for idx in subject_indices]
+        positions = defaultdict(list)
+        for position, (idx, names) in enumerate(batch_tasks):
+            for name in names:
+                positions[name].append(position)
+        predictions = {name: (name_positions,
+                              stack_views([loader.load_image_tuple(data_lists[name][subject_indices[position]],
+                                                                   probabilities=loader.probabilities)
+                                           for position in name_positions]))
+                       for name, name_positions in positions.items()}
+        yield subject_indices, truths, truth_labels, spacings, predictions
+
+
+def evaluate_subject_submissions(tasks):
+    '''
+    Worker task of the batch mode. The ground truth of each subject is loaded and labeled once, then the predictions of
+    every submission are scored against it, LoaderBatchSize subjects at a time.
+    Parameters
+    ----------
+    tasks : list
+        List of (subject index, submission names) into the target_list and data_lists given to
+        init_submissions_worker.
+    Returns
+    -------
+    tuple
+        (results, events): results is a list of (subject index, submission name, {score_name: score}, LesionTable),
+        the LesionTable being None unless LesionTableOutputPath is set, and events the trace events of the task if
+        Profiling is enabled, else None.
+    '''
+    settings = _worker_state['eval_settings']
+    data_lists = _worker_state['data_lists']
+    write_lesions = settings['LesionTableOutputPath'] is not None
+    profiler = StageProfiler() if settings['Profiling'] else None
+    results = []
+    with profiler.stage('task', 'task', num_subjects=len(tasks)) if profiler is not None else nullcontext():
+        if(settings['SlabDepth'] is not None):
+            for idx, names in tasks:
+                for name in names:
+                    lesion_tables = [] if write_lesions else None
+                    scores = evaluate_slabs([data_lists[name][idx]], [_worker_state['target_list'][idx]],
+                                            settings['ScoringFunctions'], settings['SlabDepth'],
+                                            lesion_tables=lesion_tables)
+                    results.append((idx, name, split_subject_scores(scores, 1)[0],
+                                    lesion_tables[0] if write_lesions else None))
+            return results, profiler.events if profiler is not None else None
+
+        loader = SubjectLoader(data_list=[], target_list=_worker_state['target_list'],
+                               ground_truth_index=settings['GroundTruthIndexRoot'],
+                               mask_mode=settings['MaskMode'],
+                               volume_cache=volume_cache_from_settings(settings),
+                               probabilities=settings['SweepThresholds'] is not None)
+        batches = load_submission_batches(loader, tasks, data_lists, settings['LoaderBatchSize'])
+        if(profiler is not None):
+            batches = profiler.iterate('load', batches)
+        for subject_indices, truths, truth_labels, spacings, predictions in prefetch(batches,
+                                                                                     settings['PrefetchDepth']):
+            # Labeled once, for every submission
+            truth_labels = [labels if labels is not None else label_mask(truth)
+                            for truth, labels in zip(truths, truth_labels)]
+            for name, (positions, prediction) in predictions.items():
+                if(profiler is not None):
+                    profiler.context = {'subjects': [subject_name(data_lists[name][subject_indices[position]])
+                                                     for position in positions],
+                                        'submission': name}
+                lesion_tables = [] if write_lesions else None
+                scores = score_samples(stack_views([truths[position] for position in positions]), prediction,
+                                       settings['ScoringFunctions'],
+                                       truth_labels=[truth_labels[position] for position in positions],
+                                       spacings=[spacings[position] for position in positions], profiler=profiler,
+                                       thresholds=settings['SweepThresholds'], lesion_tables=lesion_tables)
+                for sample_idx, sample_scores in enumerate(split_subject_scores(scores, len(positions))):
+                    results.append((subject_indices[positions[sample_idx]], name, sample_scores,
+                                    lesion_tables[sample_idx] if write_lesions else None))
+    return results, profiler.events if profiler is not None else None
+
+
+def evaluate_submissions(prediction_roots: dict, shard: tuple = None):
+    '''
+    Batch mode of evaluation.py: evaluates several submissions against the same ground truth, subject-major, so that
+    the ground truth is read and labeled once for all of them. Writes MetricsOutputPath, SubjectScoresOutputPath,
+    SweepOutputPath and LesionTableOutputPath once per submission (see submission_output_path), and a CSV table with
+    every aggregate of every metric per submission to ComparisonOutputPath.
+    Parameters
+    ----------
+    prediction_roots : dict or list
+        {submission name: prediction root}, or a list of prediction roots named after their last directory.
+    shard : tuple
+        Optional. (i, N): only the subjects of shard i of N are evaluated (see isles.sharding), and the partial results
+        of every submission are written to MetricsOutputPath instead of the summaries. Default: None.
+    '''
+    if(not isinstance(prediction_roots, dict)):
+        prediction_roots = {os.path.basename(os.path.normpath(root)): root for root in prediction_roots}
+    target_list, data_lists = index_submissions(prediction_roots)
+    warn_slab_skipped(eval_settings)
+    dataset_keys = [subject_key(subject_record(target_tuple, {})) for target_tuple in target_list]
+    shard_indices = set(range(len(target_list)) if shard is None else shard_subjects(dataset_keys, shard))
+
+    aggregators = {name: ScoreAggregator() for name in prediction_roots}
+    # Per-subject scores of every submission, kept for the bootstrap and the partial results of a shard
+    subject_scores = {name: {} for name in prediction_roots}
+    subject_records = {name: [] for name in prediction_roots}
+    subject_files = {}
+    if(eval_settings['SubjectScoresOutputPath'] is not None):
+        subject_files = {name: open(submission_output_path(eval_settings['SubjectScoresOutputPath'], name), 'w')
+                         for name in prediction_roots}
+    lesion_tables = {}
+    if(eval_settings['LesionTableOutputPath'] is not None):
+        lesion_tables = {name: open_lesion_table(submission_output_path(eval_settings['LesionTableOutputPath'], name))
+                         for name in prediction_roots}
+
+    def add_subject(idx, name, scores):
+        aggregators[name].update(scores)
+        if(eval_settings['BootstrapResamples'] is not None):
+            subject_scores[name][idx] = scores
+        if(shard is not None):
+            subject_records[name].append(subject_record(data_lists[name][idx], scores))
+        if(name in subject_files):
+            record = subject_record(data_lists[name][idx], scores)
+            subject_files[name].write(json.dumps(record, default=lambda value: value.item()) + '\n')
+            subject_files[name].flush()
+
+    # Submissions still to score for every subject, after the score cache
+    pending = defaultdict(list)
+    score_cache = None
+    cache_keys = {}
+    if(eval_settings['ScoreCachePath'] is not None):
+        score_cache = ScoreCache(eval_settings['ScoreCachePath'], eval_settings['ScoreCacheMaxBytes'])
+    for name, data_list in data_lists.items():
+        for idx, data_tuple in enumerate(data_list):
+            if(data_tuple is None or idx not in shard_indices):
+                continue
+            if(score_cache is not None):
+                cache_keys[idx, name] = score_cache_key(score_cache, data_tuple, target_list[idx], eval_settings)
+                # The lesion tables are not cached; every subject is scored again when they are written
+                cached_scores = score_cache.get(cache_keys[idx, name]) if not lesion_tables else None
+                if(cached_scores is not None):
+                    add_subject(idx, name, cached_scores)
+                    continue
+            pending[idx].append(name)
+
+    subject_chunks = make_subject_chunks(target_list, eval_settings['SchedulerChunkSize'], sorted(pending))
+    tasks = [[(idx, pending[idx]) for idx in chunk] for chunk in subject_chunks]
+    trace_events = []
+    start = time.perf_counter()
+    with Pool(eval_settings['Multiprocessing'], initializer=init_submissions_worker,
+              initargs=(target_list, data_lists, eval_settings)) as pool:
+        for results, events in tqdm(pool.imap_unordered(evaluate_subject_submissions, tasks), total=len(tasks),
+                                    desc='Evaluation', dynamic_ncols=True):
+            if(events is not None):
+                trace_events += events
+            for idx, name, scores, table in results:
+                add_subject(idx, name, scores)
+                if(table is not None):
+                    lesion_tables[name][1].writerows(lesion_table_rows(data_lists[name][idx], table))
+                if(score_cache is not None):
+                    score_cache.put(cache_keys[idx, name], scores)
+    if(score_cache is not None):
+        score_cache.close()
+    for subject_file in subject_files.values():
+        subject_file.close()
+    for lesion_file, _ in lesion_tables.values():
+        lesion_file.close()
+
+    timings = None
+    if(eval_settings['Profiling']):
+        timings = {'total_seconds': time.perf_counter() - start, **summarize_events(trace_events)}
+        if(eval_settings['TraceOutputPath'] is not None):
+            write_trace(trace_events, eval_settings['TraceOutputPath'])
+
+    if(shard is not None):
+        write_partial(eval_settings['MetricsOutputPath'], shard, dataset_keys,
+                      {name: (aggregators[name], subject_records[name]) for name in prediction_roots},
+                      eval_settings['ScoringFunctions'], eval_settings['SweepThresholds'], timings=timings)
+    else:
+        write_submission_metrics(aggregators, subject_scores, range(len(target_list)), eval_settings, timings=timings)
+
+
+def evaluate_predictions(shard: tuple = None):
+    '''
+    Evaluates the predictions in PredictionRoot against the ground truth. Writes the summary to MetricsOutputPath (see
+    write_metrics) and the per-subject scores to SubjectScoresOutputPath.
+    Parameters
+    ----------
+    shard : tuple
+        Optional. (i, N): only the subjects of shard i of N are evaluated (see isles.sharding), and the partial results
+        are written to MetricsOutputPath instead of the summary. Default: None.
+    '''
+    # Build the dataset index once; workers receive it through the pool initializer
+    loader = BIDSLoader(data_root=[eval_settings['PredictionRoot']], target_root=[eval_settings['GroundTruthRoot']],
+                        data_derivatives_names=eval_settings['PredictionBIDSDerivativeName'],
+                        target_derivatives_names=eval_settings['GroundTruthBIDSDerivativeName'],
+                        target_entities=eval_settings['GroundTruthEntities'],
+                        data_entities=eval_settings['PredictionEntities'])
+
+    warn_slab_skipped(eval_settings)
+    dataset_keys = [subject_key(subject_record(data_tuple, {})) for data_tuple in loader.data_list]
+    shard_indices = list(range(len(loader.data_list))) if shard is None else shard_subjects(dataset_keys, shard)
+
+    # Scores are aggregated as they arrive; per-subject records are streamed to SubjectScoresOutputPath
+    aggregator = ScoreAggregator()
+    subject_file = None
+    if(eval_settings['SubjectScoresOutputPath'] is not None):
+        subject_file = open(eval_settings['SubjectScoresOutputPath'], 'w')
+    lesion_file = None
+    if(eval_settings['LesionTableOutputPath'] is not None):
+        lesion_file, lesion_writer = open_lesion_table(eval_settings['LesionTableOutputPath'])
+
+    # Per-subject scores, kept for the bootstrap and the partial results of a shard
+    subject_scores = {}
+    subject_records = []
+
+    def add_subject(idx, scores):
+        aggregator.update(scores)
+        if(eval_settings['BootstrapResamples'] is not None):
+            subject_scores[dataset_keys[idx]] = scores
+        if(shard is not None):
+            subject_records.append(subject_record(loader.data_list[idx], scores))
+        if(subject_file is not None):
+            record = subject_record(loader.data_list[idx], scores)
+            subject_file.write(json.dumps(record, default=lambda value: value.item()) + '\n')
+            subject_file.flush()
+
+    # Reuse the scores of subjects whose prediction, ground truth and scoring functions are unchanged
+    pending_indices = shard_indices
+    score_cache = None
+    if(eval_settings['ScoreCachePath'] is not None):
+        score_cache = ScoreCache(eval_settings['ScoreCachePath'], eval_settings['ScoreCacheMaxBytes'])
+        cache_keys = {idx: score_cache_key(score_cache, loader.data_list[idx], loader.target_list[idx], eval_settings)
+                      for idx in shard_indices}
+        pending_indices = []
+        for idx, key in cache_keys.items():
+            # The lesion tables are not cached; every subject is scored again when they are written
+            cached_scores = score_cache.get(key) if lesion_file is None else None
+            if(cached_scores is None):
+                pending_indices.append(idx)
+            else:
+                add_subject(idx, cached_scores)
+
+    # Small tasks are handed out as workers become free, so one slow subject only delays its own task
+    subject_chunks = make_subject_chunks(loader.data_list, eval_settings['SchedulerChunkSize'], pending_indices)
+    trace_events = []
+    start = time.perf_counter()
+    with Pool(eval_settings['Multiprocessing'], initializer=init_worker,
+              initargs=(loader.data_list, loader.target_list, eval_settings)) as pool:
+        results = pool.imap_unordered(evaluate_subjects, subject_chunks)
+        for subject_indices, chunk_scores, events, lesion_tables in tqdm(results, total=len(subject_chunks),
+                                                                          desc='Evaluation', dynamic_ncols=True):
+            if(events is not None):
+                trace_events += events
+            if(lesion_tables is not None):
+                for idx, table in zip(subject_indices, lesion_tables):
+                    lesion_writer.writerows(lesion_table_rows(loader.data_list[idx], table))
+            for idx, scores in zip(subject_indices, split_subject_scores(chunk_scores, len(subject_indices))):
+                add_subject(idx, scores)
+                if(score_cache is not None):
+                    score_cache.put(cache_keys[idx], scores)
+    if(score_cache is not None):
+        score_cache.close()
+    if(subject_file is not None):
+        subject_file.close()
+    if(lesion_file is not None):
+        lesion_file.close()
+
+    timings = None
+    if(eval_settings['Profiling']):
+        timings = {'total_seconds': time.perf_counter() - start, **summarize_events(trace_events)}
+        if(eval_settings['TraceOutputPath'] is not None):
+            write_trace(trace_events, eval_settings['TraceOutputPath'])
+
+    # Aggregate scores together and write out; a shard writes its partial results for merge_shards.py instead
+    if(shard is not None):
+        write_partial(eval_settings['MetricsOutputPath'], shard, dataset_keys, {None: (aggregator, subject_records)},
+                      eval_settings['ScoringFunctions'], eval_settings['SweepThresholds'], timings=timings)
+    else:
+        write_metrics(aggregator, subject_scores, eval_settings, timings=timings)
+
+
+def main():
+    '''
+    Command line entry point: evaluates PredictionRoot, or every submission of PredictionRoots in batch mode, as
+    configured in settings.py.
+    '''
+    parser = argparse.ArgumentParser(description='Evaluates the predictions against the ground truth, as configured in '
+                                                 'settings.py.')
+    parser.add_argument('--shard', type=parse_shard, default=None,
+                        help='Evaluate only shard i of N, given as i/N, and write its partial results to '
+                             'MetricsOutputPath (with a _shard<i>of<N> suffix); combine the shards with '
+                             'merge_shards.py.')
+    shard = parser.parse_args().shard
+    if(shard is not None):
+        # Shards may run side by side on one host, so each one writes its own files
+        for path_setting in ('MetricsOutputPath', 'SubjectScoresOutputPath', 'LesionTableOutputPath',
+                             'TraceOutputPath'):
+            if(eval_settings[path_setting] is not None):
+                eval_settings[path_setting] = submission_output_path(eval_settings[path_setting],
+                                                                     f'shard{shard[0]}of{shard[1]}')
+
+    # Create data_description.json
+    BIDSLoader.write_dataset_description(eval_settings['GroundTruthRoot'],
+                                         eval_settings['GroundTruthBIDSDerivativeName'][0])
+    if(eval_settings['PredictionRoots'] is not None):
+        # Batch mode: several submissions against the same ground truth
+        evaluate_submissions(eval_settings['PredictionRoots'], shard=shard)
+    else:
+        BIDSLoader.write_dataset_description(eval_settings['PredictionRoot'],
+                                             eval_settings['PredictionBIDSDerivativeName'][0])
+        evaluate_predictions(shard=shard)
+
+
+if __name__ == "__main__":
+    main()
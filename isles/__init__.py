@@ -1,3 +1,14 @@
 from . import scoring
+from . import masks
+from . import ground_truth
+from . import score_cache
+from . import aggregation
+from . import synthetic
+from . import profiling
+from . import bids_layout
+from . import fusion
+from . import integrity
+from . import slabs
+from . import sharding
 
-__all__ = ['scoring']
\ No newline at end of file
+__all__ = ['scoring', 'masks', 'ground_truth', 'score_cache', 'aggregation', 'synthetic', 'profiling', 'bids_layout', 'fusion', 'integrity', 'slabs', 'sharding']
\ No newline at end of file
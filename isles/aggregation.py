@@ -0,0 +1,385 @@
+import math, warnings, numpy as np
+from collections import defaultdict
+
+# Order in which the summary statistics are reported, matching pandas.Series.describe(); percentiles go before 'max'.
+_SUMMARY_ORDER = ['count', 'mean', 'std', 'min']
+
+
+class QuantileSketch:
+    '''
+    Mergeable quantile sketch with bounded relative error (DDSketch). Values are counted in logarithmically spaced
+    buckets, so every quantile is returned within relative_accuracy of the exact value, and two sketches are merged by
+    adding their bucket counts. Memory depends on the range of the values only, not on their number.
+    Parameters
+    ----------
+    relative_accuracy : float
+        Optional. Maximum relative error of the returned quantiles. Default: 0.001.
+    '''
+    def __init__(self, relative_accuracy=0.001):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.positive = defaultdict(int)
+        self.negative = defaultdict(int)
+        self.zero_count = 0
+        self.count = 0
+
+    def _bucket(self, magnitude):
+        return math.ceil(math.log(magnitude) / self.log_gamma)
+
+    def _bucket_value(self, bucket):
+        return 2 * self.gamma**bucket / (self.gamma + 1)
+
+    def add(self, value):
+        if(value > 0):
+            self.positive[self._bucket(value)] += 1
+        elif(value < 0):
+            self.negative[self._bucket(-value)] += 1
+        else:
+            self.zero_count += 1
+        self.count += 1
+
+    def merge(self, other):
+        for bucket, count in other.positive.items():
+            self.positive[bucket] += count
+        for bucket, count in other.negative.items():
+            self.negative[bucket] += count
+        self.zero_count += other.zero_count
+        self.count += other.count
+
+    def quantile(self, q):
+        '''
+        Returns the q-quantile (0 <= q <= 1) of the values added so far, or NaN if there are none.
+        '''
+        if(self.count == 0):
+            return math.nan
+        rank = q * (self.count - 1)
+        seen = 0
+        for bucket in sorted(self.negative, reverse=True):
+            seen += self.negative[bucket]
+            if(seen > rank):
+                return -self._bucket_value(bucket)
+        seen += self.zero_count
+        if(seen > rank):
+            return 0.0
+        for bucket in sorted(self.positive):
+            seen += self.positive[bucket]
+            if(seen > rank):
+                return self._bucket_value(bucket)
+        return self._bucket_value(max(self.positive))
+
+    def to_dict(self):
+        return {'relative_accuracy': self.relative_accuracy,
+                'positive': {str(bucket): count for bucket, count in self.positive.items()},
+                'negative': {str(bucket): count for bucket, count in self.negative.items()},
+                'zero_count': self.zero_count,
+                'count': self.count}
+
+    @classmethod
+    def from_dict(cls, state):
+        sketch = cls(state['relative_accuracy'])
+        sketch.positive.update({int(bucket): count for bucket, count in state['positive'].items()})
+        sketch.negative.update({int(bucket): count for bucket, count in state['negative'].items()})
+        sketch.zero_count = state['zero_count']
+        sketch.count = state['count']
+        return sketch
+
+
+class OnlineStatistics:
+    '''
+    Streaming summary statistics of a single metric. Count, mean and standard deviation are updated with Welford's
+    algorithm and merged with Chan's parallel formula; min and max are exact. While at most exact_limit values have
+    been seen, the values are kept: quantiles are then exact (linearly interpolated, as in pandas.Series.describe) and
+    the reported mean and standard deviation are computed from the values with correctly rounded sums, so that they do
+    not depend on the order in which the values arrived or were merged. Afterwards, quantiles are read from a
+    QuantileSketch. NaN values are ignored, as in pandas.
+    Parameters
+    ----------
+    exact_limit : int
+        Optional. Number of values kept for exact quantiles. Default: 10000.
+    relative_accuracy : float
+        Optional. Relative accuracy of the quantile sketch. Default: 0.001.
+    '''
+    def __init__(self, exact_limit=10000, relative_accuracy=0.001):
+        self.exact_limit = exact_limit
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.values = []
+        self.sketch = QuantileSketch(relative_accuracy)
+
+    def update(self, value):
+        value = float(value)
+        if(math.isnan(value)):
+            return
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        self.sketch.add(value)
+        if(self.values is not None):
+            self.values.append(value)
+            if(len(self.values) > self.exact_limit):
+                self.values = None
+
+    def merge(self, other):
+        '''
+        Merges the statistics of other into this object, as if all of its values had been passed to update().
+        '''
+        if(other.count == 0):
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta**2 * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.sketch.merge(other.sketch)
+        if(self.values is not None and other.values is not None and count <= self.exact_limit):
+            self.values += other.values
+        else:
+            self.values = None
+
+    @property
+    def std(self):
+        # Sample standard deviation, as in pandas
+        if(self.count < 2):
+            return math.nan
+        return math.sqrt(self.m2 / (self.count - 1))
+
+    def quantile(self, q):
+        if(self.values is not None):
+            return float(np.quantile(self.values, q)) if self.values else math.nan
+        return self.sketch.quantile(q)
+
+    def summary(self, aggregates):
+        '''
+        Returns the requested statistics as a dict. Valid aggregates are 'count', 'mean', 'std', 'min', 'max' and
+        percentiles such as '25%'; other names are ignored.
+        '''
+        percentiles = sorted((name for name in aggregates if name.endswith('%')), key=lambda name: float(name[:-1]))
+        mean, std = (self.mean if self.count else math.nan), self.std
+        if(self.values is not None and self.count):
+            # math.fsum is exact before its final rounding, so the result is the same in any order of the values
+            mean = math.fsum(self.values) / self.count
+            if(self.count > 1):
+                std = math.sqrt(math.fsum((value - mean)**2 for value in self.values) / (self.count - 1))
+        statistics = {'count': float(self.count),
+                      'mean': mean,
+                      'std': std,
+                      'min': self.min if self.count else math.nan,
+                      'max': self.max if self.count else math.nan}
+        summary = {}
+        for name in _SUMMARY_ORDER + percentiles + ['max']:
+            if(name not in aggregates):
+                continue
+            summary[name] = self.quantile(float(name[:-1]) / 100) if name.endswith('%') else statistics[name]
+        return summary
+
+    def to_dict(self):
+        return {'exact_limit': self.exact_limit, 'count': self.count, 'mean': self.mean, 'm2': self.m2,
+                'min': self.min, 'max': self.max, 'values': self.values, 'sketch': self.sketch.to_dict()}
+
+    @classmethod
+    def from_dict(cls, state):
+        statistics = cls(state['exact_limit'])
+        statistics.count = state['count']
+        statistics.mean = state['mean']
+        statistics.m2 = state['m2']
+        statistics.min = state['min']
+        statistics.max = state['max']
+        statistics.values = state['values']
+        statistics.sketch = QuantileSketch.from_dict(state['sketch'])
+        return statistics
+
+
+class ScoreAggregator:
+    '''
+    Streaming aggregation of per-subject scores: one OnlineStatistics per metric, updated as each subject result
+    arrives. Partial aggregators (e.g. from different workers) are combined with merge(), whose cost does not depend
+    on the number of subjects.
+    '''
+    def __init__(self, **statistics_kwargs):
+        self.statistics_kwargs = statistics_kwargs
+        self.statistics = {}
+
+    def update(self, subject_scores: dict):
+        '''
+        Adds the {score_name: score} of a subject.
+        '''
+        for score_name, score in subject_scores.items():
+            if(score_name not in self.statistics):
+                self.statistics[score_name] = OnlineStatistics(**self.statistics_kwargs)
+            self.statistics[score_name].update(score)
+
+    def merge(self, other):
+        for score_name, statistics in other.statistics.items():
+            if(score_name not in self.statistics):
+                self.statistics[score_name] = OnlineStatistics(**self.statistics_kwargs)
+            self.statistics[score_name].merge(statistics)
+
+    def summary(self, aggregates):
+        '''
+        Returns {score_name: {aggregate: value}} for the requested aggregates; see OnlineStatistics.summary.
+        '''
+        return {score_name: statistics.summary(aggregates) for score_name, statistics in self.statistics.items()}
+
+    def to_dict(self):
+        return {score_name: statistics.to_dict() for score_name, statistics in self.statistics.items()}
+
+    @classmethod
+    def from_dict(cls, state):
+        aggregator = cls()
+        aggregator.statistics = {score_name: OnlineStatistics.from_dict(statistics)
+                                 for score_name, statistics in state.items()}
+        return aggregator
+
+
+def bootstrap_weights(num_subjects, num_resamples=10000, seed=0):
+    '''
+    Draws num_resamples bootstrap resamples of the subjects at once, as a (resamples x subjects) index matrix from a
+    seeded generator, and returns it as the matrix of the number of times each subject is drawn in each resample. The
+    mean of every resample is then a single matrix product with the per-subject scores (see bootstrap_means).
+    Parameters
+    ----------
+    num_subjects : int
+        Number of subjects.
+    num_resamples : int
+        Optional. Number of resamples. Default: 10000.
+    seed : int
+        Optional. Seed of the resampling; the same seed draws the same resamples. Default: 0.
+    Returns
+    -------
+    np.array
+        float64 array of shape (num_resamples, num_subjects).
+    '''
+    draws = np.random.default_rng(seed).integers(0, num_subjects, size=(num_resamples, num_subjects))
+    draws += np.arange(num_resamples)[:, np.newaxis] * num_subjects
+    counts = np.bincount(draws.ravel(), minlength=num_resamples * num_subjects)
+    return counts.reshape(num_resamples, num_subjects).astype(np.float64)
+
+
+def bootstrap_means(scores, weights):
+    '''
+    Returns the mean of every metric in every resample, as an array of shape (resamples, metrics). scores is a
+    (subjects, metrics) array; NaN scores are ignored, as in OnlineStatistics.
+    '''
+    scores = np.asarray(scores, dtype=np.float64)
+    valid = ~np.isnan(scores)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (weights @ np.where(valid, scores, 0.0)) / (weights @ valid)
+
+
+def _score_matrix(scores, score_names):
+    return np.column_stack([np.asarray(scores[name], dtype=np.float64) for name in score_names])
+
+
+def _interval(resampled, confidence):
+    # Metrics without any score have NaN means in every resample, and NaN bounds
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanquantile(resampled, [(1 - confidence) / 2, (1 + confidence) / 2], axis=0)
+
+
+def bootstrap_mean_intervals(scores, num_resamples=10000, seed=0, confidence=0.95):
+    '''
+    Percentile bootstrap confidence intervals of the mean of every metric.
+    Parameters
+    ----------
+    scores : dict
+        {score_name: per-subject scores}, every list in the same subject order.
+    num_resamples, seed
+        Optional. See bootstrap_weights.
+    confidence : float
+        Optional. Confidence level of the intervals. Default: 0.95.
+    Returns
+    -------
+    dict
+        {score_name: {'mean_ci_low': value, 'mean_ci_high': value}}.
+    '''
+    score_names = list(scores)
+    if(not score_names):
+        return {}
+    matrix = _score_matrix(scores, score_names)
+    low, high = _interval(bootstrap_means(matrix, bootstrap_weights(matrix.shape[0], num_resamples, seed)), confidence)
+    return {name: {'mean_ci_low': float(low[idx]), 'mean_ci_high': float(high[idx])}
+            for idx, name in enumerate(score_names)}
+
+
+def bootstrap_paired_comparison(scores, reference_scores, num_resamples=10000, seed=0, confidence=0.95):
+    '''
+    Subject-paired bootstrap comparison of two sets of scores of the same subjects: the per-subject differences
+    (scores - reference_scores) are resampled, so that the variability shared by both through the subjects cancels.
+    Parameters
+    ----------
+    scores, reference_scores : dict
+        {score_name: per-subject scores}, both in the same subject order. Only the score names present in both are
+        compared; subjects with a NaN score in either are ignored for that metric.
+    num_resamples, seed, confidence
+        Optional. See bootstrap_mean_intervals.
+    Returns
+    -------
+    dict
+        {score_name: {'mean_difference', 'ci_low', 'ci_high', 'probability_greater'}}, where probability_greater is the
+        fraction of resamples in which the mean difference is positive.
+    '''
+    score_names = [name for name in scores if name in reference_scores]
+    if(not score_names):
+        return {}
+    differences = _score_matrix(scores, score_names) - _score_matrix(reference_scores, score_names)
+    resampled = bootstrap_means(differences, bootstrap_weights(differences.shape[0], num_resamples, seed))
+    low, high = _interval(resampled, confidence)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        mean_difference = np.nanmean(differences, axis=0)
+    probability_greater = np.mean(resampled > 0, axis=0)
+    return {name: {'mean_difference': float(mean_difference[idx]), 'ci_low': float(low[idx]),
+                   'ci_high': float(high[idx]), 'probability_greater': float(probability_greater[idx])}
+            for idx, name in enumerate(score_names)}
+
+
+def bootstrap_ranks(submission_scores, num_resamples=10000, seed=0, lower_is_better=()):
+    '''
+    Ranking stability of several submissions scored on the same subjects: every submission is ranked by its mean in
+    each resample, all submissions being resampled with the same subjects. Rank 1 is the best mean: the highest, or the
+    lowest for the metrics in lower_is_better. Ties are broken by the order of the submissions.
+    Parameters
+    ----------
+    submission_scores : dict
+        {submission name: {score_name: per-subject scores}}, every list in the same subject order. NaN marks the
+        subjects missing from a submission.
+    num_resamples, seed
+        Optional. See bootstrap_weights.
+    lower_is_better : collection
+        Optional. Score names for which lower values are better, e.g. distances and count differences. Default: ().
+    Returns
+    -------
+    dict
+        {score_name: {submission name: {'mean_rank', 'rank_1_frequency'}}}, for the score names of every submission.
+    '''
+    names = list(submission_scores)
+    if(not names):
+        return {}
+    score_names = [score_name for score_name in submission_scores[names[0]]
+                   if all(score_name in scores for scores in submission_scores.values())]
+    if(not score_names):
+        return {}
+    matrices = [_score_matrix(submission_scores[name], score_names) for name in names]
+    weights = bootstrap_weights(matrices[0].shape[0], num_resamples, seed)
+    # (submissions, resamples, metrics); NaN means rank last
+    resampled = np.stack([bootstrap_means(matrix, weights) for matrix in matrices])
+    sign = np.array([1 if score_name in lower_is_better else -1 for score_name in score_names])
+    order = np.argsort(np.where(np.isnan(resampled), np.inf, sign * resampled), axis=0, kind='stable')
+    ranks = np.empty_like(order)
+    np.put_along_axis(ranks, order, np.arange(1, len(names) + 1)[:, np.newaxis, np.newaxis], axis=0)
+    mean_rank = ranks.mean(axis=1)
+    rank_1_frequency = (ranks == 1).mean(axis=1)
+    return {score_name: {name: {'mean_rank': float(mean_rank[idx_name, idx]),
+                                'rank_1_frequency': float(rank_1_frequency[idx_name, idx])}
+                         for idx_name, name in enumerate(names)}
+            for idx, score_name in enumerate(score_names)}
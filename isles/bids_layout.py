@@ -0,0 +1,23 @@
+from os.path import join, basename
+
+# File name suffix of the converted predictions, after sub-<subject>_ses-1_
+PREDICTION_SUFFIX = 'space-MNI152NLin2009aSym_label_L_desc-T1lesion_mask.nii.gz'
+
+
+def prediction_bids_path(dst_dir: str, path: str) -> str:
+    '''
+    Returns the path of a model prediction in the BIDS layout of the submission, e.g. sub-r001s002_ses-1.nii.gz is
+    mapped to dst_dir/sub-r001s002/ses-1/anat/sub-r001s002_ses-1_<PREDICTION_SUFFIX>. The subject is read from the
+    characters 3:6 and 7:10 of the file name, as written by nnU-Net for the ATLAS test set.
+    Parameters
+    ----------
+    dst_dir : str
+        Root of the BIDS tree.
+    path : str
+        Path or file name of the prediction.
+    Returns
+    -------
+    str
+    '''
+    subject = 'sub-r' + basename(path)[3:6] + 's' + basename(path)[7:10]
+    return join(dst_dir, subject, 'ses-1', 'anat', f'{subject}_ses-1_{PREDICTION_SUFFIX}')
@@ -0,0 +1,106 @@
+import os, numpy as np, nibabel as nib
+from .masks import load_mask
+
+# Fusion rules; see fuse_masks.
+FUSION_RULES = ('union', 'intersection', 'majority', 'vote', 'mean')
+
+
+def fuse_masks(images, rule='union', votes=None, weights=None, threshold=0.5):
+    '''
+    Fuses the predictions of several models for one subject. The images are consumed one at a time and accumulated
+    into a single vote count (or weighted sum), so only one input is held in memory besides the accumulator.
+    Parameters
+    ----------
+    images : iterable
+        Arrays of identical shape, one per model. Boolean masks for the voting rules; probabilities (or masks) for
+        'mean'.
+    rule : str
+        Optional. One of FUSION_RULES. 'union' and 'intersection' keep the voxels predicted by at least one and by all
+        models, 'majority' those predicted by more than half of the models, 'vote' those predicted by at least votes
+        models, and 'mean' those whose weighted mean probability is >= threshold. Default: 'union'.
+    votes : int
+        Number of models that must agree for rule='vote'.
+    weights : sequence
+        Optional. Weight of each model for rule='mean'. Default: equal weights.
+    threshold : float
+        Optional. Threshold on the weighted mean probability for rule='mean'. Default: 0.5.
+    Returns
+    -------
+    np.array
+        Boolean fused mask.
+    '''
+    if(rule not in FUSION_RULES):
+        raise ValueError(f'Unknown fusion rule {rule}; expected one of {FUSION_RULES}.')
+    if(rule == 'vote' and votes is None):
+        raise ValueError("rule='vote' requires the number of votes.")
+
+    accumulator = None
+    num_images = 0
+    total_weight = 0.0
+    for idx, image in enumerate(images):
+        if(rule == 'mean'):
+            weight = 1.0 if weights is None else weights[idx]
+            contribution = np.asarray(image, dtype=np.float32) * np.float32(weight)
+            total_weight += weight
+        else:
+            # uint16 so that the count cannot overflow for any realistic number of models
+            contribution = np.asarray(image, dtype=bool).astype(np.uint16)
+        if(accumulator is None):
+            accumulator = contribution
+        elif(accumulator.shape != contribution.shape):
+            raise ValueError(f'Shape mismatch between fused images: {accumulator.shape} and {contribution.shape}.')
+        else:
+            accumulator += contribution
+        num_images += 1
+    if(accumulator is None):
+        raise ValueError('No images to fuse.')
+
+    if(rule == 'union'):
+        return accumulator >= 1
+    if(rule == 'intersection'):
+        return accumulator == num_images
+    if(rule == 'majority'):
+        return 2 * accumulator > num_images
+    if(rule == 'vote'):
+        return accumulator >= votes
+    return accumulator >= threshold * total_weight
+
+
+def fuse_files(paths, dst_path, rule='union', votes=None, weights=None, threshold=0.5, volume_cache=None):
+    '''
+    Reads the prediction of every model for one subject once, fuses them with fuse_masks and writes the result as a
+    uint8 NIfTI file with the header of the first prediction.
+    Parameters
+    ----------
+    paths : sequence
+        Paths to the predictions of the subject, one per model.
+    dst_path : str
+        Path of the fused prediction.
+    rule, votes, weights, threshold
+        See fuse_masks.
+    volume_cache : isles.masks.VolumeCache
+        Optional. Cache from which the masks of the voting rules are memory-mapped instead of decoded. Default: None.
+    Returns
+    -------
+    str
+        dst_path.
+    '''
+    reference = nib.load(paths[0])
+
+    def images():
+        for path in paths:
+            image = reference if path == paths[0] else nib.load(path)
+            if(not np.allclose(image.affine, reference.affine)):
+                raise ValueError(f'Affine of {path} does not match {paths[0]}.')
+            # Binary rules read the masks without promotion to float; 'mean' needs the probabilities
+            if(rule == 'mean'):
+                yield image.get_fdata(dtype=np.float32)
+            else:
+                yield volume_cache.load_mask(path) if volume_cache is not None else load_mask(image)
+
+    fused = fuse_masks(images(), rule=rule, votes=votes, weights=weights, threshold=threshold)
+    os.makedirs(os.path.dirname(dst_path) or '.', exist_ok=True)
+    image = nib.Nifti1Image(fused.astype(np.uint8), reference.affine, reference.header)
+    image.set_data_dtype(np.uint8)
+    image.to_filename(dst_path)
+    return dst_path
@@ -0,0 +1,111 @@
+import os, json, numpy as np, scipy.ndimage
+from collections import namedtuple
+from os.path import join, basename
+from .scoring import label_mask
+from .masks import load_mask
+
+# Bump whenever the on-disk layout or the labeling changes; older entries are then treated as missing.
+INDEX_VERSION = 2
+
+# Precomputed ground truth of a subject. mask and labels are memory-mapped arrays of shape (num_images, x, y, z).
+GroundTruthEntry = namedtuple('GroundTruthEntry', ['mask', 'labels', 'num_lesions', 'lesion_voxels', 'lesion_bboxes',
+                                                   'total_volume'])
+
+
+def subject_key(image_paths):
+    '''
+    Returns the name of the index entry of a subject: the file name of its first image, without extension.
+    Parameters
+    ----------
+    image_paths : sequence
+        Paths to the ground truth images of the subject.
+    Returns
+    -------
+    str
+    '''
+    name = basename(image_paths[0])
+    for ext in ('.nii.gz', '.nii'):
+        if(name.endswith(ext)):
+            return name[:-len(ext)]
+    return name
+
+
+def _source_stats(image_paths):
+    # Used to detect ground truth files that changed after the index was compiled
+    return [{'name': basename(path), 'size': os.stat(path).st_size, 'mtime_ns': os.stat(path).st_mtime_ns}
+            for path in image_paths]
+
+
+def load_subject(image_paths, index_root):
+    '''
+    Loads the index entry of a subject. Returns None if the subject was not compiled, or if its ground truth files
+    changed since it was compiled.
+    Parameters
+    ----------
+    image_paths : sequence
+        Paths to the ground truth images of the subject.
+    index_root : str
+        Root directory of the index.
+    Returns
+    -------
+    GroundTruthEntry or None
+    '''
+    entry_dir = join(index_root, subject_key(image_paths))
+    try:
+        with open(join(entry_dir, 'index.json')) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return None
+    if(meta['version'] != INDEX_VERSION or meta['sources'] != _source_stats(image_paths)):
+        return None
+    return GroundTruthEntry(mask=np.load(join(entry_dir, 'mask.npy'), mmap_mode='r'),
+                            labels=np.load(join(entry_dir, 'labels.npy'), mmap_mode='r'),
+                            num_lesions=meta['num_lesions'],
+                            lesion_voxels=meta['lesion_voxels'],
+                            lesion_bboxes=meta['lesion_bboxes'],
+                            total_volume=meta['total_volume'])
+
+
+def compile_subject(image_paths, index_root, overwrite=False):
+    '''
+    Writes the index entry of a subject: the uncompressed binary mask and its connected-component labels as .npy files
+    (memory-mappable), and an index.json with the per-lesion voxel counts and bounding boxes and the total volume.
+    The images are stacked as (num_images, x, y, z), matching the samples produced by the loaders.
+    Parameters
+    ----------
+    image_paths : sequence
+        Paths to the ground truth images of the subject.
+    index_root : str
+        Root directory of the index.
+    overwrite : bool
+        Optional. Recompile the subject even if its entry is up to date. Default: False.
+    Returns
+    -------
+    str
+        Name of the index entry.
+    '''
+    key = subject_key(image_paths)
+    if(not overwrite and load_subject(image_paths, index_root) is not None):
+        return key
+
+    mask = np.stack([load_mask(path) for path in image_paths])
+    labels, num_lesions = label_mask(mask)
+    lesion_voxels = np.bincount(labels.ravel(), minlength=num_lesions + 1)[1:]
+    lesion_bboxes = [[s.start for s in bbox] + [s.stop for s in bbox] for bbox in scipy.ndimage.find_objects(labels)]
+
+    entry_dir = join(index_root, key)
+    os.makedirs(entry_dir, exist_ok=True)
+    np.save(join(entry_dir, 'mask.npy'), (labels > 0).astype(np.uint8))
+    np.save(join(entry_dir, 'labels.npy'), labels.astype(np.min_scalar_type(num_lesions)))
+    meta = {'version': INDEX_VERSION,
+            'sources': _source_stats(image_paths),
+            'shape': list(labels.shape),
+            'num_lesions': int(num_lesions),
+            'lesion_voxels': lesion_voxels.tolist(),
+            'lesion_bboxes': lesion_bboxes,
+            'total_volume': int(lesion_voxels.sum())}
+    # index.json is written last and atomically, so an interrupted compilation never leaves a valid-looking entry
+    with open(join(entry_dir, 'index.json.tmp'), 'w') as f:
+        json.dump(meta, f)
+    os.replace(join(entry_dir, 'index.json.tmp'), join(entry_dir, 'index.json'))
+    return key
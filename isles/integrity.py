@@ -0,0 +1,141 @@
+import gzip, zlib, numpy as np, nibabel as nib
+from functools import partial
+from multiprocessing import Pool
+from nibabel.spatialimages import HeaderDataError
+
+# Size of the chunks in which the voxel data is decompressed and counted
+CHUNK_BYTES = 16 * 1024**2
+# Labels above this value are counted with np.unique instead of np.bincount, which allocates one bin per value
+_MAX_BINCOUNT_LABEL = 2**16
+
+
+def _open(path):
+    return gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+
+
+def _read_header(stream):
+    # NIfTI-1 and NIfTI-2 are told apart by sizeof_hdr (348 or 540), in either byte order
+    sizeof_hdr = stream.read(4)
+    stream.seek(0)
+    header_class = nib.Nifti2Header if sizeof_hdr in (b'\x1c\x02\x00\x00', b'\x00\x00\x02\x1c') else nib.Nifti1Header
+    return header_class.from_fileobj(stream)
+
+
+def _count_labels(chunk, counts):
+    '''
+    Adds the number of voxels of every value of the integer array chunk to the dict counts.
+    '''
+    if(chunk.size == 0):
+        return
+    if(chunk.min() < 0 or chunk.max() > _MAX_BINCOUNT_LABEL):
+        values, value_counts = np.unique(chunk, return_counts=True)
+    else:
+        # np.bincount refuses uint64, which cannot be cast to intp safely; these values fit
+        value_counts = np.bincount(chunk.ravel().astype(np.int64, copy=False) if chunk.dtype == np.uint64
+                                   else chunk.ravel())
+        values = np.flatnonzero(value_counts)
+        value_counts = value_counts[values]
+    for value, count in zip(values.tolist(), value_counts.tolist()):
+        counts[value] = counts.get(value, 0) + count
+
+
+def check_file(path, reference_shape=None, reference_affine=None, labels=(0, 1), require_all_labels=False):
+    '''
+    Checks a NIfTI mask in a single streaming pass over the file: the header is parsed from the decompressed stream,
+    the voxel data is decoded in chunks of CHUNK_BYTES and counted per label with np.bincount in its stored integer
+    type, and the stream is read to the end so that gzip verifies the CRC and length of the file. The data is never
+    held in memory as a whole, nor promoted to floating point.
+    Parameters
+    ----------
+    path : str
+        Path to the .nii or .nii.gz file.
+    reference_shape : tuple
+        Optional. Expected shape of the image, e.g. that of a ground truth image. Default: not checked.
+    reference_affine : np.array
+        Optional. Expected affine of the image. Default: not checked.
+    labels : sequence
+        Optional. Allowed voxel values. Default: (0, 1).
+    require_all_labels : bool
+        Optional. Also report images in which one of the labels does not occur, e.g. empty predictions. Default: False.
+    Returns
+    -------
+    dict
+        {'path', 'ok', 'readable', 'errors': list of str, 'shape', 'dtype', 'label_counts': {label: voxels}}.
+        readable is False if the file could not be decoded (e.g. CRC error or truncation); label_counts is None then,
+        and for non-integer data.
+    '''
+    report = {'path': path, 'ok': False, 'readable': False, 'errors': [], 'shape': None, 'dtype': None, 'label_counts': None}
+    errors = report['errors']
+    try:
+        with _open(path) as stream:
+            header = _read_header(stream)
+            shape = header.get_data_shape()
+            dtype = header.get_data_dtype()
+            report['shape'], report['dtype'] = list(shape), dtype.str
+            if(reference_shape is not None and tuple(shape) != tuple(reference_shape)):
+                errors.append(f'Shape {tuple(shape)} does not match the reference {tuple(reference_shape)}')
+            if(reference_affine is not None and not np.allclose(header.get_best_affine(), reference_affine,
+                                                                atol=1e-4)):
+                errors.append('Affine does not match the reference')
+            if(dtype.kind not in 'biu'):
+                errors.append(f'Data type {dtype} is not an integer label type')
+            slope, intercept = header.get_slope_inter()
+            if(slope not in (None, 1) or intercept not in (None, 0)):
+                errors.append(f'Data is scaled (slope {slope}, intercept {intercept})')
+
+            # Skip the extensions, up to the start of the voxel data
+            stream.read(max(int(header['vox_offset']) - stream.tell(), 0))
+            num_bytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+            chunk_bytes = max(CHUNK_BYTES // dtype.itemsize, 1) * dtype.itemsize
+            counts = {}
+            read_bytes = 0
+            while read_bytes < num_bytes:
+                chunk = stream.read(min(chunk_bytes, num_bytes - read_bytes))
+                if(len(chunk) == 0 or len(chunk) % dtype.itemsize):
+                    raise EOFError(f'Data ends after {read_bytes + len(chunk)} of {num_bytes} bytes')
+                read_bytes += len(chunk)
+                if(dtype.kind in 'biu'):
+                    _count_labels(np.frombuffer(chunk, dtype=dtype), counts)
+            # Reaching the end of the stream makes gzip check the CRC and length of the whole file
+            while stream.read(chunk_bytes):
+                pass
+    except (OSError, EOFError, zlib.error, HeaderDataError, ValueError) as e:
+        errors.append(f'{type(e).__name__}: {e}')
+        return report
+
+    report['readable'] = True
+    if(dtype.kind in 'biu'):
+        report['label_counts'] = {int(label): count for label, count in sorted(counts.items())}
+        unexpected = sorted(set(counts) - set(labels))
+        if(unexpected):
+            errors.append(f'Unexpected labels {unexpected}')
+        if(require_all_labels and set(labels) - set(counts)):
+            errors.append(f'Missing labels {sorted(set(labels) - set(counts))}')
+    report['ok'] = not errors
+    return report
+
+
+def check_files(paths, reference_path=None, num_workers=None, **check_kwargs):
+    '''
+    Runs check_file over a process pool.
+    Parameters
+    ----------
+    paths : sequence
+        Paths to the files to check.
+    reference_path : str
+        Optional. Image (e.g. a ground truth subject) whose shape and affine every file must match. Default: None.
+    num_workers : int
+        Optional. Number of processes. Default: number of CPUs.
+    check_kwargs
+        Passed to check_file.
+    Returns
+    -------
+    list
+        One report per file (see check_file), in the order of paths.
+    '''
+    if(reference_path is not None):
+        reference = nib.load(reference_path)
+        check_kwargs['reference_shape'] = reference.shape
+        check_kwargs['reference_affine'] = reference.affine
+    with Pool(num_workers) as pool:
+        return pool.map(partial(check_file, **check_kwargs), paths, chunksize=4)
@@ -0,0 +1,90 @@
+import os, hashlib, numpy as np, nibabel as nib
+
+
+def load_mask(path):
+    '''
+    Loads a binary mask from a NIfTI file as a boolean array. The stored data is read directly from dataobj, without
+    promotion to floating point; voxels are foreground if their value is > 0.5, as in isles.scoring. The result is
+    accepted by every scoring function without further copies.
+    Parameters
+    ----------
+    path : str or nibabel image
+        Path to the NIfTI file, or an image that was already opened with nibabel.
+    Returns
+    -------
+    np.array
+        Boolean array with the shape of the image.
+    '''
+    image = nib.load(path) if isinstance(path, (str, os.PathLike)) else path
+    data = np.asanyarray(image.dataobj)
+    if(data.dtype == bool):
+        return data
+    return data > 0.5
+
+
+class VolumeCache:
+    '''
+    Size-bounded on-disk cache of decoded masks, shared by every tool and process. Each mask is stored uncompressed as
+    a boolean .npy file, keyed by the path, size and mtime of its source file, and loaded as a read-only np.memmap, so
+    repeated runs skip the gzip decode and worker processes share the pages through the OS page cache. Entries are
+    written atomically; the mtime of an entry records its last use, and once the entries exceed max_bytes the least
+    recently used ones are deleted.
+    Parameters
+    ----------
+    root : str
+        Directory of the cache.
+    max_bytes : int
+        Size of the cache before LRU eviction.
+    '''
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    def entry_path(self, path: str) -> str:
+        stat = os.stat(path)
+        key = f'{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}'
+        return os.path.join(self.root, hashlib.sha1(key.encode()).hexdigest() + '.npy')
+
+    def load_mask(self, path: str) -> np.ndarray:
+        '''
+        Returns the mask of path (see load_mask), decoding and storing it on a cache miss.
+        '''
+        entry_path = self.entry_path(path)
+        try:
+            mask = np.load(entry_path, mmap_mode='r')
+            os.utime(entry_path)
+            return mask
+        except (FileNotFoundError, ValueError):
+            # ValueError: entry deleted or replaced while it was being opened
+            pass
+        mask = load_mask(path)
+        tmp_path = f'{entry_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, mask)
+        os.replace(tmp_path, entry_path)
+        self.evict()
+        return mask
+
+    def evict(self):
+        '''
+        Deletes the least recently used entries until the cache fits in max_bytes.
+        '''
+        entries = []
+        for entry in os.scandir(self.root):
+            if(entry.name.endswith('.npy')):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, entry_path in sorted(entries):
+            if(total_bytes <= self.max_bytes):
+                break
+            try:
+                # Processes that already mapped the entry keep reading it after the unlink
+                os.remove(entry_path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
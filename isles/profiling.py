@@ -0,0 +1,163 @@
+import os, sys, json, time, resource, threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+def _max_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 1024**2 if sys.platform == 'darwin' else max_rss / 1024
+
+
+class StageProfiler:
+    '''
+    Records the wall time, CPU time and memory of the stages of an evaluation (loading, shared intermediates, scoring
+    functions) as Chrome trace events, which can be opened in chrome://tracing or Perfetto and summarized with
+    summarize_events. CPU time is measured for the thread running the stage, so loading in a prefetch thread is not
+    charged to the scoring stages. Memory is the peak RSS of the process at the end of the stage, and how much the
+    stage raised it.
+    Attributes
+    ----------
+    events : list
+        Recorded trace events; plain dicts that can be pickled and sent back from a worker.
+    context : dict
+        Arguments added to every event recorded from now on, e.g. the subjects of the current batch.
+    '''
+    def __init__(self):
+        self.events = []
+        self.context = {}
+        self._named_threads = set()
+        self._lock = threading.Lock()
+
+    def _name_thread(self):
+        # Thread name metadata, so that the loading and scoring threads show up as labeled tracks
+        thread = threading.current_thread()
+        with self._lock:
+            if(thread.ident in self._named_threads):
+                return
+            self._named_threads.add(thread.ident)
+            self.events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': thread.ident,
+                                'args': {'name': thread.name}})
+
+    def _record(self, name, category, args, start, start_cpu, start_rss):
+        wall = time.perf_counter() - start
+        cpu = time.thread_time() - start_cpu
+        peak_rss = _max_rss_mb()
+        event = {'name': name, 'cat': category, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(),
+                 # perf_counter is a system-wide monotonic clock on Linux, so the worker timelines line up
+                 'ts': start * 1e6, 'dur': wall * 1e6,
+                 'args': {**self.context, **args, 'cpu_seconds': cpu, 'peak_rss_mb': peak_rss,
+                          'rss_growth_mb': peak_rss - start_rss}}
+        with self._lock:
+            self.events.append(event)
+
+    @contextmanager
+    def stage(self, name, category='scoring', **args):
+        '''
+        Context manager recording its body as a stage named name, with args as event arguments.
+        '''
+        self._name_thread()
+        start_rss, start_cpu, start = _max_rss_mb(), time.thread_time(), time.perf_counter()
+        try:
+            yield
+        finally:
+            self._record(name, category, args, start, start_cpu, start_rss)
+
+    def iterate(self, name, iterable, item_args=None, category='loading'):
+        '''
+        Iterates over iterable, recording the production of every item as a stage named name. item_args is an
+        optional sequence of event arguments, one per item.
+        '''
+        self._name_thread()
+        iterator = iter(iterable)
+        idx = 0
+        while True:
+            start_rss, start_cpu, start = _max_rss_mb(), time.thread_time(), time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self._record(name, category, item_args[idx] if item_args is not None else {}, start, start_cpu, start_rss)
+            yield item
+            idx += 1
+
+
+def summarize_events(events):
+    '''
+    Totals the stage events of one or more StageProfilers.
+    Parameters
+    ----------
+    events : list
+        Trace events, as in StageProfiler.events.
+    Returns
+    -------
+    dict
+        'stages': {stage name: calls, wall and CPU seconds, peak RSS and total RSS growth},
+        'workers': {pid: tasks, wall seconds of the tasks, CPU seconds of the stages, peak RSS},
+        'subjects': {subject: wall seconds of the stages}. A stage covering a batch of several subjects is split
+        evenly between them.
+    '''
+    stages = defaultdict(lambda: {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'peak_rss_mb': 0.0,
+                                  'rss_growth_mb': 0.0})
+    workers = defaultdict(lambda: {'tasks': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'peak_rss_mb': 0.0})
+    subjects = defaultdict(float)
+    for event in events:
+        if(event['ph'] != 'X'):
+            continue
+        wall = event['dur'] / 1e6
+        args = event['args']
+        worker = workers[str(event['pid'])]
+        worker['peak_rss_mb'] = max(worker['peak_rss_mb'], args['peak_rss_mb'])
+        if(event['cat'] == 'task'):
+            worker['tasks'] += 1
+            worker['wall_seconds'] += wall
+            continue
+        worker['cpu_seconds'] += args['cpu_seconds']
+        stage = stages[event['name']]
+        stage['calls'] += 1
+        stage['wall_seconds'] += wall
+        stage['cpu_seconds'] += args['cpu_seconds']
+        stage['peak_rss_mb'] = max(stage['peak_rss_mb'], args['peak_rss_mb'])
+        stage['rss_growth_mb'] += args['rss_growth_mb']
+        for subject in args.get('subjects', []):
+            subjects[subject] += wall / len(args['subjects'])
+    return {'stages': dict(stages), 'workers': dict(workers), 'subjects': dict(subjects)}
+
+
+def merge_timings(timings):
+    '''
+    Combines the timings of several evaluation runs, e.g. the shards of one evaluation.
+    Parameters
+    ----------
+    timings : dict
+        {run label: {'total_seconds', 'stages', 'workers', 'subjects'}}, as written under 'timings' by evaluation.py.
+    Returns
+    -------
+    dict
+        The same fields totaled over the runs, with 'runs' holding the total_seconds of every run. Workers are keyed by
+        '<run label>/<pid>', since process ids of different runs may collide.
+    '''
+    stages = defaultdict(lambda: {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'peak_rss_mb': 0.0,
+                                  'rss_growth_mb': 0.0})
+    workers = {}
+    subjects = defaultdict(float)
+    for label, run_timings in timings.items():
+        for name, run_stage in run_timings['stages'].items():
+            stage = stages[name]
+            for field in ('calls', 'wall_seconds', 'cpu_seconds', 'rss_growth_mb'):
+                stage[field] += run_stage[field]
+            stage['peak_rss_mb'] = max(stage['peak_rss_mb'], run_stage['peak_rss_mb'])
+        workers.update({f'{label}/{pid}': worker for pid, worker in run_timings['workers'].items()})
+        for subject, seconds in run_timings['subjects'].items():
+            subjects[subject] += seconds
+    return {'total_seconds': sum(run_timings['total_seconds'] for run_timings in timings.values()),
+            'runs': {label: run_timings['total_seconds'] for label, run_timings in timings.items()},
+            'stages': dict(stages), 'workers': workers, 'subjects': dict(subjects)}
+
+
+def write_trace(events, path):
+    '''
+    Writes trace events as a Chrome trace JSON file.
+    '''
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
@@ -0,0 +1,118 @@
+import os, json, time, hashlib, sqlite3
+from .scoring import SCORING_VERSION
+
+
+def _to_json(value):
+    # numpy scalars returned by custom scoring functions
+    if(hasattr(value, 'item')):
+        return value.item()
+    raise TypeError(f'Score of type {type(value).__name__} cannot be cached')
+
+
+class ScoreCache:
+    '''
+    Per-subject score cache stored in a SQLite file. Entries are keyed by a hash of the content of the prediction and
+    ground truth files, the names and functions in ScoringFunctions and isles.scoring.SCORING_VERSION, so a changed
+    file or metric never returns stale scores. Once the stored scores exceed max_bytes, the least recently used
+    entries are evicted.
+    '''
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.connection = sqlite3.connect(path, timeout=60)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS scores '
+                                    '(key TEXT PRIMARY KEY, scores TEXT, size INTEGER, last_used REAL)')
+            # Content hashes of files, so that unchanged files are not re-read on every run
+            self.connection.execute('CREATE TABLE IF NOT EXISTS file_digests '
+                                    '(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, digest TEXT)')
+        self.total_bytes = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM scores').fetchone()[0]
+        if(self.total_bytes > self.max_bytes):
+            self.evict()
+
+    def file_digest(self, path: str) -> str:
+        '''
+        Returns the SHA-256 of the file content. The digest is reused while the size and mtime of the file are
+        unchanged.
+        '''
+        stat = os.stat(path)
+        path = os.path.abspath(path)
+        row = self.connection.execute('SELECT size, mtime_ns, digest FROM file_digests WHERE path = ?',
+                                      (path,)).fetchone()
+        if(row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns):
+            return row[2]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO file_digests VALUES (?, ?, ?, ?)',
+                                    (path, stat.st_size, stat.st_mtime_ns, digest.hexdigest()))
+        return digest.hexdigest()
+
+    def key(self, prediction_paths, truth_paths, scoring_functions: dict, options: dict = None) -> str:
+        '''
+        Returns the cache key of a subject.
+        Parameters
+        ----------
+        prediction_paths : sequence
+            Paths to the prediction images of the subject.
+        truth_paths : sequence
+            Paths to the ground truth images of the subject.
+        scoring_functions : dict
+            Dictionary of scoring functions used, keyed by output name.
+        options : dict
+            Optional. Other settings the scores depend on, e.g. {'SlabDepth': 32}. Default: None.
+        Returns
+        -------
+        str
+        '''
+        scoring_set = sorted(f'{name}={getattr(score, "__module__", "")}.{getattr(score, "__qualname__", repr(score))}'
+                             for name, score in scoring_functions.items())
+        key_content = {'version': SCORING_VERSION,
+                       'scoring_functions': scoring_set,
+                       'prediction': [self.file_digest(path) for path in prediction_paths],
+                       'truth': [self.file_digest(path) for path in truth_paths]}
+        if(options is not None):
+            key_content['options'] = options
+        return hashlib.sha256(json.dumps(key_content, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key: str):
+        '''
+        Returns the cached {score_name: score} of a subject, or None on a cache miss.
+        '''
+        row = self.connection.execute('SELECT scores FROM scores WHERE key = ?', (key,)).fetchone()
+        if(row is None):
+            return None
+        with self.connection:
+            self.connection.execute('UPDATE scores SET last_used = ? WHERE key = ?', (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key: str, scores: dict):
+        '''
+        Stores the {score_name: score} of a subject, evicting least recently used entries if the cache is full.
+        '''
+        value = json.dumps(scores, default=_to_json)
+        with self.connection:
+            row = self.connection.execute('SELECT size FROM scores WHERE key = ?', (key,)).fetchone()
+            self.connection.execute('INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?)',
+                                    (key, value, len(value), time.time()))
+        self.total_bytes += len(value) - (row[0] if row is not None else 0)
+        if(self.total_bytes > self.max_bytes):
+            self.evict()
+
+    def evict(self):
+        '''
+        Deletes least recently used entries until the stored scores fit in max_bytes.
+        '''
+        evicted = []
+        for key, size in self.connection.execute('SELECT key, size FROM scores ORDER BY last_used'):
+            if(self.total_bytes <= self.max_bytes):
+                break
+            evicted.append((key,))
+            self.total_bytes -= size
+        with self.connection:
+            self.connection.executemany('DELETE FROM scores WHERE key = ?', evicted)
+
+    def close(self):
+        self.connection.close()
@@ -1,9 +1,750 @@
 import numpy as np
 import scipy.ndimage
+import scipy.sparse
+from collections import namedtuple
+from contextlib import nullcontext
+from functools import update_wrapper
 from scipy.optimize import linear_sum_assignment
-from sklearn.metrics import precision_score, recall_score, accuracy_score
+from scipy.sparse.csgraph import connected_components
 
 
+# Bump whenever the value of an existing metric changes, so that cached scores (see isles.score_cache) are invalidated.
+SCORING_VERSION = 3
+
+# Voxelwise confusion counts for each sample; every field is an int64 array with one entry per sample.
+ConfusionCounts = namedtuple('ConfusionCounts', ['tp', 'fp', 'fn', 'tn', 'pred_vol', 'truth_vol'])
+
+# Connected-component labels of a single sample, as returned by scipy.ndimage.label for the truth and the prediction,
+# and the bounding box of the sample to which the label maps are cropped (None if they are not cropped).
+LesionLabels = namedtuple('LesionLabels', ['truth_labels', 'num_truth', 'pred_labels', 'num_pred', 'box'],
+                          defaults=(None,))
+
+
+def _binarize(array):
+    '''
+    Returns the mask as a boolean array. Values are assigned to the nearest label, matching the previous
+    np.round(...).astype(np.uint8) conversion for masks with values in [0, 1].
+    '''
+    array = np.asanyarray(array)
+    if(array.dtype == bool):
+        return array
+    return array > 0.5
+
+
+def _batch_result(values, batchwise=False):
+    '''
+    Returns the per-sample values as a tuple if batchwise, otherwise returns the value of the only sample.
+    '''
+    if(batchwise):
+        return tuple(values)
+    return values[0]
+
+
+def _safe_ratio(numerator, denominator, empty_value=0.0):
+    '''
+    Elementwise numerator / denominator as a tuple of floats; samples with a zero denominator get empty_value.
+    '''
+    return tuple(float(num / den) if den != 0 else empty_value for num, den in zip(numerator, denominator))
+
+
+# Shared intermediates, keyed by name, and the names of the intermediates or batch inputs each is computed from; see
+# register_intermediate.
+INTERMEDIATE_FUNCTIONS = {}
+INTERMEDIATE_REQUIREMENTS = {}
+# Per-batch inputs given to score_batch rather than computed from the masks; intermediates can require them by name.
+BATCH_INPUTS = ('truth_labels', 'spacing')
+
+
+def register_intermediate(name, requires=()):
+    '''
+    Registers the decorated function as the shared intermediate name. score_batch computes it at most once per batch,
+    as func(truth, prediction, batchwise=True, **requirements), where requirements holds the value of every
+    intermediate or batch input named in requires under its own name. Custom intermediates can be registered from
+    settings.py.
+    '''
+    def decorator(func):
+        INTERMEDIATE_FUNCTIONS[name] = func
+        INTERMEDIATE_REQUIREMENTS[name] = tuple(requires)
+        return func
+    return decorator
+
+
+def derived_from(requires, from_intermediates):
+    '''
+    Marks a scoring function as computable from shared intermediates (see register_intermediate). requires is the name
+    of an intermediate or a sequence of names; score_batch computes each of them once per batch and calls
+    func.from_intermediates with their values, in the order of requires, for every function requiring them.
+    '''
+    def decorator(func):
+        func.requires = (requires,) if isinstance(requires, str) else tuple(requires)
+        func.from_intermediates = from_intermediates
+        return func
+    return decorator
+
+
+def derived_metric(*requires):
+    '''
+    Turns a function of the values of shared intermediates, returning one score per sample, into a scoring function
+    that can be used in ScoringFunctions, e.g. in settings.py:
+
+        @derived_metric('labels')
+        def predicted_lesions(labels_list):
+            return tuple(labels.num_pred for labels in labels_list)
+
+    Within score_batch, the metric then costs only its own arithmetic when its intermediates are shared with other
+    metrics. It can also be called on its own, as func(truth, prediction, batchwise=False).
+    '''
+    def decorator(from_intermediates):
+        def score(truth, prediction, batchwise=False):
+            if(not batchwise):
+                truth = truth[np.newaxis, ...]
+                prediction = prediction[np.newaxis, ...]
+            intermediates = compute_intermediates(truth, prediction, requires)
+            return _batch_result(from_intermediates(*[intermediates[name] for name in requires]), batchwise)
+        update_wrapper(score, from_intermediates)
+        return derived_from(requires, from_intermediates)(score)
+    return decorator
+
+
+def plan_intermediates(names, available=()):
+    '''
+    Returns the intermediates to compute for the given names, including every intermediate they require, each once and
+    after its own requirements. Batch inputs and the available intermediates (whose requirements are not needed
+    either) are not listed.
+    '''
+    order = []
+
+    def visit(name, path):
+        if(name in order or name in BATCH_INPUTS or name in available):
+            return
+        if(name not in INTERMEDIATE_FUNCTIONS):
+            raise KeyError(f'Unknown intermediate {name!r}; register it with register_intermediate.')
+        if(name in path):
+            raise ValueError(f'Circular intermediate requirements: {" -> ".join(path + (name,))}')
+        for requirement in INTERMEDIATE_REQUIREMENTS[name]:
+            visit(requirement, path + (name,))
+        order.append(name)
+
+    for name in names:
+        visit(name, ())
+    return order
+
+
+def compute_intermediates(truth, prediction, names, inputs=None, intermediates=None, stage=None):
+    '''
+    Computes the named intermediates of a batch, and those they require, following plan_intermediates.
+    Parameters
+    ----------
+    truth : np.array or PackedMask
+        Ground truth batch; the first dimension is the batch.
+    prediction : np.array or PackedMask
+        Prediction batch, with a shape matching 'truth'.
+    names : iterable
+        Names of the intermediates to compute.
+    inputs : dict
+        Optional. Values of the batch inputs (see BATCH_INPUTS); missing inputs are None. Default: None.
+    intermediates : dict
+        Optional. Intermediates already computed for the batch, which are reused; the new ones are added to it.
+        Default: None.
+    stage : callable
+        Optional. stage(name, category) returning the context manager in which each intermediate is computed, e.g.
+        StageProfiler.stage. Default: None.
+    Returns
+    -------
+    dict
+        Every computed intermediate, keyed by name.
+    '''
+    intermediates = {} if intermediates is None else intermediates
+    values = {name: None for name in BATCH_INPUTS}
+    values.update(inputs or {})
+    for name in plan_intermediates(names, available=intermediates):
+        requirements = {requirement: intermediates[requirement] if requirement in intermediates else values[requirement]
+                        for requirement in INTERMEDIATE_REQUIREMENTS[name]}
+        with stage(name, 'intermediate') if stage is not None else nullcontext():
+            intermediates[name] = INTERMEDIATE_FUNCTIONS[name](truth, prediction, batchwise=True, **requirements)
+    return intermediates
+
+
+# Number of set bits in every byte value, for numpy versions without np.bitwise_count
+_POPCOUNT_TABLE = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+
+
+def _popcount(words):
+    '''
+    Returns the number of set bits in each row of a 2D uint64 array.
+    '''
+    if(hasattr(np, 'bitwise_count')):
+        return np.bitwise_count(words).sum(axis=1, dtype=np.int64)
+    return _POPCOUNT_TABLE[words.view(np.uint8)].sum(axis=1, dtype=np.int64)
+
+
+class PackedMask:
+    '''
+    Binary masks stored with 1 bit per voxel: each sample is flattened, packed with np.packbits and padded to whole
+    uint64 words. Overlap measures are computed with bitwise AND/OR and a popcount over the words, without unpacking.
+    The voxel metrics of this module (Dice, precision, sensitivity, specificity, accuracy and volume difference) accept
+    PackedMask inputs directly; the lesion metrics unpack them.
+    Parameters
+    ----------
+    words : np.array
+        uint64 array of shape (num_samples, num_words) holding the packed bits.
+    shape : tuple
+        Shape of a single (unpacked) sample.
+    '''
+    def __init__(self, words, shape):
+        self.words = words
+        self.shape = tuple(shape)
+
+    @classmethod
+    def pack(cls, mask, batchwise=False):
+        '''
+        Packs a mask. If batchwise=True, the first dimension of the mask is the batch; otherwise the mask is a single
+        sample. PackedMask inputs are returned unchanged.
+        '''
+        if(isinstance(mask, cls)):
+            return mask
+        mask = _binarize(mask)
+        if(not batchwise):
+            mask = mask[np.newaxis, ...]
+        packed = np.packbits(np.reshape(mask, (mask.shape[0], -1)), axis=1)
+        padding = -packed.shape[1] % 8
+        if(padding):
+            packed = np.pad(packed, ((0, 0), (0, padding)))
+        return cls(np.ascontiguousarray(packed).view(np.uint64), mask.shape[1:])
+
+    def unpack(self):
+        '''
+        Returns the masks as a boolean array of shape (num_samples, *shape).
+        '''
+        bits = np.unpackbits(self.words.view(np.uint8), axis=1, count=self.num_voxels)
+        return bits.view(bool).reshape((len(self), *self.shape))
+
+    def __len__(self):
+        return self.words.shape[0]
+
+    @property
+    def num_voxels(self):
+        return int(np.prod(self.shape))
+
+    def volume(self):
+        '''
+        Returns the number of foreground voxels of each sample.
+        '''
+        return _popcount(self.words)
+
+    def intersection(self, other):
+        '''
+        Returns the number of voxels in the foreground of both masks, for each sample.
+        '''
+        return _popcount(self.words & other.words)
+
+    def union(self, other):
+        '''
+        Returns the number of voxels in the foreground of either mask, for each sample.
+        '''
+        return _popcount(self.words | other.words)
+
+
+def _packed_confusion_counts(truth, prediction):
+    '''
+    Computes the ConfusionCounts of two PackedMask with popcounts over the packed words.
+    '''
+    if(truth.shape != prediction.shape or len(truth) != len(prediction)):
+        raise ValueError(f'Packed masks do not match: {len(truth)}x{truth.shape} and '
+                         f'{len(prediction)}x{prediction.shape}')
+    truth_vol = truth.volume()
+    pred_vol = prediction.volume()
+    tp = truth.intersection(prediction)
+    fp = pred_vol - tp
+    fn = truth_vol - tp
+    tn = truth.num_voxels - tp - fp - fn
+    return ConfusionCounts(tp=tp, fp=fp, fn=fn, tn=tn, pred_vol=pred_vol, truth_vol=truth_vol)
+
+
+def _nonzero_projections(sample):
+    '''
+    Returns, for every axis of the sample, a boolean vector marking the positions holding non-zero voxels. Only two
+    passes are made over the full sample; the remaining projections are taken from the reduced array.
+    '''
+    reduced = np.any(sample, axis=-1)
+    projections = [np.any(reduced, axis=tuple(a for a in range(reduced.ndim) if a != axis))
+                   for axis in range(reduced.ndim)]
+    projections.append(np.any(sample, axis=tuple(range(sample.ndim - 1))))
+    return projections
+
+
+def sample_bounding_boxes(truth, prediction, batchwise=False, pad=1):
+    '''
+    Computes the joint bounding box of the non-zero voxels of the truth and the prediction of each sample, padded by
+    pad voxels. Every voxel outside of the box is background in both masks, so voxel metrics and labeling can be
+    restricted to it. The leading axis of each sample (the channel) is never cropped.
+    Parameters
+    ----------
+    truth : np.array
+        Array containing the ground truth.
+    prediction : np.array
+        Array containing the prediction.
+    batchwise : bool
+        Optional. Indicate whether the computation should be done batchwise, assuming that the first dimension of the
+        data is the batch. Default: False.
+    pad : int
+        Optional. Number of voxels by which to pad the box. Default: 1.
+    Returns
+    -------
+    tuple
+        Tuple of slices for every sample, indexing the sample (without the batch axis). Samples that are empty in both
+        masks get an empty box.
+    '''
+    if(not batchwise):
+        truth = truth[np.newaxis, ...]
+        prediction = prediction[np.newaxis, ...]
+
+    box_list = []
+    for idx_sample in range(truth.shape[0]):
+        truth_projections = _nonzero_projections(truth[idx_sample, ...])
+        pred_projections = _nonzero_projections(prediction[idx_sample, ...])
+        box = [slice(None)]
+        for axis in range(1, truth.ndim - 1):
+            nonzero = np.flatnonzero(truth_projections[axis] | pred_projections[axis])
+            if(nonzero.size == 0):
+                box.append(slice(0, 0))
+            else:
+                box.append(slice(max(nonzero[0] - pad, 0), min(nonzero[-1] + 1 + pad, truth.shape[axis + 1])))
+        box_list.append(tuple(box))
+    return tuple(box_list)
+
+
+@register_intermediate('bounding_boxes')
+def _batch_bounding_boxes(truth, prediction, batchwise=False):
+    # Packed masks are scored over the full volume
+    if(isinstance(truth, PackedMask) or isinstance(prediction, PackedMask)):
+        return None
+    return sample_bounding_boxes(truth, prediction, batchwise=batchwise)
+
+
+# Binarized truth and prediction of a single sample, cropped to its bounding box (a tuple of slices).
+CroppedMasks = namedtuple('CroppedMasks', ['truth', 'prediction', 'box'])
+
+
+@register_intermediate('masks', requires=('bounding_boxes',))
+def cropped_masks(truth, prediction, batchwise=False, bounding_boxes=None):
+    '''
+    Binarizes the truth and the prediction of each sample inside its bounding box. The voxel counts, the labels and the
+    surface distances all start from these masks, so each sample is cropped and binarized once; boolean inputs are
+    only viewed, not copied.
+    Parameters
+    ----------
+    truth : np.array
+        Array containing the ground truth.
+    prediction : np.array
+        Array containing the prediction.
+    batchwise : bool
+        Optional. Indicate whether the computation should be done batchwise, assuming that the first dimension of the
+        data is the batch. Default: False.
+    bounding_boxes : sequence
+        Optional. Bounding box of each sample, as returned by sample_bounding_boxes. Default: None (computed here).
+    Returns
+    -------
+    tuple
+        CroppedMasks for every sample, or None for packed masks (see PackedMask), which are not cropped.
+    '''
+    if(isinstance(truth, PackedMask) or isinstance(prediction, PackedMask)):
+        return None
+    if(not batchwise):
+        truth = truth[np.newaxis, ...]
+        prediction = prediction[np.newaxis, ...]
+    if(bounding_boxes is None):
+        bounding_boxes = sample_bounding_boxes(truth, prediction, batchwise=True)
+    return tuple(CroppedMasks(truth=_binarize(truth[idx_sample, ...][box]),
+                              prediction=_binarize(prediction[idx_sample, ...][box]), box=box)
+                 for idx_sample, box in enumerate(bounding_boxes))
+
+
+@register_intermediate('counts', requires=('masks',))
+def confusion_counts(truth, prediction, batchwise=False, bounding_boxes=None, masks=None):
+    '''
+    Computes the voxelwise true positive, false positive, false negative and true negative counts, as well as the
+    predicted and true volumes, with a single set of integer reductions over each sample. All voxel metrics in this
+    module are derived from these counts. The reductions only run inside the joint bounding box of both masks; the
+    true negatives outside of it are added back analytically. If either input is a PackedMask, the counts are
+    computed with popcounts over the packed bits instead.
+    Parameters
+    ----------
+    truth : np.array or PackedMask
+        Array containing the ground truth.
+    prediction : np.array or PackedMask
+        Array containing the prediction.
+    batchwise : bool
+        Optional. Indicate whether the computation should be done batchwise, assuming that the first dimension of the
+        data is the batch. Default: False.
+    bounding_boxes : sequence
+        Optional. Bounding box of each sample, as returned by sample_bounding_boxes. Default: None (computed here).
+    masks : sequence
+        Optional. Cropped masks of each sample, as returned by cropped_masks; bounding_boxes is then not used.
+        Default: None.
+    Returns
+    -------
+    ConfusionCounts
+        Named tuple of int64 arrays with one entry per sample. If batchwise=False, the arrays have a single entry.
+    '''
+    if(isinstance(truth, PackedMask) or isinstance(prediction, PackedMask)):
+        return _packed_confusion_counts(PackedMask.pack(truth, batchwise), PackedMask.pack(prediction, batchwise))
+
+    if(not batchwise):
+        truth = truth[np.newaxis, ...]
+        prediction = prediction[np.newaxis, ...]
+    if(masks is None):
+        masks = cropped_masks(truth, prediction, batchwise=True, bounding_boxes=bounding_boxes)
+    num_samples = truth.shape[0]
+    num_voxels = int(np.prod(truth.shape[1:]))
+
+    truth_vol = np.zeros(num_samples, dtype=np.int64)
+    pred_vol = np.zeros(num_samples, dtype=np.int64)
+    tp = np.zeros(num_samples, dtype=np.int64)
+    for idx_sample, (sample_truth, sample_prediction, _) in enumerate(masks):
+        truth_vol[idx_sample] = np.count_nonzero(sample_truth)
+        pred_vol[idx_sample] = np.count_nonzero(sample_prediction)
+        tp[idx_sample] = np.count_nonzero(sample_truth & sample_prediction)
+    fp = pred_vol - tp
+    fn = truth_vol - tp
+    # Every voxel outside of the box is a true negative
+    tn = num_voxels - tp - fp - fn
+    return ConfusionCounts(tp=tp, fp=fp, fn=fn, tn=tn, pred_vol=pred_vol, truth_vol=truth_vol)
+
+
+def _dice_from_counts(counts):
+    # If there are no non-zero labels in either the truth or the prediction, the score is "perfect"
+    return _safe_ratio(2 * counts.tp, counts.pred_vol + counts.truth_vol, empty_value=1.0)
+
+
+def _volume_difference_from_counts(counts):
+    return tuple(int(abs(pred - tru)) for pred, tru in zip(counts.pred_vol, counts.truth_vol))
+
+
+def _precision_from_counts(counts):
+    return _safe_ratio(counts.tp, counts.tp + counts.fp)
+
+
+def _sensitivity_from_counts(counts):
+    return _safe_ratio(counts.tp, counts.tp + counts.fn)
+
+
+def _specificity_from_counts(counts):
+    return _safe_ratio(counts.tn, counts.tn + counts.fp)
+
+
+def _accuracy_from_counts(counts):
+    return _safe_ratio(counts.tp + counts.tn, counts.tp + counts.fp + counts.fn + counts.tn)
+
+
+def label_mask(mask):
+    '''
+    Labels the 3D connected components of a single mask with scipy.ndimage.label. A mask of shape (channel, x, y, z) is
+    labeled channel by channel, with the labels numbered across the channels, so that no lesion spans two channels.
+    This is the labeling used by every lesion metric in this module, including labels precomputed ahead of time (see
+    isles.ground_truth).
+    Parameters
+    ----------
+    mask : np.array
+        Array containing a single mask.
+    Returns
+    -------
+    tuple
+        (labels, num_labels), as returned by scipy.ndimage.label.
+    '''
+    mask = _binarize(mask)
+    structure = None
+    if(mask.ndim > 3):
+        # 3D connectivity only; voxels of different channels are never connected
+        structure = np.zeros((3,) * mask.ndim, dtype=bool)
+        structure[(1,) * (mask.ndim - 3)] = scipy.ndimage.generate_binary_structure(3, 1)
+    return scipy.ndimage.label(mask, structure=structure)
+
+
+@register_intermediate('labels', requires=('masks', 'truth_labels'))
+def lesion_labels(truth, prediction, batchwise=False, truth_labels=None, bounding_boxes=None, masks=None):
+    '''
+    Labels the 3D connected components of every channel of the truth and the prediction of each sample (see
+    label_mask). Each mask is labeled exactly once; the lesion metrics in this module are derived from these labels.
+    Labeling only runs inside the joint bounding box of both masks, so the returned label maps are cropped to that box.
+    Parameters
+    ----------
+    truth : np.array
+        Array containing the ground truth.
+    prediction : np.array
+        Array containing the prediction.
+    batchwise : bool
+        Optional. Indicate whether the computation should be done batchwise, assuming that the first dimension of the
+        data is the batch. Default: False.
+    truth_labels : sequence
+        Optional. Precomputed (labels, num_labels) of the full ground truth of each sample, as returned by label_mask.
+        Samples whose entry is None are labeled here. Default: None.
+    bounding_boxes : sequence
+        Optional. Bounding box of each sample, as returned by sample_bounding_boxes. Default: None (computed here).
+    masks : sequence
+        Optional. Cropped masks of each sample, as returned by cropped_masks; bounding_boxes is then not used.
+        Default: None.
+    Returns
+    -------
+    tuple
+        LesionLabels for every sample. If batchwise=False, the tuple has a single entry.
+    '''
+    if(masks is None):
+        if(isinstance(truth, PackedMask)):
+            truth = truth.unpack() if batchwise else truth.unpack()[0]
+        if(isinstance(prediction, PackedMask)):
+            prediction = prediction.unpack() if batchwise else prediction.unpack()[0]
+        if(not batchwise):
+            truth = truth[np.newaxis, ...]
+            prediction = prediction[np.newaxis, ...]
+        masks = cropped_masks(truth, prediction, batchwise=True, bounding_boxes=bounding_boxes)
+    if(truth_labels is None):
+        truth_labels = [None] * len(masks)
+
+    labels_list = []
+    for idx_sample, (sample_truth, sample_prediction, box) in enumerate(masks):
+        if(truth_labels[idx_sample] is None):
+            sample_truth_labels, num_truth = label_mask(sample_truth)
+        else:
+            sample_truth_labels, num_truth = truth_labels[idx_sample]
+            sample_truth_labels = np.asarray(sample_truth_labels[box])
+        pred_labels, num_pred = label_mask(sample_prediction)
+        labels_list.append(LesionLabels(truth_labels=sample_truth_labels, num_truth=num_truth,
+                                        pred_labels=pred_labels, num_pred=num_pred, box=box))
+    return tuple(labels_list)
+
+
+def _lesion_contingency(truth_labels, pred_labels, num_pred):
+    '''
+    Builds the sparse contingency table between two label maps from the voxels where both are labeled. Returns the
+    arrays (truth_idx, pred_idx, overlap) listing every pair of overlapping lesions and their number of shared voxels;
+    pairs of lesions that never touch are not listed.
+    '''
+    both = (truth_labels > 0) & (pred_labels > 0)
+    pair_keys = truth_labels[both].astype(np.int64) * (num_pred + 1) + pred_labels[both]
+    pair_keys, overlap = np.unique(pair_keys, return_counts=True)
+    truth_idx, pred_idx = np.divmod(pair_keys, num_pred + 1)
+    return truth_idx, pred_idx, overlap
+
+
+def _lesion_f1_from_labels(truth_labels, num_truth, pred_labels, num_pred, empty_value=1.0):
+    '''
+    Computes the lesion-wise F1-score from the label maps; see _lesion_f1_score. num_truth and num_pred are the number
+    of lesions present in the respective label maps.
+    '''
+    truth_idx, pred_idx, _ = _lesion_contingency(truth_labels, pred_labels, num_pred)
+    tp = np.unique(truth_idx).size  # True lesions overlapping at least one predicted voxel
+    fn = num_truth - tp
+    fp = num_pred - np.unique(pred_idx).size  # Predicted lesions without any overlap
+    return _lesion_f1_from_detections(tp, fp, fn, empty_value)
+
+
+def _lesion_f1_from_detections(tp, fp, fn, empty_value=1.0):
+    denom = tp + (fp + fn)/2
+    if(denom != 0):
+        return tp / denom
+    return empty_value
+
+
+# Per-lesion statistics of the truth and the prediction of a single sample, the overlapping (truth, prediction) lesion
+# pairs and the number of channels of the sample; see lesion_statistics.
+LesionTable = namedtuple('LesionTable', ['truth', 'pred', 'pairs', 'num_channels'])
+
+# Lesion size buckets of the size-stratified lesion metrics, as {name: (min voxels, max voxels)}. The minimum is
+# included and the maximum excluded; None means no maximum.
+LESION_SIZE_BUCKETS = {'tiny': (0, 10), 'small': (10, 100), 'medium': (100, 1000), 'large': (1000, None)}
+
+PAIR_DTYPE = np.dtype([('channel', np.int32), ('truth_label', np.int32), ('pred_label', np.int32),
+                       ('overlap', np.int64)])
+
+
+def lesion_dtype(ndim):
+    '''
+    Returns the structured dtype of the rows of a LesionTable of ndim spatial axes.
+    '''
+    return np.dtype([('channel', np.int32), ('label', np.int32), ('component', np.int32), ('voxels', np.int64),
+                     ('overlap', np.int64), ('detected', bool), ('bbox_start', np.int64, (ndim,)),
+                     ('bbox_stop', np.int64, (ndim,))])
+
+
+def _lesion_rows(labels, num_labels, other_mask, offset):
+    '''
+    Returns the per-lesion table of the label map of a single channel as a structured array, from two bincounts and one
+    scipy.ndimage.find_objects pass over the map. overlap is the number of voxels of the lesion inside other_mask, and
+    the bounding box is shifted by offset into the coordinates of the full volume.
+    '''
+    table = np.zeros(num_labels, dtype=lesion_dtype(labels.ndim))
+    if(num_labels == 0):
+        return table
+    table['label'] = np.arange(1, num_labels + 1)
+    table['voxels'] = np.bincount(labels.ravel(), minlength=num_labels + 1)[1:num_labels + 1]
+    table['overlap'] = np.bincount(labels[other_mask], minlength=num_labels + 1)[1:num_labels + 1]
+    table['detected'] = table['overlap'] > 0
+    for idx, slices in enumerate(scipy.ndimage.find_objects(labels, max_label=num_labels)):
+        if(slices is not None):
+            table['bbox_start'][idx] = [axis_slice.start for axis_slice in slices]
+            table['bbox_stop'][idx] = [axis_slice.stop for axis_slice in slices]
+    table['bbox_start'] += offset
+    table['bbox_stop'] += offset
+    # Labels absent from the channel (e.g. of another channel, or of a precomputed labeling) have no voxels
+    return table[table['voxels'] > 0]
+
+
+def _channel_components(labels, num_labels):
+    '''
+    Returns the component of every label of a (channel, ...) label map when lesions of adjacent channels that share a
+    voxel position are joined, as when the whole sample is labeled at once. The lesion counts (see
+    simple_lesion_count_difference and lesion_count_by_weighted_assignment) count these components.
+    '''
+    if(labels.shape[0] == 1):
+        return np.arange(num_labels + 1)
+    both = (labels[:-1] > 0) & (labels[1:] > 0)
+    edges = scipy.sparse.coo_matrix((np.ones(np.count_nonzero(both)), (labels[:-1][both], labels[1:][both])),
+                                    shape=(num_labels + 1, num_labels + 1))
+    return connected_components(edges, directed=False)[1]
+
+
+def lesion_tables(labels_list):
+    '''
+    Builds the LesionTable of every sample from its LesionLabels; see lesion_statistics.
+    '''
+    tables = []
+    for labels in labels_list:
+        ndim = labels.truth_labels.ndim - 1
+        offset = np.zeros(ndim, dtype=np.int64) if labels.box is None else \
+            np.array([axis_slice.start or 0 for axis_slice in labels.box[1:]], dtype=np.int64)
+        truth_rows, pred_rows, pairs = [], [], []
+        for channel, (truth_labels, pred_labels) in enumerate(zip(labels.truth_labels, labels.pred_labels)):
+            truth_rows.append(_lesion_rows(truth_labels, labels.num_truth, pred_labels > 0, offset))
+            pred_rows.append(_lesion_rows(pred_labels, labels.num_pred, truth_labels > 0, offset))
+            truth_idx, pred_idx, overlap = _lesion_contingency(truth_labels, pred_labels, labels.num_pred)
+            channel_pairs = np.zeros(truth_idx.size, dtype=PAIR_DTYPE)
+            channel_pairs['truth_label'], channel_pairs['pred_label'], channel_pairs['overlap'] = \
+                truth_idx, pred_idx, overlap
+            pairs.append(channel_pairs)
+            truth_rows[-1]['channel'] = pred_rows[-1]['channel'] = channel_pairs['channel'] = channel
+        truth_rows, pred_rows = np.concatenate(truth_rows), np.concatenate(pred_rows)
+        truth_rows['component'] = _channel_components(labels.truth_labels, labels.num_truth)[truth_rows['label']]
+        pred_rows['component'] = _channel_components(labels.pred_labels, labels.num_pred)[pred_rows['label']]
+        tables.append(LesionTable(truth=truth_rows, pred=pred_rows,
+                                  pairs=np.concatenate(pairs), num_channels=labels.truth_labels.shape[0]))
+    return tuple(tables)
+
+
+@register_intermediate('lesions', requires=('labels',))
+def lesion_statistics(truth, prediction, batchwise=False, truth_labels=None, bounding_boxes=None, labels=None):
+    '''
+    Computes a compact table of the lesions of the truth and of the prediction of each sample: the label, the number of
+    voxels, the bounding box, the number of voxels overlapping the other mask and whether the lesion is detected, i.e.
+    overlaps it at all (the criterion of lesion_f1_score), as well as every overlapping pair of lesions. Each channel
+    of a sample has its own rows. The tables are built from the label maps of lesion_labels with a fixed number of
+    passes, so the cost does not grow with the number of lesions, and every lesion metric is derived from them.
+    Parameters
+    ----------
+    truth : np.array
+        Array containing the ground truth.
+    prediction : np.array
+        Array containing the prediction.
+    batchwise : bool
+        Optional. Indicate whether the computation should be done batchwise, assuming that the first dimension of the
+        data is the batch. Default: False.
+    truth_labels, bounding_boxes
+        Optional. See lesion_labels.
+    labels : sequence
+        Optional. LesionLabels of each sample, as returned by lesion_labels; the masks are then not labeled again.
+        Default: None.
+    Returns
+    -------
+    tuple
+        LesionTable for every sample. Its truth and pred fields are structured arrays (see lesion_dtype) with the
+        fields channel, label, component (see _channel_components), voxels, overlap, detected, bbox_start and
+        bbox_stop (spatial voxel coordinates, stop excluded), one row per lesion of each channel. pairs is a
+        structured array (see PAIR_DTYPE) with the number of shared voxels of every overlapping pair of lesions in each
+        channel.
+    '''
+    if(labels is None):
+        labels = lesion_labels(truth, prediction, batchwise=batchwise, truth_labels=truth_labels,
+                               bounding_boxes=bounding_boxes)
+    return lesion_tables(labels)
+
+
+def _num_lesions(rows):
+    # Lesions of adjacent channels sharing a voxel position count once, as in the original 4D labeling
+    return np.unique(rows['component']).size
+
+
+def _lesion_f1_from_table(table):
+    '''
+    Computes the lesion-wise F1-score of a sample from its LesionTable, averaged across the channels.
+    '''
+    f1_score = 0
+    for channel in range(table.num_channels):
+        truth_detected = table.truth['detected'][table.truth['channel'] == channel]
+        pred_detected = table.pred['detected'][table.pred['channel'] == channel]
+        tp = int(np.count_nonzero(truth_detected))
+        f1_score += _lesion_f1_from_detections(tp, pred_detected.size - int(np.count_nonzero(pred_detected)),
+                                               truth_detected.size - tp)
+    return f1_score / table.num_channels
+
+
+def _label_components(rows):
+    # Lookup from label to component
+    components = np.zeros(int(rows['label'].max(initial=0)) + 1, dtype=np.int64)
+    components[rows['label']] = rows['component']
+    return components
+
+
+def _lesion_count_by_weighted_assignment_from_table(table):
+    '''
+    Computes the lesion count by weighted assignment of a single sample from its LesionTable. The pairwise precision
+    matrix is kept sparse and the assignment is solved independently on each connected block of the overlap graph;
+    lesions that touch nothing contribute no precision and need no assignment.
+    '''
+    num_pred, num_truth = _num_lesions(table.pred), _num_lesions(table.truth)
+    if(num_truth == 0):
+        return 1.0 if num_pred == 0 else 0.0
+    if(table.pairs.size == 0):
+        return 0.0
+
+    # Precision of every overlapping (pred, truth) pair of components: shared voxels / predicted component volume
+    pred_components, pred_row_idx = np.unique(table.pred['component'], return_inverse=True)
+    truth_components = np.unique(table.truth['component'])
+    pred_volumes = np.bincount(pred_row_idx, weights=table.pred['voxels'], minlength=num_pred)
+    pair_pred = np.searchsorted(pred_components, _label_components(table.pred)[table.pairs['pred_label']])
+    pair_truth = np.searchsorted(truth_components, _label_components(table.truth)[table.pairs['truth_label']])
+    cost_matrix = scipy.sparse.coo_matrix((table.pairs['overlap'].astype(np.float64), (pair_pred, pair_truth)),
+                                          shape=(num_pred, num_truth)).tocsr()
+    cost_matrix.sum_duplicates()
+    cost_matrix = scipy.sparse.diags(1 / pred_volumes) @ cost_matrix
+    pred_idx = np.unique(pair_pred)
+
+    # Maximum-weight matchings of disconnected blocks are independent; solve each block separately
+    adjacency = scipy.sparse.bmat([[None, cost_matrix], [cost_matrix.T, None]], format='csr')
+    _, block_labels = connected_components(adjacency, directed=False)
+    pred_blocks, truth_blocks = block_labels[:num_pred], block_labels[num_pred:]
+    total_precision = 0.0
+    for block in np.unique(block_labels[pred_idx]):
+        block_pred = np.flatnonzero(pred_blocks == block)
+        block_truth = np.flatnonzero(truth_blocks == block)
+        block_matrix = cost_matrix[block_pred, :][:, block_truth].toarray()
+        row_ind, col_ind = linear_sum_assignment(cost_matrix=block_matrix, maximize=True)
+        total_precision += block_matrix[row_ind, col_ind].sum()
+    return float(total_precision / num_truth)
+
+
+def _lesion_count_by_weighted_assignment_from_tables(tables):
+    return tuple(_lesion_count_by_weighted_assignment_from_table(table) for table in tables)
+
+
+def _simple_lesion_count_from_tables(tables):
+    return tuple(abs(_num_lesions(table.pred) - _num_lesions(table.truth)) for table in tables)
+
+
+def _lesion_f1_from_tables(tables):
+    return tuple(_lesion_f1_from_table(table) for table in tables)
+
+
+@derived_from('counts', _dice_from_counts)
 def dice_coef(truth, prediction, batchwise=False):
     '''
     Computes the Sørensen–Dice coefficient for the input matrices. If batchwise=True, the first dimension of the input
@@ -23,39 +764,11 @@ def dice_coef(truth, prediction, batchwise=False):
     float or tuple
         Sørensen–Dice coefficient.
     '''
-
-    # Reshape the input to reduce computation to a dot product
-    if(not batchwise):
-        prediction = np.reshape(prediction, (1,np.prod(prediction.shape)))
-        truth = np.reshape(truth, (1,np.prod(truth.shape)))
-    else:
-        pred_shape = prediction.shape
-        prediction = np.reshape(prediction, (pred_shape[0], np.prod(pred_shape[1:])))
-        truth_shape = truth.shape
-        truth = np.reshape(truth, (truth_shape[0], np.prod(truth_shape[1:])))
-
-    # Prevent values >1 from inflating the score
-    np.clip(truth, 0, 1, out=truth)
-    np.clip(prediction, 0, 1, out=prediction)
-
-    # Compute dice coef
-    coef_list = []
-    for i in range(truth.shape[0]):
-        coef_denom = np.sum(prediction[i,...]) + np.sum(truth[i,...])
-        if(coef_denom == 0):  # If there are no non-zero labels in either the truth or the prediction
-            coef_list.append(1.0)  # "Perfect" score
-            continue
-        coef = prediction[i:i+1, ...] @ truth[i:i+1, ...].T
-        coef = 2*coef / coef_denom
-        coef_list.append(float(coef))
-
-    # Return list of coeffs if batchwise, otherwise return float
-    if(batchwise):
-        return tuple(coef_list)
-    else:
-        return coef_list[0]
+    counts = confusion_counts(truth, prediction, batchwise=batchwise)
+    return _batch_result(_dice_from_counts(counts), batchwise)
 
 
+@derived_from('counts', _volume_difference_from_counts)
 def volume_difference(truth, prediction, batchwise=False):
     '''
     Computes the total volume difference between the prediction and ground truth.
@@ -70,24 +783,14 @@ def volume_difference(truth, prediction, batchwise=False):
         data is the batch. Default: False.
     Returns
     -------
-    float or tuple
+    int or tuple
+        Absolute difference in the number of voxels.
     '''
-    if(not batchwise):
-        pred_vol = np.sum(prediction)
-        truth_vol = np.sum(prediction)
-        return np.abs(pred_vol - truth_vol)
-    else:
-        pred_shape = prediction.shape
-        prediction = np.reshape(prediction, (pred_shape[0], np.prod(pred_shape[1:])))
-        truth_shape = truth.shape
-        truth = np.reshape(truth, (truth_shape[0], np.prod(truth_shape[1:])))
-
-        prediction_vols = [np.sum(prediction[i, ...]) for i in range(pred_shape[0])]
-        truth_vols = [np.sum(truth[i,...]) for i in range(truth_shape[0])]
-        return tuple(np.abs(pred - tru) for pred, tru in zip(prediction_vols, truth_vols))
-    return
+    counts = confusion_counts(truth, prediction, batchwise=batchwise)
+    return _batch_result(_volume_difference_from_counts(counts), batchwise)
 
 
+@derived_from('lesions', _simple_lesion_count_from_tables)
 def simple_lesion_count_difference(truth, prediction, batchwise=False):
     '''
     Computes the difference in the number of distinct regions between the two input images. Regions are considered
@@ -108,28 +811,19 @@ def simple_lesion_count_difference(truth, prediction, batchwise=False):
     -------
     int or tuple
     '''
-    if(not batchwise):
-        _, pred_count = scipy.ndimage.label(prediction)
-        _, truth_count = scipy.ndimage.label(truth)
-        return np.abs(pred_count - truth_count)
-    else:
-        truth_shape = truth.shape
-        count_list = []
-        for i in range(truth_shape[0]):
-            _, pred_count = scipy.ndimage.label(prediction[i, ...])
-            _, truth_count = scipy.ndimage.label(truth[i, ...])
-            count_list.append(np.abs(pred_count - truth_count))
-        return tuple(count_list)
-    return
+    tables = lesion_statistics(truth, prediction, batchwise=batchwise)
+    return _batch_result(_simple_lesion_count_from_tables(tables), batchwise)
 
 
+@derived_from('lesions', _lesion_count_by_weighted_assignment_from_tables)
 def lesion_count_by_weighted_assignment(truth, prediction, batchwise=False):
     '''
     Performs lesion matching between the predicted lesions and the true lesions. A weighted bipartite graph between
     the predicted and true lesions is constructed, using precision as the edge weights. The returned value is the
     mean precision across predictions normalized by the number of lesions in the ground truth. Values close to 1
     indicate that the right number of lesions have been identified and that they overlap. Lower values indicate either
-    the wrong number of predicted lesions or that they do not sufficiently overlap with the ground truth.
+    the wrong number of predicted lesions or that they do not sufficiently overlap with the ground truth. If the ground
+    truth has no lesions, the score is 1 for an empty prediction and 0 otherwise.
     Parameters
     ----------
     prediction : np.array
@@ -144,43 +838,11 @@ def lesion_count_by_weighted_assignment(truth, prediction, batchwise=False):
     -------
     float or tuple
     '''
-    # Reshape to avoid code duplication
-    if(not batchwise):
-        prediction = np.reshape(prediction, (1, *prediction.shape))
-        truth = np.reshape(truth, (1, *truth.shape))
-    pred_shape = prediction.shape
-    truth_shape = truth.shape
-
-    # "Lesion Count by Weighted Assignment"
-    lcwa = []
-    for idx_sample in range(truth_shape[0]):
-        # Identify unique regions
-        pred_lesions, num_pred_lesions = scipy.ndimage.label(prediction[idx_sample, ...])
-        truth_lesion, num_truth_lesions = scipy.ndimage.label(truth[idx_sample, ...])
-
-        # reshape for use with sklearn precision
-        pred_reshape = np.reshape(prediction[idx_sample, ...], (np.prod(pred_shape[1:])))
-        truth_reshape = np.reshape(truth[idx_sample, ...], (np.prod(truth_shape[1:])))
-
-        # pre-allocate cost matrix
-        cost_matrix = np.zeros((num_pred_lesions, num_truth_lesions))
-
-        # compute cost matrix
-        for idx_pred in range(num_pred_lesions):
-            pred_lesion = pred_reshape == idx_pred
-            for idx_truth in range(num_truth_lesions):
-                truth_lesion = truth_reshape == idx_truth
-                cost_matrix[idx_pred, idx_truth] = precision_score(y_true=truth_lesion, y_pred=pred_lesion)
-        row_ind, col_ind = linear_sum_assignment(cost_matrix=cost_matrix, maximize=True)
-        total_precision = cost_matrix[row_ind, col_ind].sum()
-        lcwa.append(total_precision / num_truth_lesions)
-
-    if(not batchwise):
-        return lcwa[0]
-    else:
-        return tuple(lcwa)
+    tables = lesion_statistics(truth, prediction, batchwise=batchwise)
+    return _batch_result(_lesion_count_by_weighted_assignment_from_tables(tables), batchwise)
 
 
+@derived_from('counts', _precision_from_counts)
 def precision(truth, prediction, batchwise=False):
     '''
     Returns the precision of the prediction: tp / (tp + fp)
@@ -198,26 +860,11 @@ def precision(truth, prediction, batchwise=False):
     float or tuple
         Precision of the input. If batchwise=True, the tuple is the precision for every sample.
     '''
-    # sklearn implementation requires vectors of ints
-    truth = np.round(truth).astype(np.uint8)
-    prediction = np.round(prediction).astype(np.uint8)
-
-    if(not batchwise):
-        # Convert to vector
-        num_pred = np.prod(prediction.shape)
-        return precision_score(truth.reshape((num_pred,)), prediction.reshape((num_pred,)))
-    else:
-        # Need to get the precision for each sample in the batch
-        precision_list = []
-        num_pred = np.prod(prediction.shape[1:])
-        for sample_idx in range(truth.shape[0]):
-            sample_precision = precision(truth[sample_idx, ...].reshape((num_pred,)),
-                                         prediction[sample_idx, ...].reshape((num_pred,)),
-                                         batchwise=False)
-            precision_list.append(sample_precision)
-        return tuple(precision_list)
+    counts = confusion_counts(truth, prediction, batchwise=batchwise)
+    return _batch_result(_precision_from_counts(counts), batchwise)
 
 
+@derived_from('counts', _sensitivity_from_counts)
 def sensitivity(truth, prediction, batchwise=False):
     '''
     Returns the sensitivity of the prediction: tp / (tp + fn)
@@ -236,9 +883,11 @@ def sensitivity(truth, prediction, batchwise=False):
     float or tuple
         Sensitivity of the input. If batchwise=True, the tuple is the sensitivity for every sample.
     '''
-    return _recall(truth, prediction, batchwise=batchwise, pos_label=1)
+    counts = confusion_counts(truth, prediction, batchwise=batchwise)
+    return _batch_result(_sensitivity_from_counts(counts), batchwise)
 
 
+@derived_from('counts', _specificity_from_counts)
 def specificity(truth, prediction, batchwise=False):
     '''
     Returns the specificity of the prediction: tn / (tn + fp)
@@ -257,50 +906,11 @@ def specificity(truth, prediction, batchwise=False):
     float or tuple
         Specificity of the input. If batchwise=True, the tuple is the specificity for every sample.
     '''
-    return _recall(truth, prediction, batchwise=batchwise, pos_label=0)
-
-
-def _recall(truth, prediction, batchwise=False, pos_label=1):
-    '''
-    Returns the recall of the prediction: tp / (tp + fn), where 'positive' is defined by pos_label.
-    Parameters
-    ----------
-    truth : np.array
-        Ground truth data.
-    prediction : np.array
-        Prediction data.
-    batchwise : bool
-        Optional. Indicate whether the computation should be done batchwise, assuming that the first dimension of the
-        data is the batch. Default: False.
-    pos_label : int
-        Optional. Indicate which label is the positive case. Default: 1.
-
-    Returns
-    -------
-    float or tuple
-        Recall of the input for the label specified by pos_label. If batchwise=True, the tuple is the specificity for every sample.
-    '''
-    # sklearn implementation requires vectors of ints
-    truth = np.round(truth).astype(np.uint8)
-    prediction = np.round(prediction).astype(np.uint8)
-
-    if(not batchwise):
-        # Convert to vector
-        num_pred = np.prod(prediction.shape)
-        return recall_score(truth.reshape((num_pred,)), prediction.reshape((num_pred,)), pos_label=pos_label)
-    else:
-        # Need to get the precision for each sample in the batch
-        recall_list = []
-        num_pred = np.prod(prediction.shape[1:])
-        for sample_idx in range(truth.shape[0]):
-            sample_recall = _recall(truth[sample_idx, ...].reshape((num_pred,)),
-                                    prediction[sample_idx, ...].reshape((num_pred,)),
-                                    batchwise=False,
-                                    pos_label=pos_label)
-            recall_list.append(sample_recall)
-        return tuple(recall_list)
+    counts = confusion_counts(truth, prediction, batchwise=batchwise)
+    return _batch_result(_specificity_from_counts(counts), batchwise)
 
 
+@derived_from('counts', _accuracy_from_counts)
 def accuracy(truth, prediction, batchwise=False):
     '''
     Returns the accuracy of the prediction (tp + tn) / (tp+tn+fp+fn)
@@ -317,31 +927,17 @@ def accuracy(truth, prediction, batchwise=False):
     Returns
     -------
     float or tuple
-        Accuracy of the input. If batchwise=True, the tuple is the specificity for every sample.
+        Accuracy of the input. If batchwise=True, the tuple is the accuracy for every sample.
     '''
-    # sklearn implementation requires vectors of ints
-    truth = np.round(truth).astype(np.uint8)
-    prediction = np.round(prediction).astype(np.uint8)
-
-    if(not batchwise):
-        # Convert to vector
-        num_pred = np.prod(prediction.shape)
-        return accuracy_score(truth.reshape((num_pred,)), prediction.reshape((num_pred,)))
-    else:
-        accuracy_list = []
-        num_pred = np.prod(prediction.shape[1:])
-        for sample_idx in range(truth.shape[0]):
-            sample_accuracy = accuracy(truth[sample_idx, ...].reshape((num_pred,)),
-                                       prediction[sample_idx,...].reshape((num_pred,)),
-                                       batchwise=False)
-            accuracy_list.append(sample_accuracy)
-        return tuple(accuracy_list)
+    counts = confusion_counts(truth, prediction, batchwise=batchwise)
+    return _batch_result(_accuracy_from_counts(counts), batchwise)
 
 
 def _lesion_f1_score(truth, prediction, empty_value=1.0):
     """
     Computes the lesion-wise F1-score between two masks. Masks are considered true positives if at least one voxel
-    overlaps between the truth and the prediction.
+    overlaps between the truth and the prediction. Lesions are matched through a single sparse overlap table between
+    the two label maps, so the cost is linear in the number of voxels regardless of the number of lesions.
     Parameters
     ----------
     truth : array-like, bool
@@ -365,36 +961,13 @@ def _lesion_f1_score(truth, prediction, empty_value=1.0):
     fp: 3D connected-component from the prediction image that has no voxel overlapping with the ground-truth image.
     fn: 3d connected-component from the ground-truth image that has no voxel overlapping with the prediction image.
     """
-    tp, fp, fn = 0, 0, 0
-    f1_score = empty_value
-
-    labeled_ground_truth, num_lesions = scipy.ndimage.label(truth.astype(bool))
-
-    # For each true lesion, check if there is at least one overlapping voxel. This determines true positives and
-    # false negatives (unpredicted lesions)
-    for idx_lesion in range(1, num_lesions+1):
-        lesion = labeled_ground_truth == idx_lesion
-        lesion_pred_sum = lesion + prediction
-        if(np.max(lesion_pred_sum) > 1):
-            tp += 1
-        else:
-            fn += 1
-
-    # For each predicted lesion, check if there is at least one overlapping voxel in the ground truth.
-    labaled_prediction, num_pred_lesions = scipy.ndimage.label(prediction.astype(bool))
-    for idx_lesion in range(1, num_pred_lesions+1):
-        lesion = labaled_prediction == idx_lesion
-        lesion_pred_sum = lesion + truth
-        if(np.max(lesion_pred_sum) <= 1):  # No overlap
-           fp += 1
-
-    # Compute f1_score
-    denom = tp + (fp + fn)/2
-    if(denom != 0):
-        f1_score = tp / denom
-    return f1_score
+    labeled_ground_truth, num_lesions = label_mask(truth)
+    labeled_prediction, num_pred_lesions = label_mask(prediction)
+    return _lesion_f1_from_labels(labeled_ground_truth, num_lesions, labeled_prediction, num_pred_lesions,
+                                  empty_value=empty_value)
 
 
+@derived_from('lesions', _lesion_f1_from_tables)
 def lesion_f1_score(truth, prediction, batchwise=False):
     """ Computes the F1 score lesionwise. Lesions are considered accurately predicted if a single voxel overlaps between
     a region in `truth` and `prediction`.
@@ -413,15 +986,401 @@ def lesion_f1_score(truth, prediction, batchwise=False):
     float or tuple
         Lesion-wise F1-score. If batchwise=True, the tuple is the F1-score for every sample.
     """
+    tables = lesion_statistics(truth, prediction, batchwise=batchwise)
     if not batchwise:
-        num_channel = truth.shape[0]
-        f1_score = _lesion_f1_score(truth[0, ...], prediction[0, ...])
-        for i in range(1, num_channel):
-            f1_score += _lesion_f1_score(truth[i, ...], prediction[i, ...])
-        return f1_score / num_channel
+        return _lesion_f1_from_table(tables[0])
+    else:
+        return list(_lesion_f1_from_tables(tables))
+
+
+def _in_size_bucket(voxels, min_voxels, max_voxels):
+    return (voxels >= min_voxels) & (True if max_voxels is None else voxels < max_voxels)
+
+
+def lesion_size_bucket(voxels, buckets=LESION_SIZE_BUCKETS):
+    '''
+    Returns the name of the bucket of a lesion of the given number of voxels, or None if it is in no bucket.
+    '''
+    for name, (min_voxels, max_voxels) in buckets.items():
+        if(_in_size_bucket(voxels, min_voxels, max_voxels)):
+            return name
+    return None
+
+
+class SizeStratifiedLesionMetric:
+    '''
+    Lesion detection metric restricted to the lesions of one size bucket, derived from the tables of lesion_statistics.
+    True lesions are assigned to a bucket by their own size, as are false positive lesions of the prediction. Lesions of
+    a multi-channel sample are the 3D lesions of each channel (see label_mask).
+    Parameters
+    ----------
+    metric : str
+        'f1' (lesion-wise F1-score, as lesion_f1_score), 'sensitivity' (fraction of true lesions detected) or
+        'false_positives' (number of predicted lesions overlapping no true lesion). F1-score and sensitivity are NaN
+        for samples without any lesion of the bucket, so that they are left out of the aggregates.
+    min_voxels : int
+        Optional. Smallest lesion of the bucket. Default: 0.
+    max_voxels : int
+        Optional. Size of the lesions above the bucket, or None for no maximum. Default: None.
+    '''
+    requires = ('lesions',)
+    METRICS = ('f1', 'sensitivity', 'false_positives')
+
+    def __init__(self, metric, min_voxels=0, max_voxels=None):
+        if(metric not in self.METRICS):
+            raise ValueError(f'Unknown lesion metric {metric}; expected one of {self.METRICS}.')
+        self.metric = metric
+        self.min_voxels = min_voxels
+        self.max_voxels = max_voxels
+
+    def __repr__(self):
+        # Also identifies the metric in the score cache keys
+        return f'SizeStratifiedLesionMetric({self.metric!r}, {self.min_voxels!r}, {self.max_voxels!r})'
+
+    def _from_table(self, table):
+        truth_detected = table.truth['detected'][_in_size_bucket(table.truth['voxels'], self.min_voxels,
+                                                                 self.max_voxels)]
+        pred_detected = table.pred['detected'][_in_size_bucket(table.pred['voxels'], self.min_voxels,
+                                                               self.max_voxels)]
+        tp = int(np.count_nonzero(truth_detected))
+        fn = truth_detected.size - tp
+        fp = pred_detected.size - int(np.count_nonzero(pred_detected))
+        if(self.metric == 'false_positives'):
+            return fp
+        if(self.metric == 'sensitivity'):
+            return tp / (tp + fn) if tp + fn > 0 else float('nan')
+        denom = tp + (fp + fn)/2
+        return tp / denom if denom != 0 else float('nan')
+
+    def from_intermediates(self, tables):
+        return tuple(self._from_table(table) for table in tables)
+
+    def __call__(self, truth, prediction, batchwise=False):
+        return _batch_result(self.from_intermediates(lesion_statistics(truth, prediction, batchwise=batchwise)),
+                             batchwise)
+
+
+def size_stratified_lesion_metrics(buckets=LESION_SIZE_BUCKETS):
+    '''
+    Returns the size-stratified lesion metrics of every bucket, keyed by output name, e.g. 'Lesionwise F1-Score (tiny)',
+    'Lesion Sensitivity (tiny)' and 'Lesion False Positives (tiny)'; see SizeStratifiedLesionMetric.
+    Parameters
+    ----------
+    buckets : dict
+        Optional. {name: (min voxels, max voxels)}. Default: LESION_SIZE_BUCKETS.
+    Returns
+    -------
+    dict
+    '''
+    metric_names = {'f1': 'Lesionwise F1-Score', 'sensitivity': 'Lesion Sensitivity',
+                    'false_positives': 'Lesion False Positives'}
+    return {f'{metric_name} ({bucket})': SizeStratifiedLesionMetric(metric, min_voxels, max_voxels)
+            for bucket, (min_voxels, max_voxels) in buckets.items()
+            for metric, metric_name in metric_names.items()}
+
+
+# Distances between the surfaces of the truth and the prediction of a single sample, in the units of the voxel spacing,
+# and whether each mask is empty (distances are then undefined).
+SurfaceDistances = namedtuple('SurfaceDistances', ['truth_to_pred', 'pred_to_truth', 'truth_empty', 'pred_empty'])
+
+
+def _surface(mask):
+    # Foreground voxels with at least one 6-connected background neighbour (the volume border counts as background)
+    return mask & ~scipy.ndimage.binary_erosion(mask)
+
+
+def _sample_spacings(spacing, num_samples):
+    '''
+    Returns the voxel spacing of every sample, from a single spacing for all samples, one per sample, or None.
+    '''
+    if(spacing is None):
+        return [None] * num_samples
+    if(np.ndim(spacing) == 1):
+        return [spacing] * num_samples
+    return list(spacing)
+
+
+@register_intermediate('distances', requires=('masks', 'spacing'))
+def surface_distances(truth, prediction, batchwise=False, spacing=None, bounding_boxes=None, masks=None):
+    '''
+    Computes, for each sample, the distance from every surface voxel of each mask to the surface of the other. The
+    distance transforms only run inside the joint bounding box of both masks, padded by one voxel (see
+    sample_bounding_boxes): both surfaces lie inside it, so the distances are the same as over the full volume. The
+    channels of a sample are processed separately and their distances pooled.
+    Parameters
+    ----------
+    truth : np.array
+        Array containing the ground truth, with samples of shape (channel, x, y, z).
+    prediction : np.array
+        Array containing the prediction.
+    batchwise : bool
+        Optional. Indicate whether the computation should be done batchwise, assuming that the first dimension of the
+        data is the batch. Default: False.
+    spacing : sequence
+        Optional. Voxel spacing along (x, y, z), e.g. the zooms of the NIfTI header; either one spacing for every
+        sample or, if batchwise, one per sample. Default: 1 along every axis.
+    bounding_boxes : sequence
+        Optional. Precomputed bounding boxes of the samples; see sample_bounding_boxes. Default: None.
+    masks : sequence
+        Optional. Cropped masks of each sample, as returned by cropped_masks; bounding_boxes is then not used.
+        Default: None.
+    Returns
+    -------
+    tuple
+        SurfaceDistances for every sample. If batchwise=False, the tuple has a single entry.
+    '''
+    if(masks is None):
+        if(isinstance(truth, PackedMask)):
+            truth = truth.unpack() if batchwise else truth.unpack()[0]
+        if(isinstance(prediction, PackedMask)):
+            prediction = prediction.unpack() if batchwise else prediction.unpack()[0]
+        if(not batchwise):
+            truth = truth[np.newaxis, ...]
+            prediction = prediction[np.newaxis, ...]
+        masks = cropped_masks(truth, prediction, batchwise=True, bounding_boxes=bounding_boxes)
+
+    distances_list = []
+    for (sample_truth, sample_prediction, _), sample_spacing in zip(masks, _sample_spacings(spacing, len(masks))):
+        truth_to_pred, pred_to_truth = [np.empty(0)], [np.empty(0)]
+        for channel_truth, channel_prediction in zip(sample_truth, sample_prediction):
+            # Channels where either mask is empty have no distances to contribute
+            if(not channel_truth.any() or not channel_prediction.any()):
+                continue
+            truth_surface = _surface(channel_truth)
+            pred_surface = _surface(channel_prediction)
+            truth_to_pred.append(scipy.ndimage.distance_transform_edt(~pred_surface,
+                                                                      sampling=sample_spacing)[truth_surface])
+            pred_to_truth.append(scipy.ndimage.distance_transform_edt(~truth_surface,
+                                                                      sampling=sample_spacing)[pred_surface])
+        distances_list.append(SurfaceDistances(truth_to_pred=np.concatenate(truth_to_pred),
+                                               pred_to_truth=np.concatenate(pred_to_truth),
+                                               truth_empty=not sample_truth.any(),
+                                               pred_empty=not sample_prediction.any()))
+    return tuple(distances_list)
+
+
+def _surface_distance_score(distances, score):
+    '''
+    Applies score to the surface distances of a sample. If both masks are empty the surfaces agree and the distance is
+    0; if only one is, the distance is undefined and NaN is returned (NaN scores are left out of the aggregates).
+    '''
+    if(distances.truth_empty and distances.pred_empty):
+        return 0.0
+    if(distances.truth_empty or distances.pred_empty):
+        return np.nan
+    return float(score(distances))
+
+
+def _hd95_from_distances(distances_list):
+    return tuple(_surface_distance_score(distances, lambda d: max(np.percentile(d.truth_to_pred, 95),
+                                                                  np.percentile(d.pred_to_truth, 95)))
+                 for distances in distances_list)
+
+
+def _assd_from_distances(distances_list):
+    return tuple(_surface_distance_score(distances, lambda d: (d.truth_to_pred.mean() + d.pred_to_truth.mean()) / 2)
+                 for distances in distances_list)
+
+
+@derived_from('distances', _hd95_from_distances)
+def hausdorff_distance_95(truth, prediction, batchwise=False, spacing=None):
+    '''
+    Computes the 95th percentile Hausdorff distance between the surfaces of the truth and the prediction: the larger of
+    the 95th percentiles of the distances from each surface to the other. See surface_distances.
+    Parameters
+    ----------
+    prediction : np.array
+        Array containing the prediction.
+    truth : np.array
+        Array containing the ground truth.
+    batchwise : bool
+        Optional. Indicate whether the computation should be done batchwise, assuming that the first dimension of the
+        data is the batch. Default: False.
+    spacing : sequence
+        Optional. Voxel spacing along (x, y, z); see surface_distances. Default: 1 along every axis.
+    Returns
+    -------
+    float or tuple
+        Distance in the units of the spacing; 0 if both masks are empty, NaN if only one is.
+    '''
+    distances_list = surface_distances(truth, prediction, batchwise=batchwise, spacing=spacing)
+    return _batch_result(_hd95_from_distances(distances_list), batchwise)
+
+
+@derived_from('distances', _assd_from_distances)
+def average_symmetric_surface_distance(truth, prediction, batchwise=False, spacing=None):
+    '''
+    Computes the average symmetric surface distance: the mean of the average distances from each surface to the other.
+    See surface_distances.
+    Parameters
+    ----------
+    prediction : np.array
+        Array containing the prediction.
+    truth : np.array
+        Array containing the ground truth.
+    batchwise : bool
+        Optional. Indicate whether the computation should be done batchwise, assuming that the first dimension of the
+        data is the batch. Default: False.
+    spacing : sequence
+        Optional. Voxel spacing along (x, y, z); see surface_distances. Default: 1 along every axis.
+    Returns
+    -------
+    float or tuple
+        Distance in the units of the spacing; 0 if both masks are empty, NaN if only one is.
+    '''
+    distances_list = surface_distances(truth, prediction, batchwise=batchwise, spacing=spacing)
+    return _batch_result(_assd_from_distances(distances_list), batchwise)
+
+
+# Number of voxels binned at a time by threshold_sweep_counts, to bound the size of the bin index array
+_SWEEP_CHUNK_VOXELS = 2**22
+
+
+def threshold_sweep_counts(truth, probabilities, thresholds, batchwise=False):
+    '''
+    Computes the confusion counts of every sample at every threshold in a single pass over the voxels. Each predicted
+    value is binned by the number of thresholds below it, the bins are counted separately inside and outside the
+    truth, and a reverse cumulative sum gives the voxels predicted positive at each threshold. A voxel is positive at
+    threshold t if its value is > t, so the counts at t=0.5 match confusion_counts.
+    Parameters
+    ----------
+    truth : np.array
+        Array containing the ground truth.
+    probabilities : np.array
+        Array containing the predicted probabilities, with a shape matching 'truth'.
+    thresholds : sequence
+        Thresholds at which to binarize the probabilities.
+    batchwise : bool
+        Optional. Indicate whether the computation should be done batchwise, assuming that the first dimension of the
+        data is the batch. Default: False.
+    Returns
+    -------
+    tuple
+        ConfusionCounts for every sample, whose fields are arrays over the thresholds (in the given order). If
+        batchwise=False, the tuple has a single entry.
+    '''
+    if(not batchwise):
+        truth = truth[np.newaxis, ...]
+        probabilities = probabilities[np.newaxis, ...]
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    order = np.argsort(thresholds)
+    sorted_thresholds = thresholds[order]
+    num_bins = thresholds.size + 1
+
+    counts_list = []
+    for idx_sample in range(truth.shape[0]):
+        sample_truth = _binarize(truth[idx_sample, ...]).ravel()
+        sample_probabilities = np.asanyarray(probabilities[idx_sample, ...]).ravel()
+        # Compared in the precision of the probabilities, as probabilities > t would
+        sample_thresholds = sorted_thresholds
+        if(np.issubdtype(sample_probabilities.dtype, np.floating)):
+            sample_thresholds = sorted_thresholds.astype(sample_probabilities.dtype)
+        truth_hist = np.zeros(num_bins, dtype=np.int64)
+        all_hist = np.zeros(num_bins, dtype=np.int64)
+        for start in range(0, sample_truth.size, _SWEEP_CHUNK_VOXELS):
+            chunk = slice(start, start + _SWEEP_CHUNK_VOXELS)
+            chunk_truth = sample_truth[chunk]
+            # Voxels not above the lowest threshold (most of a softmax map) are negative everywhere and go to bin 0
+            above = sample_probabilities[chunk] > sample_thresholds[0]
+            truth_above = chunk_truth[above]
+            # Number of thresholds strictly below each value; the voxel is positive at the thresholds before its bin
+            bins = np.searchsorted(sample_thresholds, sample_probabilities[chunk][above], side='left')
+            all_hist += np.bincount(bins, minlength=num_bins)
+            all_hist[0] += above.size - bins.size
+            truth_hist += np.bincount(bins[truth_above], minlength=num_bins)
+            truth_hist[0] += np.count_nonzero(chunk_truth) - np.count_nonzero(truth_above)
+        # Voxels positive at the i-th sorted threshold are those in bins i+1 and above; stored in the given order
+        tp = np.empty(thresholds.size, dtype=np.int64)
+        pred_vol = np.empty(thresholds.size, dtype=np.int64)
+        tp[order] = np.cumsum(truth_hist[::-1])[::-1][1:]
+        pred_vol[order] = np.cumsum(all_hist[::-1])[::-1][1:]
+        truth_vol = np.full(thresholds.size, truth_hist.sum(), dtype=np.int64)
+        fp = pred_vol - tp
+        fn = truth_vol - tp
+        tn = sample_truth.size - tp - fp - fn
+        counts_list.append(ConfusionCounts(tp=tp, fp=fp, fn=fn, tn=tn, pred_vol=pred_vol, truth_vol=truth_vol))
+    return tuple(counts_list)
+
+
+# Curves reported by threshold_sweep, keyed like the scoring functions in settings.py
+SWEEP_METRICS = {'Dice': _dice_from_counts,
+                 'Volume Difference': _volume_difference_from_counts,
+                 'Precision': _precision_from_counts,
+                 'Sensitivity': _sensitivity_from_counts,
+                 'Specificity': _specificity_from_counts}
+
+
+def threshold_sweep(truth, probabilities, thresholds, batchwise=False):
+    '''
+    Computes the voxel metrics of SWEEP_METRICS at every threshold, from threshold_sweep_counts.
+    Parameters
+    ----------
+    truth : np.array
+        Array containing the ground truth.
+    probabilities : np.array
+        Array containing the predicted probabilities, with a shape matching 'truth'.
+    thresholds : sequence
+        Thresholds at which to binarize the probabilities.
+    batchwise : bool
+        Optional. Indicate whether the computation should be done batchwise, assuming that the first dimension of the
+        data is the batch. Default: False.
+    Returns
+    -------
+    dict
+        {metric name: list with, for every sample, the tuple of its values at each threshold}.
+    '''
+    counts_list = threshold_sweep_counts(truth, probabilities, thresholds, batchwise=batchwise)
+    return {name: [from_counts(counts) for counts in counts_list] for name, from_counts in SWEEP_METRICS.items()}
+
+
+def score_batch(truth, prediction, scoring_functions, truth_labels=None, profiler=None, spacings=None,
+                intermediates=None):
+    '''
+    Scores a batch with every function in scoring_functions. The shared intermediates required by the scoring functions
+    (see derived_from) are planned for the whole batch with plan_intermediates, computed once each, and handed to
+    every scoring function derived from them; other scoring functions are called on the batch directly.
+    Parameters
+    ----------
+    truth : np.array or PackedMask
+        Ground truth batch; the first dimension is the batch.
+    prediction : np.array or PackedMask
+        Prediction batch, with a shape matching 'truth'.
+    scoring_functions : dict
+        Dictionary of scoring functions to use, keyed by the desired output name.
+    truth_labels : sequence
+        Optional. Precomputed ground truth labels of each sample; see lesion_labels. Default: None.
+    profiler : isles.profiling.StageProfiler
+        Optional. If set, every shared intermediate and every scoring function are recorded as separate stages.
+        Default: None.
+    spacings : sequence
+        Optional. Voxel spacing of each sample, used by the surface distance metrics; see surface_distances.
+        Default: None.
+    intermediates : dict
+        Optional. Receives the shared intermediates computed for the batch, keyed by name. Names mapped to None are
+        computed even if no scoring function needs them, e.g. {'lesions': None} for the lesion tables. Default: None.
+    Returns
+    -------
+    dict
+        Dictionary of per-sample score tuples, keyed identically to scoring_functions.
+    '''
+    stage = profiler.stage if profiler is not None else (lambda name, category: nullcontext())
+    requested = []
+    if(intermediates is None):
+        intermediates = {}
     else:
-        f1_list = []
-        num_batch = truth.shape[0]
-        for idx_batch in range(num_batch):
-            f1_list.append(lesion_f1_score(truth[idx_batch, ...], prediction[idx_batch, ...], batchwise=False))
-        return f1_list
\ No newline at end of file
+        requested = [name for name, value in intermediates.items() if value is None]
+        for name in requested:
+            del intermediates[name]
+    required = [name for score in scoring_functions.values() for name in getattr(score, 'requires', ())]
+    compute_intermediates(truth, prediction, required + requested,
+                          inputs={'truth_labels': truth_labels, 'spacing': spacings},
+                          intermediates=intermediates, stage=stage)
+
+    batch_scores = {}
+    for score_name, score in scoring_functions.items():
+        with stage(score_name, 'scoring'):
+            if(hasattr(score, 'requires')):
+                batch_scores[score_name] = score.from_intermediates(*[intermediates[name] for name in score.requires])
+            else:
+                batch_scores[score_name] = score(truth=truth, prediction=prediction, batchwise=True)
+    return batch_scores
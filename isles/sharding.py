@@ -0,0 +1,181 @@
+import os, json, time, hashlib, platform
+from .scoring import SCORING_VERSION
+from .aggregation import ScoreAggregator
+from .profiling import merge_timings
+
+# Format of the partial results files; bumped when their content changes incompatibly.
+SHARD_FORMAT_VERSION = 2
+
+
+def parse_shard(text):
+    '''
+    Parses a shard given as 'i/N' (0 <= i < N) into (i, N).
+    '''
+    try:
+        index, num_shards = (int(part) for part in str(text).split('/'))
+    except ValueError:
+        raise ValueError(f"Shard must be given as 'i/N', got {text!r}.") from None
+    if(num_shards < 1 or not 0 <= index < num_shards):
+        raise ValueError(f'Shard index must be in [0, {num_shards}), got {index}.')
+    return index, num_shards
+
+
+def shard_of(key, num_shards):
+    '''
+    Returns the shard of a subject, from a hash of its key, e.g. its (subject, session) pair. The hash does not depend
+    on the process, host or order of the subjects, so every shard process assigns the subjects in the same way.
+    '''
+    digest = hashlib.sha256(json.dumps(list(key)).encode()).digest()
+    return int.from_bytes(digest[:8], 'big') % num_shards
+
+
+def shard_subjects(keys, shard):
+    '''
+    Returns the indices of the keys assigned to shard (i, N).
+    '''
+    index, num_shards = shard
+    return [idx for idx, key in enumerate(keys) if shard_of(key, num_shards) == index]
+
+
+def subjects_digest(keys):
+    '''
+    Returns a digest of a set of subject keys, independent of their order.
+    '''
+    return hashlib.sha256(json.dumps(sorted(list(key) for key in keys)).encode()).hexdigest()
+
+
+def _to_json(value):
+    # numpy scalars returned by custom scoring functions
+    if(hasattr(value, 'item')):
+        return value.item()
+    raise TypeError(f'Value of type {type(value).__name__} cannot be written to a partial results file')
+
+
+def write_partial(path, shard, dataset_keys, submissions, score_names, sweep_thresholds=None, timings=None):
+    '''
+    Writes the partial results of a shard. The file describes itself: besides the per-subject scores and the
+    aggregator state of every submission, it holds the shard, the digest of the whole dataset, the subjects assigned to
+    the shard, the scores and the scoring version, which merge_partials checks before combining shards.
+    Parameters
+    ----------
+    path : str
+        Path of the partial results file (JSON). It is written to a temporary file first and renamed, so that an
+        interrupted shard never leaves a truncated file.
+    shard : tuple
+        (i, N).
+    dataset_keys : list
+        Keys of every subject of the dataset, including those of other shards.
+    submissions : dict
+        {submission name: (ScoreAggregator, records)}, records being the per-subject {'subject', 'session', scores}
+        dicts of the shard (see evaluation.subject_record). The name is None outside of the batch mode.
+    score_names : list
+        Names of the scoring functions.
+    sweep_thresholds : list
+        Optional. Thresholds of the threshold sweep, if any. Default: None.
+    timings : dict
+        Optional. Stage timings of the shard, if Profiling is enabled. Default: None.
+    '''
+    index, num_shards = shard
+    state = {'format': 'isles-evaluation-shard',
+             'format_version': SHARD_FORMAT_VERSION,
+             'scoring_version': SCORING_VERSION,
+             'shard': index,
+             'num_shards': num_shards,
+             'num_subjects': len(dataset_keys),
+             'dataset_digest': subjects_digest(dataset_keys),
+             'assigned': [list(dataset_keys[idx]) for idx in shard_subjects(dataset_keys, shard)],
+             'score_names': list(score_names),
+             'sweep_thresholds': sweep_thresholds,
+             'timings': timings,
+             'host': platform.node(),
+             'created': time.time(),
+             'submissions': [{'name': name, 'aggregator': aggregator.to_dict(), 'subjects': records}
+                             for name, (aggregator, records) in submissions.items()]}
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    with open(temporary_path, 'w') as f:
+        json.dump(state, f, default=_to_json)
+    os.replace(temporary_path, path)
+
+
+def load_partial(path):
+    '''
+    Reads a partial results file written by write_partial.
+    '''
+    with open(path) as f:
+        try:
+            state = json.load(f)
+        except json.JSONDecodeError:
+            state = None
+    if(not isinstance(state, dict) or state.get('format') != 'isles-evaluation-shard'):
+        raise ValueError(f'{path} is not a partial results file.')
+    if(state['format_version'] != SHARD_FORMAT_VERSION):
+        raise ValueError(f'{path} has format version {state["format_version"]}; expected {SHARD_FORMAT_VERSION}.')
+    return state
+
+
+def merge_partials(paths):
+    '''
+    Combines the partial results files of the shards of one evaluation. All shards must come from the same dataset,
+    number of shards, scoring functions and scoring version, and every subject of the dataset must be covered by
+    exactly one shard.
+    Parameters
+    ----------
+    paths : list
+        Paths of the partial results files, one per shard.
+    Returns
+    -------
+    tuple
+        (submissions, score_names, sweep_thresholds, timings), with submissions {submission name: (ScoreAggregator,
+        records)} as given to write_partial, records sorted by subject and session, and timings the timings of the
+        shards combined by isles.profiling.merge_timings, or None if no shard recorded any.
+    '''
+    if(not paths):
+        raise ValueError('No partial results files to merge.')
+    partials = [load_partial(path) for path in paths]
+    reference = partials[0]
+    for path, partial in zip(paths, partials):
+        for field in ('scoring_version', 'num_shards', 'num_subjects', 'dataset_digest', 'score_names',
+                      'sweep_thresholds'):
+            if(partial[field] != reference[field]):
+                raise ValueError(f'{path} and {paths[0]} differ in {field}: '
+                                 f'{partial[field]!r} != {reference[field]!r}.')
+
+    shard_paths = {}
+    for path, partial in zip(paths, partials):
+        if(partial['shard'] in shard_paths):
+            raise ValueError(f'Shard {partial["shard"]} is in both {shard_paths[partial["shard"]]} and {path}.')
+        shard_paths[partial['shard']] = path
+    missing_shards = sorted(set(range(reference['num_shards'])) - set(shard_paths))
+    if(missing_shards):
+        raise ValueError(f'Missing shards {missing_shards} of {reference["num_shards"]}.')
+
+    assigned = {}
+    for path, partial in zip(paths, partials):
+        for key in map(tuple, partial['assigned']):
+            if(key in assigned):
+                raise ValueError(f'Subject {key} is assigned to both {assigned[key]} and {path}.')
+            assigned[key] = path
+    if(len(assigned) != reference['num_subjects'] or subjects_digest(assigned) != reference['dataset_digest']):
+        raise ValueError(f'The shards cover {len(assigned)} subjects instead of the {reference["num_subjects"]} of '
+                         f'the dataset.')
+
+    submissions = {}
+    for path, partial in zip(paths, partials):
+        for submission in partial['submissions']:
+            aggregator, records = submissions.setdefault(submission['name'], (ScoreAggregator(), []))
+            aggregator.merge(ScoreAggregator.from_dict(submission['aggregator']))
+            for record in submission['subjects']:
+                key = record.get('subject'), record.get('session')
+                if(assigned.get(key) != path):
+                    raise ValueError(f'{path} holds scores of subject {key}, which is not assigned to its shard.')
+                records.append(record)
+    for name, (aggregator, records) in submissions.items():
+        keys = [(record.get('subject'), record.get('session')) for record in records]
+        if(len(set(keys)) != len(keys)):
+            raise ValueError(f'Subjects scored more than once in submission {name}.')
+        records.sort(key=lambda record: json.dumps([record.get('subject'), record.get('session')]))
+    shard_timings = {f'shard{partial["shard"]}': partial['timings'] for partial in partials
+                     if partial['timings'] is not None}
+    timings = merge_timings(shard_timings) if shard_timings else None
+    return submissions, reference['score_names'], reference['sweep_thresholds'], timings
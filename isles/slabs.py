@@ -0,0 +1,252 @@
+import numpy as np, nibabel as nib
+import scipy.ndimage
+from .integrity import _open, _read_header
+from .scoring import ConfusionCounts, LesionTable, PAIR_DTYPE, lesion_dtype, score_batch
+
+# Intermediates computed by the slab-wise pass; scoring functions requiring anything else cannot be scored out of core.
+SLAB_INTERMEDIATES = ('counts', 'lesions')
+
+
+def iter_slabs(path, slab_depth):
+    '''
+    Streams a 3D NIfTI mask in z-slabs, decompressing the file once from start to end. NIfTI stores z as the slowest
+    axis, so every slab is a contiguous run of bytes; only one slab is decoded at a time.
+    Parameters
+    ----------
+    path : str
+        Path to the .nii or .nii.gz file.
+    slab_depth : int
+        Number of z-planes per slab.
+    Returns
+    -------
+    generator
+        (z_start, slab) pairs, where slab is a boolean (x, y, depth) array; voxels are foreground if their (scaled)
+        value is > 0.5, as in isles.masks.load_mask.
+    '''
+    with _open(path) as stream:
+        header = _read_header(stream)
+        shape = header.get_data_shape()
+        if(len(shape) < 3 or int(np.prod(shape[3:], dtype=np.int64)) != 1):
+            raise ValueError(f'{path}: slab-wise scoring needs a 3D volume, got shape {shape}.')
+        dtype = header.get_data_dtype()
+        slope, intercept = header.get_slope_inter()
+        stream.read(max(int(header['vox_offset']) - stream.tell(), 0))
+        plane_bytes = int(shape[0]) * int(shape[1]) * dtype.itemsize
+        for z_start in range(0, shape[2], slab_depth):
+            depth = min(slab_depth, shape[2] - z_start)
+            data = stream.read(plane_bytes * depth)
+            if(len(data) != plane_bytes * depth):
+                raise EOFError(f'{path}: data ends in the slab starting at z={z_start}')
+            slab = np.frombuffer(data, dtype=dtype).reshape((shape[0], shape[1], depth), order='F')
+            if(slope is not None and (slope != 1 or intercept not in (None, 0))):
+                slab = slab * slope + (intercept or 0)
+            yield z_start, slab if slab.dtype == bool else slab > 0.5
+
+
+class SlabLabeler:
+    '''
+    Connected-component labeling of a volume streamed in z-slabs. Each slab is labeled with scipy.ndimage.label
+    (6-connectivity, as for whole volumes) into provisional labels, and the labels touching across the boundary with
+    the previous slab are merged with a union-find. The statistics of every provisional label (voxels, bounding box
+    and first voxel in raster order) are kept, so that finish() can number the merged lesions in the same order as
+    scipy.ndimage.label does on the whole volume. Memory is set by the slab size and the number of lesions.
+    Parameters
+    ----------
+    shape : tuple
+        Shape (x, y, z) of the volume.
+    '''
+    def __init__(self, shape):
+        self.shape = tuple(int(size) for size in shape)
+        self.num_labels = 0
+        self.parent = np.zeros(1, dtype=np.int64)
+        self.voxels, self.bbox_start, self.bbox_stop, self.first_voxel = [], [], [], []
+        self.previous_plane = None
+
+    def _find(self, label):
+        root = label
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[label] != root:
+            self.parent[label], label = root, self.parent[label]
+        return root
+
+    def add(self, z_start, slab):
+        '''
+        Labels the next slab and returns its map of provisional labels, unique across slabs (0 is background).
+        '''
+        labels, num_labels = scipy.ndimage.label(slab)
+        voxels = np.bincount(labels.ravel(), minlength=num_labels + 1)[1:]
+        bbox_start = np.zeros((num_labels, 3), dtype=np.int64)
+        bbox_stop = np.zeros((num_labels, 3), dtype=np.int64)
+        for idx, slices in enumerate(scipy.ndimage.find_objects(labels)):
+            bbox_start[idx] = [axis_slice.start for axis_slice in slices]
+            bbox_stop[idx] = [axis_slice.stop for axis_slice in slices]
+        bbox_start[:, 2] += z_start
+        bbox_stop[:, 2] += z_start
+        # First voxel of each label in raster (C) order of the whole volume: (x, y) first, then z
+        foreground = np.flatnonzero(labels)
+        _, first = np.unique(labels.ravel()[foreground], return_index=True)
+        x, y, z = np.unravel_index(foreground[first], labels.shape)
+        first_voxel = (x * self.shape[1] + y) * self.shape[2] + z + z_start
+
+        labels = labels.astype(np.int64)
+        labels[labels > 0] += self.num_labels
+        self.parent = np.concatenate([self.parent, np.arange(self.num_labels + 1, self.num_labels + num_labels + 1)])
+
+        # Lesions continuing from the previous slab touch it through its last plane
+        if(self.previous_plane is not None):
+            both = (self.previous_plane > 0) & (labels[:, :, 0] > 0)
+            touching = np.unique(np.stack([self.previous_plane[both], labels[:, :, 0][both]]), axis=1)
+            for previous, current in touching.T:
+                previous_root, current_root = self._find(previous), self._find(current)
+                if(previous_root != current_root):
+                    self.parent[max(previous_root, current_root)] = min(previous_root, current_root)
+        self.previous_plane = labels[:, :, -1].copy()
+
+        self.voxels.append(voxels)
+        self.bbox_start.append(bbox_start)
+        self.bbox_stop.append(bbox_stop)
+        self.first_voxel.append(first_voxel)
+        self.num_labels += num_labels
+        return labels
+
+    def finish(self):
+        '''
+        Merges the provisional labels. Returns (final_labels, num_labels): final_labels maps every provisional label
+        (index 0 is background) to its lesion, numbered 1..num_labels as by scipy.ndimage.label on the whole volume.
+        '''
+        roots = self.parent.copy()
+        while True:
+            parents = roots[roots]
+            if(np.array_equal(parents, roots)):
+                break
+            roots = parents
+        first_voxel = np.concatenate([np.zeros(1, dtype=np.int64)] + self.first_voxel)
+        components, component_idx = np.unique(roots[1:], return_inverse=True)
+        component_first = np.full(components.size, np.iinfo(np.int64).max)
+        np.minimum.at(component_first, component_idx, first_voxel[1:])
+        rank = np.empty(components.size, dtype=np.int64)
+        rank[np.argsort(component_first, kind='stable')] = np.arange(1, components.size + 1)
+        return np.concatenate([np.zeros(1, dtype=np.int64), rank[component_idx]]), int(components.size)
+
+    def rows(self, final_labels, num_labels, overlap):
+        '''
+        Returns the LesionTable rows (see isles.scoring.lesion_dtype) of the merged lesions, given the voxels of every
+        provisional label overlapping the other mask.
+        '''
+        table = np.zeros(num_labels, dtype=lesion_dtype(3))
+        if(num_labels == 0):
+            return table
+        final = final_labels[1:] - 1
+        table['label'] = table['component'] = np.arange(1, num_labels + 1)
+        table['voxels'] = np.bincount(final, weights=np.concatenate(self.voxels), minlength=num_labels)
+        table['overlap'] = np.bincount(final, weights=overlap[1:], minlength=num_labels)
+        table['detected'] = table['overlap'] > 0
+        table['bbox_start'] = np.iinfo(np.int64).max
+        np.minimum.at(table['bbox_start'], final, np.concatenate(self.bbox_start))
+        np.maximum.at(table['bbox_stop'], final, np.concatenate(self.bbox_stop))
+        return table
+
+
+def slab_intermediates(truth_path, prediction_path, slab_depth=16):
+    '''
+    Computes the confusion counts and the lesion table of a subject in a single streaming pass over both masks, one
+    z-slab at a time, with the memory of a few slabs instead of whole volumes. The results are identical to those of
+    isles.scoring.confusion_counts and isles.scoring.lesion_statistics on the whole volumes, label numbers included.
+    Parameters
+    ----------
+    truth_path : str
+        Path to the ground truth mask, a single 3D NIfTI volume.
+    prediction_path : str
+        Path to the prediction, with the same shape.
+    slab_depth : int
+        Optional. Number of z-planes per slab. Default: 16.
+    Returns
+    -------
+    dict
+        {'counts': ConfusionCounts, 'lesions': (LesionTable,)}, batched as for a batch of a single sample.
+    '''
+    shape = nib.load(truth_path).shape[:3]
+    if(nib.load(prediction_path).shape[:3] != shape):
+        raise ValueError(f'Shape mismatch between {truth_path} and {prediction_path}.')
+    truth_labeler, pred_labeler = SlabLabeler(shape), SlabLabeler(shape)
+    tp = truth_vol = pred_vol = 0
+    truth_overlap, pred_overlap = [np.zeros(1, dtype=np.int64)], [np.zeros(1, dtype=np.int64)]
+    pair_truth, pair_pred, pair_overlap = [], [], []
+    for (z_start, truth), (_, prediction) in zip(iter_slabs(truth_path, slab_depth),
+                                                 iter_slabs(prediction_path, slab_depth)):
+        tp += int(np.count_nonzero(truth & prediction))
+        truth_vol += int(np.count_nonzero(truth))
+        pred_vol += int(np.count_nonzero(prediction))
+        num_truth, num_pred = truth_labeler.num_labels, pred_labeler.num_labels
+        truth_labels = truth_labeler.add(z_start, truth)
+        pred_labels = pred_labeler.add(z_start, prediction)
+        truth_overlap.append(np.bincount(truth_labels[prediction],
+                                         minlength=truth_labeler.num_labels + 1)[num_truth + 1:])
+        pred_overlap.append(np.bincount(pred_labels[truth], minlength=pred_labeler.num_labels + 1)[num_pred + 1:])
+        # Voxels shared by a provisional truth and prediction label, per pair
+        both = (truth_labels > 0) & (pred_labels > 0)
+        pair_keys, overlap = np.unique(truth_labels[both] * (pred_labeler.num_labels + 1) + pred_labels[both],
+                                       return_counts=True)
+        truth_idx, pred_idx = np.divmod(pair_keys, pred_labeler.num_labels + 1)
+        pair_truth.append(truth_idx)
+        pair_pred.append(pred_idx)
+        pair_overlap.append(overlap)
+
+    truth_final, num_truth = truth_labeler.finish()
+    pred_final, num_pred = pred_labeler.finish()
+    pair_keys = truth_final[np.concatenate(pair_truth + [np.zeros(0, dtype=np.int64)])] * (num_pred + 1) + \
+        pred_final[np.concatenate(pair_pred + [np.zeros(0, dtype=np.int64)])]
+    pair_keys, pair_idx = np.unique(pair_keys, return_inverse=True)
+    pairs = np.zeros(pair_keys.size, dtype=PAIR_DTYPE)
+    pairs['truth_label'], pairs['pred_label'] = np.divmod(pair_keys, num_pred + 1)
+    pairs['overlap'] = np.bincount(pair_idx, weights=np.concatenate(pair_overlap + [np.zeros(0, dtype=np.int64)]),
+                                   minlength=pair_keys.size)
+
+    table = LesionTable(truth=truth_labeler.rows(truth_final, num_truth, np.concatenate(truth_overlap)),
+                        pred=pred_labeler.rows(pred_final, num_pred, np.concatenate(pred_overlap)),
+                        pairs=pairs, num_channels=1)
+    fp, fn = pred_vol - tp, truth_vol - tp
+    counts = ConfusionCounts(tp=np.array([tp]), fp=np.array([fp]), fn=np.array([fn]),
+                             tn=np.array([int(np.prod(shape)) - tp - fp - fn]), pred_vol=np.array([pred_vol]),
+                             truth_vol=np.array([truth_vol]))
+    return {'counts': counts, 'lesions': (table,)}
+
+
+def slab_scoring_functions(scoring_functions):
+    '''
+    Splits scoring_functions into those that can be scored slab-wise, i.e. derived only from SLAB_INTERMEDIATES, and
+    the others. Returns (supported, unsupported), both keyed as scoring_functions.
+    '''
+    supported, unsupported = {}, {}
+    for score_name, score in scoring_functions.items():
+        requires = getattr(score, 'requires', None)
+        if(requires is not None and all(name in SLAB_INTERMEDIATES for name in requires)):
+            supported[score_name] = score
+        else:
+            unsupported[score_name] = score
+    return supported, unsupported
+
+
+def score_slabs(truth_path, prediction_path, scoring_functions, slab_depth=16, intermediates=None):
+    '''
+    Scores a subject out of core; see slab_intermediates. Scoring functions that cannot be scored slab-wise (see
+    slab_scoring_functions) are left out.
+    Parameters
+    ----------
+    truth_path, prediction_path, slab_depth
+        See slab_intermediates.
+    scoring_functions : dict
+        Dictionary of scoring functions to use, keyed by the desired output name.
+    intermediates : dict
+        Optional. Receives the intermediates of the subject, e.g. its lesion table. Default: None.
+    Returns
+    -------
+    dict
+        {score_name: score}.
+    '''
+    intermediates = {} if intermediates is None else intermediates
+    intermediates.update(slab_intermediates(truth_path, prediction_path, slab_depth))
+    supported, _ = slab_scoring_functions(scoring_functions)
+    batch_scores = score_batch(None, None, supported, intermediates=intermediates)
+    return {score_name: scores[0] for score_name, scores in batch_scores.items()}
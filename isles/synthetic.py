@@ -0,0 +1,96 @@
+import os, numpy as np, nibabel as nib
+from os.path import join
+
+# File name suffix of the synthetic masks, following the ATLAS ground truth naming
+MASK_SUFFIX = 'space-MNI152NLin2009aSym_label-L_desc-T1lesion_mask.nii.gz'
+
+
+def _draw_ellipsoid(mask, center, radii):
+    '''
+    Sets the voxels of mask inside the ellipsoid with the given center and radii (one per axis).
+    '''
+    low = np.maximum(np.floor(center - radii).astype(int), 0)
+    high = np.minimum(np.ceil(center + radii).astype(int) + 1, mask.shape)
+    if(np.any(high <= low)):
+        return
+    box = tuple(slice(start, stop) for start, stop in zip(low, high))
+    grid = np.ogrid[box]
+    inside = sum(((axis_grid - c) / r)**2 for axis_grid, c, r in zip(grid, center, radii)) <= 1
+    mask[box] |= inside
+
+
+def make_lesion_pair(rng, shape, num_lesions, radius_range, overlap, num_false_positives=0):
+    '''
+    Generates a synthetic (truth, prediction) pair of boolean masks. The truth contains num_lesions ellipsoids whose
+    radii are drawn uniformly from radius_range. Each predicted lesion is its true lesion shifted along a random
+    direction by (1 - overlap) times its diameter, so overlap=1 reproduces the truth and overlap=0 just misses it.
+    num_false_positives additional lesions are added to the prediction only.
+    Parameters
+    ----------
+    rng : np.random.Generator
+        Seeded random generator; the same seed always gives the same pair.
+    shape : tuple
+        Shape of the masks.
+    num_lesions : int
+        Number of true lesions.
+    radius_range : tuple
+        (min, max) radius of the lesions, in voxels.
+    overlap : float
+        Overlap level between 0 and 1.
+    num_false_positives : int
+        Optional. Number of predicted lesions without a true counterpart. Default: 0.
+    Returns
+    -------
+    tuple
+        (truth, prediction) boolean arrays of the given shape.
+    '''
+    shape = np.asarray(shape)
+    truth = np.zeros(shape, dtype=bool)
+    prediction = np.zeros(shape, dtype=bool)
+    for _ in range(num_lesions):
+        radii = rng.uniform(*radius_range, size=shape.size)
+        center = rng.uniform(0, shape - 1)
+        direction = rng.normal(size=shape.size)
+        direction /= np.linalg.norm(direction)
+        _draw_ellipsoid(truth, center, radii)
+        _draw_ellipsoid(prediction, center + (1 - overlap) * 2 * radii * direction, radii)
+    for _ in range(num_false_positives):
+        _draw_ellipsoid(prediction, rng.uniform(0, shape - 1), rng.uniform(*radius_range, size=shape.size))
+    return truth, prediction
+
+
+def write_mask(root, subject, mask, session='1'):
+    '''
+    Writes a mask into a BIDS tree as root/sub-<subject>/ses-<session>/anat/sub-<subject>_ses-<session>_<MASK_SUFFIX>.
+    Returns the path of the written file.
+    '''
+    anat_dir = join(root, f'sub-{subject}', f'ses-{session}', 'anat')
+    os.makedirs(anat_dir, exist_ok=True)
+    path = join(anat_dir, f'sub-{subject}_ses-{session}_{MASK_SUFFIX}')
+    nib.Nifti1Image(mask.astype(np.uint8), np.eye(4)).to_filename(path)
+    return path
+
+
+def write_synthetic_dataset(truth_root, prediction_root, num_subjects, shape, num_lesions, radius_range, overlap,
+                            num_false_positives=0, seed=0):
+    '''
+    Writes num_subjects synthetic pairs (see make_lesion_pair) as a ground truth and a prediction BIDS tree that
+    BIDSLoader can read. The dataset_description.json files are written by evaluation.py.
+    Parameters
+    ----------
+    truth_root : str
+        Root of the ground truth BIDS tree.
+    prediction_root : str
+        Root of the prediction BIDS tree.
+    num_subjects : int
+        Number of subjects to generate.
+    shape, num_lesions, radius_range, overlap, num_false_positives
+        See make_lesion_pair.
+    seed : int
+        Optional. Seed of the random generator. Default: 0.
+    '''
+    rng = np.random.default_rng(seed)
+    for idx in range(num_subjects):
+        truth, prediction = make_lesion_pair(rng, shape, num_lesions, radius_range, overlap, num_false_positives)
+        write_mask(truth_root, f'{idx:03d}', truth)
+        write_mask(prediction_root, f'{idx:03d}', prediction)
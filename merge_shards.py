@@ -0,0 +1,40 @@
+import json, argparse
+from settings import eval_settings
+from evaluation import write_metrics, write_submission_metrics, submission_output_path, subject_key, record_scores
+from isles.sharding import merge_partials
+
+# Combines the partial results files of `evaluation.py --shard i/N` runs into the outputs of an unsharded run
+# (MetricsOutputPath, SubjectScoresOutputPath, SweepOutputPath and, in batch mode, ComparisonOutputPath), after
+# checking that they come from the same evaluation and that every subject was evaluated by exactly one shard.
+
+
+def write_subject_scores(path, records):
+    with open(path, 'w') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merges the partial results files written by evaluation.py --shard '
+                                                 'i/N into the outputs of settings.py.')
+    parser.add_argument('partials', nargs='+', help='Partial results files, one per shard.')
+    args = parser.parse_args()
+
+    submissions, score_names, sweep_thresholds, timings = merge_partials(args.partials)
+    # The scores and thresholds of the shards are reported, whatever settings.py now holds
+    settings = {**eval_settings, 'ScoringFunctions': score_names, 'SweepThresholds': sweep_thresholds}
+    if(list(submissions) == [None]):
+        aggregator, records = submissions[None]
+        if(settings['SubjectScoresOutputPath'] is not None):
+            write_subject_scores(settings['SubjectScoresOutputPath'], records)
+        write_metrics(aggregator, {subject_key(record): record_scores(record) for record in records}, settings,
+                      timings=timings)
+    else:
+        if(settings['SubjectScoresOutputPath'] is not None):
+            for name, (_, records) in submissions.items():
+                write_subject_scores(submission_output_path(settings['SubjectScoresOutputPath'], name), records)
+        subject_scores = {name: {subject_key(record): record_scores(record) for record in records}
+                          for name, (_, records) in submissions.items()}
+        subject_keys = sorted({key for scores in subject_scores.values() for key in scores}, key=str)
+        write_submission_metrics({name: aggregator for name, (aggregator, _) in submissions.items()}, subject_scores,
+                                 subject_keys, settings, timings=timings)
@@ -1,9 +1,12 @@
 from isles.scoring import dice_coef, volume_difference, simple_lesion_count_difference, precision, sensitivity, \
-  specificity, accuracy, lesion_count_by_weighted_assignment, lesion_f1_score
+  specificity, accuracy, lesion_count_by_weighted_assignment, lesion_f1_score, hausdorff_distance_95, \
+  average_symmetric_surface_distance, size_stratified_lesion_metrics, LESION_SIZE_BUCKETS
 
 eval_settings = {
     "GroundTruthRoot": "/workspace/ground-truth/",     # Path to the ground truth
     "PredictionRoot": "/workspace/input/",             # Path to the user predictions
+    "PredictionRoots": None,                                # {name: path} of several submissions to compare; or None
+    "GroundTruthIndexRoot": None,                           # Path to the compile_ground_truth.py index; None to disable
     "GroundTruthBIDSDerivativeName": ["atlas2"],            # BIDS derivative name of the ground truth
     "PredictionBIDSDerivativeName": ["atlas2_prediction"],  # BIDS derivative name of the predictions
     "GroundTruthEntities": {                                # BIDS entities identifying the ground truth
@@ -15,9 +18,33 @@ eval_settings = {
         "suffix": "mask"
     },
     "LoaderBatchSize": 4,                                   # Number of images to load at a time
+    "PrefetchDepth": 1,                                     # Number of batches each worker decodes ahead while scoring
+    "MaskMode": True,                                       # Load images as boolean masks instead of float32 arrays
     "Multiprocessing": 8,                                   # Number of processors to use in parallel
+    "SchedulerChunkSize": 8,                                # Number of subjects per task handed to a worker
     "Aggregates": ["mean", "std", "min", "max", "25%", "50%", "75%", "count", "uniq", "freq"],  # Summary stats to use
+    "BootstrapResamples": None,                             # Bootstrap resamples of the mean confidence intervals; or None
+    "BootstrapSeed": 0,                                     # Seed of the bootstrap resamples
+    "BootstrapConfidence": 0.95,                            # Confidence level of the bootstrap intervals
+    "BootstrapReferencePath": None,                         # Per-subject scores of a submission to compare against
+    "LowerIsBetter": {'Volume Difference',                  # Scores ranked by ascending mean in the batch mode
+                      'Simple Lesion Count',
+                      'Hausdorff Distance 95',
+                      'Average Symmetric Surface Distance',
+                      *(f'Lesion False Positives ({bucket})' for bucket in LESION_SIZE_BUCKETS)},
     "MetricsOutputPath": "/workspace/metrics.json",            # Desired location of output summary
+    "SubjectScoresOutputPath": "/workspace/subject_scores.jsonl",  # Per-subject scores (JSON lines); None to disable
+    "LesionTableOutputPath": None,                          # Per-lesion statistics of every subject (CSV); or None
+    "ComparisonOutputPath": "/workspace/comparison.csv",   # Side-by-side aggregates of the PredictionRoots submissions
+    "SweepThresholds": None,                                # Thresholds to sweep over probability predictions; or None
+    "SweepOutputPath": "/workspace/threshold_sweep.json",   # Per-threshold metric curves of the sweep
+    "ScoreCachePath": None,                                 # SQLite file caching per-subject scores; None to disable
+    "ScoreCacheMaxBytes": 256 * 1024**2,                    # Size of the score cache before LRU eviction
+    "VolumeCachePath": None,                                # Directory caching decoded masks (memory-mapped); or None
+    "VolumeCacheMaxBytes": 32 * 1024**3,                    # Size of the volume cache before LRU eviction
+    "SlabDepth": None,                                      # Score in z-slabs of this many planes (see README); or None
+    "Profiling": False,                                     # Record per-stage timings in MetricsOutputPath
+    "TraceOutputPath": None,                                # Chrome/Perfetto trace of the workers if Profiling; or None
     "SampleBIDS": "/workspace/sample_bids/",           # Path to the sample BIDS directory; don't modify.
     "ScoringFunctions": {'Dice': dice_coef,                 # Functions to use for scoring the dataset.
                          'Volume Difference': volume_difference,
@@ -26,5 +53,9 @@ eval_settings = {
                          'Sensitivity': sensitivity,
                          'Specificity': specificity,
                          'Accuracy': accuracy,
-                         'Lesionwise F1-Score': lesion_f1_score}
+                         'Lesionwise F1-Score': lesion_f1_score,
+                         'Lesion Count by Weighted Assignment': lesion_count_by_weighted_assignment,
+                         'Hausdorff Distance 95': hausdorff_distance_95,
+                         'Average Symmetric Surface Distance': average_symmetric_surface_distance,
+                         **size_stratified_lesion_metrics()}
 }
@@ -1,28 +1,70 @@
-import os, numpy as np, nibabel as nib, SimpleITK as sitk, json, csv, re, random, tqdm
-from tqdm.contrib import tzip
-from os.path import join, basename, exists, splitext
-from glob import glob, iglob
+import os
+from functools import partial
+from multiprocessing import Pool
+from os.path import join, basename
+from glob import glob
+from tqdm import tqdm
+from isles.fusion import fuse_files
+from isles.bids_layout import prediction_bids_path
+from isles.masks import VolumeCache
 
-A_PATH = os.getenv('A_PATH', default=None)
-B_PATH = os.getenv('B_PATH', default=None)
+# Fuses the predictions of any number of models in a single read of every input.
+#   SRC_PATHS        Comma-separated prediction directories (A_PATH and B_PATH are still accepted for two models)
+#   DST_PATH         Output directory
+#   FUSION_RULE      union, intersection, majority, vote or mean (see isles.fusion.fuse_masks). Default: union
+#   FUSION_VOTES     Number of agreeing models for FUSION_RULE=vote
+#   FUSION_WEIGHTS   Comma-separated model weights for FUSION_RULE=mean. Default: equal weights
+#   FUSION_THRESHOLD Threshold on the weighted mean probability for FUSION_RULE=mean. Default: 0.5
+#   BIDS_OUTPUT      If True, write DST_PATH in the BIDS layout of convert_to_BIDS.py instead of flat files
+#   NUM_WORKERS      Number of processes. Default: all CPUs
+#   VOLUME_CACHE_PATH  Optional directory of the decoded-mask cache shared with evaluation.py (see isles.masks)
+SRC_PATHS = os.getenv('SRC_PATHS', default=None)
+SRC_PATHS = SRC_PATHS.split(',') if SRC_PATHS else [os.getenv('A_PATH'), os.getenv('B_PATH')]
 DST_PATH = os.getenv('DST_PATH', default=None)
+FUSION_RULE = os.getenv('FUSION_RULE', default='union')
+FUSION_VOTES = int(os.getenv('FUSION_VOTES')) if os.getenv('FUSION_VOTES') else None
+FUSION_WEIGHTS = [float(w) for w in os.getenv('FUSION_WEIGHTS').split(',')] if os.getenv('FUSION_WEIGHTS') else None
+FUSION_THRESHOLD = float(os.getenv('FUSION_THRESHOLD', default=0.5))
+BIDS_OUTPUT = os.getenv('BIDS_OUTPUT', default=None) == 'True'
+NUM_WORKERS = int(os.getenv('NUM_WORKERS', default=os.cpu_count()))
+VOLUME_CACHE_PATH = os.getenv('VOLUME_CACHE_PATH', default=None)
+VOLUME_CACHE_MAX_BYTES = int(os.getenv('VOLUME_CACHE_MAX_BYTES', default=32 * 1024**3))
 
-a_paths = sorted(glob(join(A_PATH, '*.nii.gz')))
-b_paths = sorted(glob(join(B_PATH, '*.nii.gz')))
-os.makedirs(DST_PATH, exist_ok=True)
 
-for a_path, b_path in tzip(a_paths, b_paths, dynamic_ncols=True):
-    if basename(a_path) != basename(b_path):
-        tqdm.write(f'Not matched: {basename(a_path)}, {basename(b_path)}')
-    else:
-        a = sitk.ReadImage(a_path)
-        b = sitk.ReadImage(b_path)
+def match_subjects(src_dirs):
+    '''
+    Returns [(file name, [path in each directory])] for the files present in every directory, and the file names
+    missing from at least one of them.
+    '''
+    names = [{basename(path) for path in glob(join(src_dir, '*.nii.gz'))} for src_dir in src_dirs]
+    common = set.intersection(*names)
+    unmatched = sorted(set.union(*names) - common)
+    return [(name, [join(src_dir, name) for src_dir in src_dirs]) for name in sorted(common)], unmatched
 
-        a_img = sitk.GetArrayFromImage(a)
-        b_img = sitk.GetArrayFromImage(b)
 
-        union_img = np.logical_or(a_img, b_img).astype(np.uint8)
+def fuse_subject(subject, dst_dir, bids_output, **fusion_kwargs):
+    name, paths = subject
+    dst_path = prediction_bids_path(dst_dir, name) if bids_output else join(dst_dir, name)
+    return fuse_files(paths, dst_path, **fusion_kwargs)
 
-        union = sitk.GetImageFromArray(union_img)
-        union.CopyInformation(a)
-        sitk.WriteImage(union, join(DST_PATH, basename(a_path)))
\ No newline at end of file
+
+if __name__ == '__main__':
+    if(FUSION_WEIGHTS is not None and len(FUSION_WEIGHTS) != len(SRC_PATHS)):
+        raise ValueError(f'FUSION_WEIGHTS has {len(FUSION_WEIGHTS)} weights for {len(SRC_PATHS)} models.')
+    os.makedirs(DST_PATH, exist_ok=True)
+    subjects, unmatched = match_subjects(SRC_PATHS)
+    for name in unmatched:
+        tqdm.write(f'Not matched: {name}')
+
+    fuse = partial(fuse_subject, dst_dir=DST_PATH, bids_output=BIDS_OUTPUT, rule=FUSION_RULE, votes=FUSION_VOTES,
+                   weights=FUSION_WEIGHTS, threshold=FUSION_THRESHOLD,
+                   volume_cache=VolumeCache(VOLUME_CACHE_PATH, VOLUME_CACHE_MAX_BYTES) if VOLUME_CACHE_PATH else None)
+    with Pool(NUM_WORKERS) as pool:
+        for _ in tqdm(pool.imap_unordered(fuse, subjects), total=len(subjects), desc=f'Fusion ({FUSION_RULE})',
+                      dynamic_ncols=True):
+            pass
+
+    if(BIDS_OUTPUT):
+        from bidsio import BIDSLoader
+        from settings import eval_settings
+        BIDSLoader.write_dataset_description(DST_PATH, eval_settings['PredictionBIDSDerivativeName'][0])